@@ -6,14 +6,24 @@
 # USAGE:
 # --dir - Directory to search, in beets format
 # --artifact - The full filename of the artifact to search for
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Check every album path in ~/Music and report albums that do not have cover.jpg
 # python3 audit_missing_artifacts.py --dir=~/Music --artifact=cover.jpg
 import argparse,os,beetutils
 
-def main(library_dir: str, artifact: str) -> int:
+def main(library_dir: str, artifact: str, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, output: str = "text", scan_jobs: int = None) -> int:
     library_dir = os.path.expanduser(library_dir)
-    library_albums = beetutils.get_library_albums(library_dir)
+    if index_path is not None:
+        index_path = os.path.expanduser(index_path)
+
+    # Use the snapshot if one has been provided, otherwise stream the albums from the library
+    library_albums = snapshot.get_library_albums() if snapshot is not None else beetutils.iter_library_albums(library_dir, index_path, scan_jobs)
 
     audit_result = True
 
@@ -23,9 +33,11 @@ def main(library_dir: str, artifact: str) -> int:
         album_path = os.path.join(library_dir, library_album)
 
         # If the artifact is not present in the album path, print it
+        beetutils.METRICS.count("stat_calls")
         if not os.path.exists(os.path.join(album_path, artifact)):
             audit_result = False
-            print(album_path)
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "missing_artifact", os.path.join(album_path, artifact), album_path, "add", text=album_path)
     
     return 0 if audit_result else 1
 
@@ -34,6 +46,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
     parser.add_argument("--artifact", nargs="?", default="cover.jpg", help="The filename of the artifact to audit for")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.dir, args.artifact))
\ No newline at end of file
+    with beetutils.instrumented(args, "audit_missing_artifacts"):
+        result = main(args.dir, args.artifact, index_path=args.index, output=args.output, scan_jobs=args.scanjobs)
+
+    exit(result)
\ No newline at end of file
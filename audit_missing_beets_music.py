@@ -5,36 +5,88 @@
 # USAGE:
 # --db - Path to the beets datbase file
 # --dir - Directory to search, in beets format
+# --both - Also report songs in the library that are not in the beets database
+# --since - Only check songs modified or added since an age (e.g. 1d), date or timestamp, without scanning the library
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Search compare the ~/Music library with the ~/library.db beets database
 # python3 audit_missing_beets_music.py --dir=~/Music --db=~/library.db
+# Report songs missing from either the ~/Music library or the ~/library.db beets database
+# python3 audit_missing_beets_music.py --dir=~/Music --db=~/library.db --both
+# Write the songs missing from either as JSON records, one per line
+# python3 audit_missing_beets_music.py --dir=~/Music --db=~/library.db --both --output=ndjson
+# Check only the songs in the ~/library.db beets database touched within the last day
+# python3 audit_missing_beets_music.py --dir=~/Music --db=~/library.db --since=1d
 import argparse,beetutils
 from os.path import expanduser
+from typing import Iterable
 
-def main(db: str, library_dir: str) -> int:
+def main(db: str, library_dir: str, both: bool = False, since: float = None, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, beets_songs: Iterable[str] = None, output: str = "text", scan_jobs: int = None) -> int:
     # Expansion
     library_dir = expanduser(library_dir)
+    if index_path is not None:
+        index_path = expanduser(index_path)
     db = expanduser(db)
     
-    # Retrieve both lists
-    beets_songs = beetutils.get_beets_songs(db)
-    library_songs = beetutils.get_library_songs(library_dir)
+    # Stream the songs from the database unless they have already been provided
+    if beets_songs is None:
+        beets_songs = beetutils.iter_beets_songs(db, since=since)
 
-    audit_result = True
+    if since is not None and snapshot is None:
+        # Only a handful of recent songs are being checked, so look for each directly instead of scanning the library
+        findings = ((True, beets_song) for beets_song in beetutils.iter_missing_files(beets_songs))
+    else:
+        # Use the snapshot if one has been provided, otherwise stream the songs from the library
+        library_songs = snapshot.get_library_songs() if snapshot is not None else beetutils.iter_library_songs(library_dir, index_path=index_path, scan_jobs=scan_jobs)
 
-    # Print any songs in the beets database not present in the library folder
-    for beets_song in beets_songs:
-        if beets_song not in library_songs:
-            audit_result = False
-            print(beets_song)
-    
-    return 0 if audit_result else 1
+        # Compare both in a single pass, reporting songs missing from the library as soon as they are found
+        findings = beetutils.iter_reconcile(beets_songs, library_songs, both)
+
+    missing_library = 0
+    missing_beets = 0
+
+    for in_beets, song in findings:
+        beetutils.METRICS.count("files_matched")
+
+        if in_beets:
+            # Print any songs in the beets database not present in the library folder
+            if both and missing_library == 0 and output == "text":
+                print("Music in beets db not in library:")
+
+            missing_library += 1
+            beetutils.emit(output, "missing_library_song", song, beetutils.album_of(song, library_dir), "remove_from_db")
+        else:
+            # Print any songs in the library folder not present in the beets database
+            if missing_beets == 0 and output == "text":
+                print("Music in library not in beets db:")
+
+            missing_beets += 1
+            beetutils.emit(output, "missing_db_song", song, beetutils.album_of(song, library_dir), "import")
+
+    return 0 if missing_library == 0 and missing_beets == 0 else 1
 
 if __name__ == "__main__":
     # Interactive command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
     parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    parser.add_argument("--both", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Also report songs in the library not present in the beets database")
+    parser.add_argument("--since", type=beetutils.string_to_timestamp, nargs="?", default=None, help="Only check songs modified or added since an age (e.g. 1d), date or UNIX timestamp")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.db, args.dir))
\ No newline at end of file
+    if args.both and args.since is not None:
+        parser.error("--both requires every song in the beets database, and cannot be combined with --since")
+
+    with beetutils.instrumented(args, "audit_missing_beets_music"):
+        result = main(args.db, args.dir, args.both, args.since, index_path=args.index, output=args.output, scan_jobs=args.scanjobs)
+
+    exit(result)
\ No newline at end of file
@@ -1,37 +1,267 @@
 #!/usr/bin/env python3
-# audit_missing_library_music
+# audit_missing_converted_music
 # Retrieves all songs in both the beets datbase and converted library folder
 # then returns a list of all paths in the beets database that do not exist in the converted library folder
+# Optionally, it will also verify that each converted song is complete, comparing it with its source
+# Requires mutagen for --verify
 # USAGE:
 # --db - Path to the beets datbase file
 # --dir - Directory to search, in beets format
 # --beetsdir - Name of the subdir for the beets library present in the db
 # --librarydir - Name of the subdir for the library folder
 # --ext - File format of the converted directory
+# --both - Also report songs in the converted library that are not in the beets database
+# --since - Only check songs modified or added since an age (e.g. 1d), date or timestamp, without scanning the converted library
+# --verify - Also check that each converted song has valid frames, is not truncated, and matches the duration of its source
+# --verifycache - Path to the database of verified songs, only songs which have changed since are verified again
+# --jobs - Number of songs to verify at once, defaults to the number of CPUs
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Check all mp3 versions of songs in ~/library.db located at ~/Music/FLAC that do not exist under ~/Music/V2
 # python3 audit_missing_converted_music.py --db=~/library.db --dir=~/Music/V2 --beetsdir=FLAC --librarydir=V2 --ext=mp3
-import argparse,beetutils
+# Additionally report any mp3s under ~/Music/V2 which no longer have a song in ~/library.db
+# python3 audit_missing_converted_music.py --db=~/library.db --dir=~/Music/V2 --beetsdir=FLAC --librarydir=V2 --ext=mp3 --both
+# Additionally report any mp3s under ~/Music/V2 which are truncated or do not match their song in ~/Music/FLAC
+# python3 audit_missing_converted_music.py --db=~/library.db --dir=~/Music/V2 --beetsdir=FLAC --librarydir=V2 --ext=mp3 --verify
+import argparse,beetutils,os,sys
 from os.path import expanduser
+from typing import Iterable, Iterator, Tuple
 
-def main(db: str, library_dir: str, beets_subdir: str, library_subdir: str, extension: str) -> int:
+# Most seconds a converted song may differ in duration from its source, allowing for encoder padding
+DURATION_TOLERANCE = 1.0
+# Smallest share of the bytes promised by the MP3 header which must be on disk
+MIN_SIZE_RATIO = 0.98
+
+def main(db: str, library_dir: str, beets_subdir: str, library_subdir: str, extension: str, both: bool = False, since: float = None, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, beets_songs: Iterable[str] = None, output: str = "text", verify_cache_path: str = None, jobs: int = None, scan_jobs: int = None) -> int:
     # Expansion
     db = expanduser(db)
     library_dir = expanduser(library_dir)
+    if index_path is not None:
+        index_path = expanduser(index_path)
+
+    # Stream the songs from the database unless they have already been provided
+    if beets_songs is None:
+        beets_songs = beetutils.iter_beets_songs(db, extension, since)
+
+    # Both sides are compared by their path relative to their own root, e.g. ~/Music/FLAC and ~/Music/V2
+    converted_index = beetutils.PathIndex(library_dir)
+    beets_index = converted_index.with_root(beetutils.sibling_root(library_dir, library_subdir, beets_subdir))
+    beets_keys = _iter_keys(beets_index, beets_songs)
+
+    if since is not None and snapshot is None:
+        # Only a handful of recent songs are being checked, so look for each directly instead of scanning the converted library
+        findings = ((True, beets_song) for beets_song in beetutils.iter_missing_files(converted_index.path(key) for key in beets_keys))
+    else:
+        # Use the snapshot if one has been provided, otherwise stream the songs from the converted library
+        library_songs = snapshot.get_library_songs(extension) if snapshot is not None else beetutils.iter_library_songs(library_dir, extension, index_path, scan_jobs)
+
+        # Compare both in a single pass on the compact keys, reporting songs missing from the converted library as soon as they are found
+        findings = ((in_beets, converted_index.path(key)) for in_beets, key in beetutils.iter_reconcile(beets_keys, _iter_keys(converted_index, library_songs), both))
+
+    missing_converted = 0
+    missing_beets = 0
+
+    for in_beets, song in findings:
+        beetutils.METRICS.count("files_matched")
+
+        if in_beets:
+            # Print any songs in the beets database not present in the converted library folder
+            if both and missing_converted == 0 and output == "text":
+                print("Music in beets db not in converted library:")
+
+            missing_converted += 1
+            beetutils.emit(output, "missing_converted_song", song, beetutils.album_of(song, library_dir), "convert")
+        else:
+            # Print any songs in the converted library folder not present in the beets database
+            if missing_beets == 0 and output == "text":
+                print("Music in converted library not in beets db:")
+
+            missing_beets += 1
+            beetutils.emit(output, "orphaned_converted_song", song, beetutils.album_of(song, library_dir), "delete")
+
+    # Check the songs that do exist once every missing song has been reported
+    verify_result = True
+    if verify_cache_path is not None:
+        verify_result = verify_converted(db, library_dir, beets_subdir, library_subdir, extension, expanduser(verify_cache_path), since, jobs, output)
+
+    return 0 if missing_converted == 0 and missing_beets == 0 and verify_result else 1
+
+def _iter_keys(path_index: beetutils.PathIndex, songs: Iterable[str]) -> Iterator[Tuple[str, ...]]:
+    """
+    Stream the keys of songs relative to the root of an index, reporting any songs outside of the root
+
+    Args:
+        path_index: Index of the root the songs should be within
+        songs: Full song paths
+
+    Returns:
+        A generator of the key of each song within the root
+    """
+
+    for song in songs:
+        key = path_index.key(song)
+
+        if key is None:
+            print("Skipping %s, it is not within %s" % (song, path_index.root), file=sys.stderr)
+            continue
+
+        yield key
+
+def verify_converted(db: str, library_dir: str, beets_subdir: str, library_subdir: str, extension: str, verify_cache_path: str, since: float = None, jobs: int = None, output: str = "text") -> bool:
+    """
+    Verifies every converted song against its source across a pool of worker processes, reporting any which are damaged
+    Results are cached against the size and mtime of both songs, so only changed pairs are verified again
+
+    Args:
+        db: Path to the SQLite beets database
+        library_dir: Path to the converted library
+        beets_subdir: Name of the subdir for the beets library present in the db
+        library_subdir: Name of the subdir for the converted library
+        extension: File extension of the converted songs
+        verify_cache_path: Path to the database of verified songs
+        since: If provided, only verify songs modified or added at or after this UNIX timestamp
+        jobs: Number of songs to verify at once, defaults to the number of CPUs
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+
+    Returns:
+        True if every converted song that exists is intact, False if any are damaged
+    """
+
+    verify_cache = beetutils.ResultCache(verify_cache_path)
+    converted_index = beetutils.PathIndex(library_dir)
+    beets_index = converted_index.with_root(beetutils.sibling_root(library_dir, library_subdir, beets_subdir))
+    damaged = 0
+
+    try:
+        # Report cached results straight away, and collect the pairs that need verifying
+        pending = []
+        for source, converted, stamp in _iter_pairs(db, beets_index, converted_index, extension, since):
+            cached, failure = verify_cache.get(converted, stamp)
+
+            if not cached:
+                pending.append((source, converted, stamp))
+                continue
+
+            beetutils.METRICS.count("songs_reused")
+            if failure is not None:
+                damaged += 1
+                _emit_damaged(output, converted, library_dir, failure)
+
+        results = beetutils.map_in_processes(verify_song, [source for source, converted, stamp in pending], [converted for source, converted, stamp in pending], jobs=jobs)
 
-    # Retrieve both lists
-    beets_songs = [beets_song.replace(beets_subdir, library_subdir) for beets_song in beetutils.get_beets_songs(db, extension)]
-    library_songs = beetutils.get_library_songs(library_dir, extension)
+        for (source, converted, stamp), failure in zip(pending, results):
+            beetutils.METRICS.count("songs_verified")
+            verify_cache.put(converted, stamp, failure)
 
-    audit_result = True
+            if failure is not None:
+                damaged += 1
+                _emit_damaged(output, converted, library_dir, failure)
 
-    # Print any songs in the library folder not present in the beets database
-    for beets_song in beets_songs:
-        if beets_song not in library_songs:
-            audit_result = False
-            print(beets_song)
-    
-    return 0 if audit_result else 1
+        verify_cache.save()
+    finally:
+        verify_cache.close()
+
+    return damaged == 0
+
+def _iter_pairs(db: str, beets_index: beetutils.PathIndex, converted_index: beetutils.PathIndex, extension: str, since: float = None) -> Iterator[Tuple[str, str, Tuple[int, ...]]]:
+    """
+    Stream each source and converted song pair which both exist, along with the stamp of both songs
+
+    Args:
+        db: Path to the SQLite beets database
+        beets_index: Index of the root of the beets library
+        converted_index: Index of the root of the converted library
+        extension: File extension of the converted songs
+        since: If provided, only return songs modified or added at or after this UNIX timestamp
+
+    Returns:
+        A generator of (source, converted, stamp) tuples, see beetutils.file_stamp
+    """
+
+    for row in beetutils.iter_beets_rows(db, ["path"], since):
+        source = beetutils.decode_beets_path(row[0])
+        relative_key = beets_index.key(beetutils.with_extension(source, extension))
+
+        # Songs outside of the beets library are reported by the audit itself
+        if relative_key is None:
+            continue
+
+        converted = converted_index.path(relative_key)
+
+        try:
+            stamp = beetutils.file_stamp(source, converted)
+        except FileNotFoundError:
+            # Missing songs are reported by the audit itself
+            continue
+
+        yield source, converted, stamp
+
+def _emit_damaged(output: str, converted: str, library_dir: str, failure: str) -> None:
+    """
+    Reports a damaged converted song, along with why it failed verification
+
+    Args:
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+        converted: Full path to the damaged converted song
+        library_dir: Path to the converted library
+        failure: Why the song failed verification
+    """
+
+    beetutils.METRICS.count("files_matched")
+    beetutils.emit(output, "damaged_converted_song", converted, beetutils.album_of(converted, library_dir), "convert", "%s: %s" % (converted, failure), reason=failure)
+
+def verify_song(source: str, converted: str) -> str:
+    """
+    Checks that a converted song is complete, and matches the duration of its source
+
+    Args:
+        source: Full path to the song in the library
+        converted: Full path to the converted song
+
+    Returns:
+        Why the converted song failed verification, or None if it is intact
+    """
+
+    # mutagen is only needed to verify, so the audit itself and the scripts importing it run without it
+    import mutagen
+    from mutagen.mp3 import MP3
+
+    try:
+        if os.path.getsize(converted) == 0:
+            return "empty file"
+
+        # mutagen raises if it cannot find a single MPEG frame
+        converted_song = mutagen.File(converted)
+        source_song = mutagen.File(source)
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+    if converted_song is None:
+        return "unrecognised format"
+    if source_song is None:
+        return "unrecognised source format"
+
+    if isinstance(converted_song, MP3):
+        # mutagen flags streams whose first frame is not followed by further valid frames
+        if converted_song.info.sketchy:
+            return "no valid MPEG frames"
+
+        # Xing and VBRI headers record the size of the whole stream, which a truncated file falls short of
+        # Leave the ID3 tag out of the size, otherwise an embedded cover could hide a truncated stream
+        expected_size = converted_song.info.bitrate * converted_song.info.length / 8
+        stream_size = os.path.getsize(converted) - (converted_song.tags.size if converted_song.tags is not None else 0)
+        if stream_size < expected_size * MIN_SIZE_RATIO:
+            return "truncated, %d of %d bytes" % (stream_size, expected_size)
+
+    if abs(converted_song.info.length - source_song.info.length) > DURATION_TOLERANCE:
+        return "duration %.1fs does not match source %.1fs" % (converted_song.info.length, source_song.info.length)
+
+    return None
 
 if __name__ == "__main__":
     # Interactive command line arguments
@@ -41,6 +271,21 @@ if __name__ == "__main__":
     parser.add_argument("--beetsdir", nargs="?", default="FLAC", help="Name of the subdir for the beets library present in the db")
     parser.add_argument("--librarydir", nargs="?", default="V2", help="Name of the subdir for the library folder")
     parser.add_argument("--ext", nargs="?", default="mp3", help="File format of the converted directory")
+    parser.add_argument("--verify", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Also verify that each converted song is intact and matches its source")
+    parser.add_argument("--verifycache", nargs="?", default="~/.config/beets/verify_cache.db", help="The database of verified songs")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of songs to verify at once, defaults to the number of CPUs")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    parser.add_argument("--both", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Also report songs in the converted library not present in the beets database")
+    parser.add_argument("--since", type=beetutils.string_to_timestamp, nargs="?", default=None, help="Only check songs modified or added since an age (e.g. 1d), date or UNIX timestamp")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.db, args.dir, args.beetsdir, args.librarydir, args.ext))
\ No newline at end of file
+    if args.both and args.since is not None:
+        parser.error("--both requires every song in the beets database, and cannot be combined with --since")
+
+    with beetutils.instrumented(args, "audit_missing_converted_music"):
+        result = main(args.db, args.dir, args.beetsdir, args.librarydir, args.ext, args.both, args.since, index_path=args.index, output=args.output, verify_cache_path=args.verifycache if args.verify else None, jobs=args.jobs, scan_jobs=args.scanjobs)
+
+    exit(result)
\ No newline at end of file
@@ -5,28 +5,40 @@
 # USAGE:
 # --db - Path to the beets datbase file
 # --dir - Directory to search, in beets format
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Search compare the ~/Music library with the ~/library.db beets database
 # python3 audit_missing_library_music.py --dir=~/Music --db=~/library.db
 import argparse,beetutils
 from os.path import expanduser
+from typing import Iterable
 
-def main(db: str, library_dir: str) -> int:
+def main(db: str, library_dir: str, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, beets_songs: Iterable[str] = None, output: str = "text", scan_jobs: int = None) -> int:
     # Expansion
     db = expanduser(db)
     library_dir = expanduser(library_dir)
+    if index_path is not None:
+        index_path = expanduser(index_path)
 
-    # Retrieve both lists
-    beets_songs = beetutils.get_beets_songs(db)
-    library_songs = beetutils.get_library_songs(library_dir)
+    # Stream the songs from the database unless they have already been provided
+    if beets_songs is None:
+        beets_songs = beetutils.iter_beets_songs(db)
+
+    # Use the snapshot if one has been provided, otherwise stream the songs from the library
+    library_songs = snapshot.get_library_songs() if snapshot is not None else beetutils.iter_library_songs(library_dir, index_path=index_path, scan_jobs=scan_jobs)
 
     audit_result = True
 
-    # Print any songs in the library folder not present in the beets database
-    for library_song in library_songs:
-        if library_song not in beets_songs:
-            audit_result = False
-            print(library_song)
+    # Compare both in a single pass, printing any songs in the library folder not present in the beets database as they are found
+    for in_library, library_song in beetutils.iter_reconcile(library_songs, beets_songs, False):
+        audit_result = False
+        beetutils.METRICS.count("files_matched")
+        beetutils.emit(output, "missing_db_song", library_song, beetutils.album_of(library_song, library_dir), "import")
     
     return 0 if audit_result else 1
 
@@ -35,6 +47,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
     parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.db, args.dir))
\ No newline at end of file
+    with beetutils.instrumented(args, "audit_missing_library_music"):
+        result = main(args.db, args.dir, index_path=args.index, output=args.output, scan_jobs=args.scanjobs)
+
+    exit(result)
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# audit_tag_drift.py
+# Retrieves the tags beets stores for every song in the beets database, as well as the tags written in each file
+# then returns every field where the two no longer match, such as after a change with write disabled, or zero
+# The tags read from each file are cached along with its size and mtime, so only changed files are opened again
+# Requires mutagen
+# USAGE:
+# --db - Path to the beets datbase file
+# --dir - Directory of the library, in beets format, used to group findings by album
+# --fields - Space separated beets fields to compare, see FIELD_TAGS
+# --config - Path to the beets config.yaml, if it exists, with original_date set the year is compared with the original year
+# --converted - Optional directory of the converted library, to also compare the tags of the converted songs
+# --beetsdir - Name of the subdir for the beets library present in the db
+# --converteddir - Name of the subdir for the converted folder
+# --ext - File format of the converted directory
+# --since - Only check songs modified or added since an age (e.g. 1d), date or timestamp
+# --cache - Path to the database of tags read from files
+# --jobs - Number of files to read at once, defaults to the number of CPUs
+# --output - Write findings as lines of text (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
+# EXAMPLE:
+# Compare the tags of every song in ~/Music/FLAC with ~/library.db
+# python3 audit_tag_drift.py --db=~/library.db --dir=~/Music/FLAC
+# Compare only the titles and track numbers, of the library and the converted library in ~/Music/V2
+# python3 audit_tag_drift.py --db=~/library.db --dir=~/Music/FLAC --fields="title track" --converted=~/Music/V2
+import argparse,beetutils,os,re,sys
+from argparse import ArgumentTypeError
+from typing import Dict, List, Tuple
+import mutagen
+
+# Tag that each beets field is written to, in the format independent keys of mutagen's easy interface
+FIELD_TAGS = {
+    "title": "title",
+    "artist": "artist",
+    "album": "album",
+    "albumartist": "albumartist",
+    "genre": "genre",
+    "composer": "composer",
+    "track": "tracknumber",
+    "disc": "discnumber",
+    "year": "date",
+    "mb_trackid": "musicbrainz_trackid",
+    "mb_albumid": "musicbrainz_albumid"
+}
+# Fields beets stores as integers, which are compared on the leading number of the tag, e.g. 3 from 3/12
+INT_FIELDS = ["track", "disc", "year"]
+DEFAULT_FIELDS = "title artist album albumartist track disc year"
+
+def main(db: str, library_dir: str, fields: List[str], cache_path: str, jobs: int = None, since: float = None, converted_dir: str = None, beets_subdir: str = "FLAC", converted_subdir: str = "V2", extension: str = "mp3", output: str = "text", config_path: str = None) -> int:
+    # Expansion
+    db = os.path.expanduser(db)
+    library_dir = os.path.expanduser(library_dir)
+    cache_path = os.path.expanduser(cache_path)
+    if config_path is not None:
+        config_path = os.path.expanduser(config_path)
+
+    # With original_date, beets writes the original year of a reissue to the date tag rather than the year of the release
+    original_date = config_path is not None and os.path.isfile(config_path) and bool(beetutils.load_beets_config(config_path).get("original_date", False))
+    original_year = original_date and "year" in fields
+
+    # Songs are grouped into albums of either library
+    album_roots = library_dir
+    beets_index = converted_index = None
+
+    if converted_dir is not None:
+        converted_dir = os.path.expanduser(converted_dir)
+        album_roots = os.pathsep.join([library_dir, converted_dir])
+        converted_index = beetutils.PathIndex(converted_dir)
+        beets_index = converted_index.with_root(beetutils.sibling_root(converted_dir, converted_subdir, beets_subdir))
+
+    cache = beetutils.ResultCache(cache_path)
+    drifted = 0
+
+    try:
+        # Compare files whose cached tags are current straight away, and collect the files that need reading
+        pending = []
+
+        for row in beetutils.iter_beets_rows(db, ["path"] + fields + (["original_year"] if original_year else []), since):
+            song = beetutils.decode_beets_path(row[0])
+            expected = {field: normalise_value(field, value) for field, value in zip(fields, row[1:])}
+            paths = [song]
+
+            # Songs without an original year are written with the year of the release
+            if original_year and row[-1]:
+                expected["year"] = normalise_value("year", row[-1])
+
+            if converted_index is not None:
+                relative_key = beets_index.key(beetutils.with_extension(song, extension))
+                if relative_key is not None:
+                    paths.append(converted_index.path(relative_key))
+
+            for path in paths:
+                try:
+                    stamp = beetutils.file_stamp(path)
+                except FileNotFoundError:
+                    # Missing songs are reported by the other audits
+                    continue
+
+                cached, cached_tags = cache.get(path, stamp)
+
+                if cached and all(field in cached_tags for field in fields):
+                    beetutils.METRICS.count("tags_reused")
+                    drifted += _report_drift(output, path, beetutils.album_of(path, album_roots), expected, cached_tags)
+                else:
+                    pending.append((path, stamp, expected, cached_tags))
+
+        results = beetutils.map_in_processes(read_tags, [path for path, stamp, expected, cached_tags in pending], [fields] * len(pending), jobs=jobs)
+
+        for (path, stamp, expected, cached_tags), (tags, failure) in zip(pending, results):
+            if failure is not None:
+                drifted += 1
+                print("Failed to read tags from %s: %s" % (path, failure), file=sys.stderr)
+                continue
+
+            beetutils.METRICS.count("tags_read")
+
+            # Keep any other fields cached for an unchanged file, so runs comparing different fields do not evict each other
+            cache.put(path, stamp, dict(cached_tags, **tags) if cached_tags is not None else tags)
+            drifted += _report_drift(output, path, beetutils.album_of(path, album_roots), expected, tags)
+
+        cache.save()
+    finally:
+        cache.close()
+
+    return 0 if drifted == 0 else 1
+
+def _report_drift(output: str, path: str, album: str, expected: Dict[str, object], tags: Dict[str, object]) -> int:
+    """
+    Reports every field where a file's tags differ from the beets database
+
+    Args:
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+        path: Full path to the file
+        album: Full path to the album the file belongs to
+        expected: Normalised values of each field in the beets database
+        tags: Normalised values of each field in the file
+
+    Returns:
+        The number of fields which differ
+    """
+
+    drifted = 0
+
+    for field, value in expected.items():
+        if tags[field] != value:
+            drifted += 1
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "tag_drift", path, album, "write", "%s: %s is %r in beets but %r in the file" % (path, field, value, tags[field]), field=field, db=value, file=tags[field])
+
+    return drifted
+
+def read_tags(path: str, fields: List[str]) -> Tuple[Dict[str, object], str]:
+    """
+    Reads the tags of a file with mutagen, capturing any failure
+
+    Args:
+        path: Full path to the file
+        fields: Beets fields to read, see FIELD_TAGS
+
+    Returns:
+        A tuple of the normalised value of each field, and the failure message if the file could not be read
+    """
+
+    try:
+        song = mutagen.File(path, easy=True)
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+    if song is None:
+        return None, "unrecognised format"
+
+    tags = song.tags if song.tags is not None else {}
+    values = {}
+
+    for field in fields:
+        # Multiple values are joined, so a file holding more than beets wrote is reported
+        value = tags.get(FIELD_TAGS[field])
+        values[field] = normalise_value(field, "; ".join(value) if value else None)
+
+    return values, None
+
+def normalise_value(field: str, value) -> object:
+    """
+    Normalises a value from either the beets database or a tag, so the two can be compared
+
+    Args:
+        field: Beets field the value belongs to
+        value: Value of the field, which may be None if it is not set
+
+    Returns:
+        The leading number for integer fields, 0 if there is none, otherwise the value as a string, empty if it is not set
+    """
+
+    if field in INT_FIELDS:
+        match = re.match(r"\s*(\d+)", str(value)) if value is not None else None
+        return int(match.group(1)) if match is not None else 0
+
+    return str(value) if value is not None else ""
+
+def string_to_fields(string_value: str) -> List[str]:
+    """
+    Parses a space separated list of beets fields
+
+    Args:
+        string_value: Fields to compare, e.g. "title artist track"
+
+    Returns:
+        An array of the fields
+    """
+
+    fields = string_value.split()
+
+    for field in fields:
+        if field not in FIELD_TAGS:
+            raise ArgumentTypeError("Unsupported field %s, expected one of %s" % (field, ", ".join(FIELD_TAGS)))
+
+    if len(fields) == 0:
+        raise ArgumentTypeError("At least one field is required")
+
+    return fields
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
+    parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--fields", type=string_to_fields, nargs="?", default=DEFAULT_FIELDS, help="Space separated beets fields to compare")
+    parser.add_argument("--config", nargs="?", default="~/.config/beets/config.yaml", help="The beets config, read for original_date if it exists")
+    parser.add_argument("--converted", nargs="?", default=None, help="Location of the converted music files, to also compare their tags")
+    parser.add_argument("--beetsdir", nargs="?", default="FLAC", help="Name of the subdir for the beets library present in the db")
+    parser.add_argument("--converteddir", nargs="?", default="V2", help="Name of the subdir for the converted folder")
+    parser.add_argument("--ext", nargs="?", default="mp3", help="File format of the converted directory")
+    parser.add_argument("--since", type=beetutils.string_to_timestamp, nargs="?", default=None, help="Only check songs modified or added since an age (e.g. 1d), date or UNIX timestamp")
+    parser.add_argument("--cache", nargs="?", default="~/.config/beets/tag_cache.db", help="The database of tags read from files")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of files to read at once, defaults to the number of CPUs")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with beetutils.instrumented(args, "audit_tag_drift"):
+        result = main(args.db, args.dir, args.fields, args.cache, args.jobs, args.since, args.converted, args.beetsdir, args.converteddir, args.ext, args.output, args.config)
+
+    exit(result)
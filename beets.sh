@@ -23,7 +23,24 @@ IMPORT_DIR=${IMPORT_DIR:-~/media/Music/Import}
 LIBRARY_DIR=${LIBRARY_DIR:-~/media/Music/FLAC}
 CONVERTED_DIR=${CONVERTED_DIR:-~/media/Music/V2}
 ARTIFACT_DIR=${ARTIFACT_DIR:-~/media/Music/Misc/Artifacts}
+ARTIFACT_RULES=${ARTIFACT_RULES:-cue:rename log:rename jpg:move dir:delete}
 BEETS_DB=${BEETS_DB:-~/.config/beets/library.db}
+LIBRARY_INDEX=${LIBRARY_INDEX:-~/.config/beets/library_index.db}
+SCAN_JOBS=${SCAN_JOBS:-1}
+BEETS_CONFIG=${BEETS_CONFIG:-~/.config/beets/config.yaml}
+CONVERT_MANIFEST=${CONVERT_MANIFEST:-~/.config/beets/convert_manifest.db}
+CONVERT_JOBS=${CONVERT_JOBS:-$(nproc)}
+VERIFY_CACHE=${VERIFY_CACHE:-~/.config/beets/verify_cache.db}
+TAG_CACHE=${TAG_CACHE:-~/.config/beets/tag_cache.db}
+PIPELINE_REPORT=${PIPELINE_REPORT:-}
+PIPELINE_PROMETHEUS=${PIPELINE_PROMETHEUS:-}
+COVER_MAX_SIZE=${COVER_MAX_SIZE:-}
+COVER_QUALITY=${COVER_QUALITY:-85}
+COVER_CACHE_DIR=${COVER_CACHE_DIR:-~/.cache/beets/covers}
+WATCH_DEBOUNCE=${WATCH_DEBOUNCE:-5}
+WATCH_FIX=${WATCH_FIX:-false}
+SYNC_PATTERNS=${SYNC_PATTERNS:-*.cue *.log}
+SYNC_HARDLINK=${SYNC_HARDLINK:-false}
 BEETS_SUBDIR=${BEETS_SUBDIR:-FLAC}
 LIBRARY_SUBDIR=${LIBRARY_SUBDIR:-FLAC}
 CONVERTED_SUBDIR=${CONVERTED_SUBDIR:-V2}
@@ -124,9 +141,43 @@ deploy_beets() {
 	pip install https://github.com/ocelma/python-itunes/archive/master.zip
 }
 
-import_library() {
-	echo "Importing music from $IMPORT_DIR"
-	$BEETS_BIN import "$IMPORT_DIR"
+run_pipeline() {
+	echo "Running $1 in a single process"
+
+	# Only export metrics if somewhere to write them has been configured
+	METRICS_ARGS=()
+	if [[ -n $PIPELINE_REPORT ]]; then
+		METRICS_ARGS+=("--report=$PIPELINE_REPORT")
+	fi
+	if [[ -n $PIPELINE_PROMETHEUS ]]; then
+		METRICS_ARGS+=("--prometheus=$PIPELINE_PROMETHEUS")
+	fi
+
+	# Only resize covers if a size has been configured
+	COVER_ARGS=()
+	if [[ -n $COVER_MAX_SIZE ]]; then
+		COVER_ARGS+=("--maxsize=$COVER_MAX_SIZE" "--quality=$COVER_QUALITY" "--cachedir=$COVER_CACHE_DIR")
+	fi
+
+	$PYTHON_BIN pipeline.py "$1" \
+		--db="$BEETS_DB" \
+		--dir="$LIBRARY_DIR" \
+		--converted="$CONVERTED_DIR" \
+		--artifactdir="$ARTIFACT_DIR" \
+		--rules="$ARTIFACT_RULES" \
+		--index="$LIBRARY_INDEX" \
+		--scanjobs="$SCAN_JOBS" \
+		--config="$BEETS_CONFIG" \
+		--manifest="$CONVERT_MANIFEST" \
+		--jobs="$CONVERT_JOBS" \
+		--beetsdir="$BEETS_SUBDIR" \
+		--librarydir="$LIBRARY_SUBDIR" \
+		--converteddir="$CONVERTED_SUBDIR" \
+		--ext="$CONVERTED_EXTENSION" \
+		--interactive="$INTERACTIVE" \
+		--bell="$BELL" \
+		"${COVER_ARGS[@]}" \
+		"${METRICS_ARGS[@]}"
 
 	RESULT=$?
 
@@ -137,30 +188,21 @@ import_library() {
 	fi
 }
 
-audit_library() {
-	echo -e "Auditing missing beets music\n"
-	audit_beets_music
-
-	if [ $? == '1' ]; then
-		echo -e "$BELL \nMusic in beets db not in library! Fix and press any key to continue"
-		read < /dev/tty
-	fi
+import_library() {
+	echo "Importing music from $IMPORT_DIR"
+	$BEETS_BIN import "$IMPORT_DIR"
 
-	echo -e "Auditing missing library music\n"
-	audit_library_music
+	RESULT=$?
 
-	if [ $? == '1' ]; then
-		echo -e "$BELL \nMusic in library not in beets db! Fix and press any key to continue"
-		read < /dev/tty
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
 	fi
+}
 
-	echo -e "Auditing missing music covers\n"
-	audit_music_covers
-
-	if [ $? == '1' ]; then
-		echo -e "$BELL \nCovers missing! Fix and press any key to continue"
-		read < /dev/tty
-	fi
+audit_library() {
+	run_pipeline audit_library
 }
 
 audit_beets_music() {
@@ -180,7 +222,7 @@ audit_beets_music() {
 
 audit_library_music() {
 	echo "Checking for music in $LIBRARY_DIR not present in $BEETS_DB"
-	$PYTHON_BIN audit_missing_beets_music.py \
+	$PYTHON_BIN audit_missing_library_music.py \
 		--db="$BEETS_DB" \
 		--dir="$LIBRARY_DIR"
 	
@@ -193,10 +235,28 @@ audit_library_music() {
 	fi
 }
 
+audit_all_music() {
+	echo "Checking for music in $BEETS_DB not present in $LIBRARY_DIR, and in $LIBRARY_DIR not present in $BEETS_DB"
+	$PYTHON_BIN audit_missing_beets_music.py \
+		--db="$BEETS_DB" \
+		--dir="$LIBRARY_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--both
+	
+	RESULT=$?
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
 audit_music_covers() {
 	echo "Checking for missing covers in $LIBRARY_DIR"
 	$PYTHON_BIN audit_missing_artifacts.py \
 		--dir="$LIBRARY_DIR" \
+		--index="$LIBRARY_INDEX" \
 		--artifact="cover.jpg"
 
 	RESULT=$?
@@ -208,32 +268,53 @@ audit_music_covers() {
 	fi
 }
 
-fix_library() {
-	echo "Fixing cue artifacts"
-	fix_cue_artifacts
+audit_tag_drift() {
+	echo "Checking for tags in $LIBRARY_DIR and $CONVERTED_DIR that differ from $BEETS_DB"
+	$PYTHON_BIN audit_tag_drift.py \
+		--db="$BEETS_DB" \
+		--config="$BEETS_CONFIG" \
+		--dir="$LIBRARY_DIR" \
+		--converted="$CONVERTED_DIR" \
+		--beetsdir="$BEETS_SUBDIR" \
+		--converteddir="$CONVERTED_SUBDIR" \
+		--ext="$CONVERTED_EXTENSION" \
+		--cache="$TAG_CACHE" \
+		--jobs="$CONVERT_JOBS"
 
-	echo "Fixing log artifacts"
-	fix_log_artifacts
+	RESULT=$?
 
-	echo "Moving jpg artifacts"
-	fix_jpg_artifacts
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
 
-	echo "Deleting dir artifacts"
-	fix_dir_artifacts
+fix_library() {
+	run_pipeline fix_library
 }
 
 fix_log_artifacts() {	
+	PLAN=
+	PLAN_ARGS=()
+
 	if [[ $INTERACTIVE == 'true' ]]; then
+		PLAN=$(mktemp)
 		echo -e "Listing log artifacts in $LIBRARY_DIR \n"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="log" \
-			--dryrun
+			--dryrun \
+			--plan="$PLAN"
 		RESULT=$?
 
 		if [[ $RESULT == '1' ]]; then
 			echo -e "$BELL \nThe above logs will be fixed, press any key to continue"
 			read < /dev/tty
+
+			# Apply exactly what was listed, rather than searching the library again
+			PLAN_ARGS=("--applyplan=$PLAN")
 		fi
 	fi
 
@@ -241,10 +322,16 @@ fix_log_artifacts() {
 		echo "Fixing log artifacts in $LIBRARY_DIR"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
-			--ext="log"
+			--index="$LIBRARY_INDEX" \
+			--ext="log" \
+			"${PLAN_ARGS[@]}"
 		RESULT=$?
 	fi
 
+	if [[ -n $PLAN ]]; then
+		rm -f "$PLAN"
+	fi
+
 	if [[ $INTERACTIVE == 'false' ]]; then
 		exit $RESULT
 	else
@@ -253,17 +340,26 @@ fix_log_artifacts() {
 }
 
 fix_cue_artifacts() {	
+	PLAN=
+	PLAN_ARGS=()
+
 	if [[ $INTERACTIVE == 'true' ]]; then
+		PLAN=$(mktemp)
 		echo -e "Listing cue artifacts in $LIBRARY_DIR \n"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="cue" \
-			--dryrun
+			--dryrun \
+			--plan="$PLAN"
 		RESULT=$?
 
 		if [[ $RESULT == '1' ]]; then
 			echo -e "$BELL \nThe above cues will be fixed, press any key to continue"
 			read < /dev/tty
+
+			# Apply exactly what was listed, rather than searching the library again
+			PLAN_ARGS=("--applyplan=$PLAN")
 		fi
 	fi
 
@@ -271,10 +367,16 @@ fix_cue_artifacts() {
 		echo "Fixing cue artifacts in $LIBRARY_DIR"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
-			--ext="cue"
+			--index="$LIBRARY_INDEX" \
+			--ext="cue" \
+			"${PLAN_ARGS[@]}"
 		RESULT=$?
 	fi
 
+	if [[ -n $PLAN ]]; then
+		rm -f "$PLAN"
+	fi
+
 	if [[ $INTERACTIVE == 'false' ]]; then
 		exit $RESULT
 	else
@@ -283,17 +385,26 @@ fix_cue_artifacts() {
 }
 
 fix_jpg_artifacts() {	
+	PLAN=
+	PLAN_ARGS=()
+
 	if [[ $INTERACTIVE == 'true' ]]; then
+		PLAN=$(mktemp)
 		echo -e "Listing jpg artifacts in $LIBRARY_DIR \n"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="jpg" \
-			--dryrun
+			--dryrun \
+			--plan="$PLAN"
 		RESULT=$?
 
 		if [[ $RESULT == '1' ]]; then
 			echo -e "$BELL \nThe above jpgs will be moved, press any key to continue"
 			read < /dev/tty
+
+			# Apply exactly what was listed, rather than searching the library again
+			PLAN_ARGS=("--applyplan=$PLAN")
 		fi
 	fi
 
@@ -301,12 +412,18 @@ fix_jpg_artifacts() {
 		echo "Moving jpg artifacts in $LIBRARY_DIR"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="jpg" \
 			--move \
-			--movedir="$ARTIFACT_DIR"
+			--movedir="$ARTIFACT_DIR" \
+			"${PLAN_ARGS[@]}"
 		RESULT=$?
 	fi
 
+	if [[ -n $PLAN ]]; then
+		rm -f "$PLAN"
+	fi
+
 	if [[ $INTERACTIVE == 'false' ]]; then
 		exit $RESULT
 	else
@@ -315,17 +432,26 @@ fix_jpg_artifacts() {
 }
 
 fix_dir_artifacts() {	
+	PLAN=
+	PLAN_ARGS=()
+
 	if [[ $INTERACTIVE == 'true' ]]; then
+		PLAN=$(mktemp)
 		echo -e "Listing dir artifacts in $LIBRARY_DIR \n"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="dir" \
-			--dryrun
+			--dryrun \
+			--plan="$PLAN"
 		RESULT=$?
 
 		if [[ $RESULT == '1' ]]; then
 			echo -e "$BELL \nThe above dirs will be DELETED, press any key to continue"
 			read < /dev/tty
+
+			# Apply exactly what was listed, rather than searching the library again
+			PLAN_ARGS=("--applyplan=$PLAN")
 		fi
 	fi
 
@@ -333,11 +459,59 @@ fix_dir_artifacts() {
 	echo "Deleting dir artifacts in $LIBRARY_DIR"
 		$PYTHON_BIN fix_artifacts.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--ext="dir" \
-			--delete
+			--delete \
+			"${PLAN_ARGS[@]}"
 		RESULT=$?
 	fi
 
+	if [[ -n $PLAN ]]; then
+		rm -f "$PLAN"
+	fi
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
+rebuild_index() {
+	echo "Rebuilding library index for $LIBRARY_DIR and $CONVERTED_DIR"
+	$PYTHON_BIN library_index.py \
+		--dir="$LIBRARY_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--scanjobs="$SCAN_JOBS" \
+		--rebuild \
+	&& $PYTHON_BIN library_index.py \
+		--dir="$CONVERTED_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--scanjobs="$SCAN_JOBS" \
+		--rebuild
+
+	RESULT=$?
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
+check_index() {
+	echo "Checking library index against $LIBRARY_DIR and $CONVERTED_DIR"
+	$PYTHON_BIN library_index.py \
+		--dir="$LIBRARY_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--check \
+	&& $PYTHON_BIN library_index.py \
+		--dir="$CONVERTED_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--check
+
+	RESULT=$?
+
 	if [[ $INTERACTIVE == 'false' ]]; then
 		exit $RESULT
 	else
@@ -347,7 +521,12 @@ fix_dir_artifacts() {
 
 convert_library() {	
 	echo "Converting music in $LIBRARY_DIR"
-	$BEETS_BIN convert -y "added:-1d.." > ./convert.log 2>&1
+	$PYTHON_BIN convert_library.py \
+		--config="$BEETS_CONFIG" \
+		--db="$BEETS_DB" \
+		--manifest="$CONVERT_MANIFEST" \
+		--jobs="$CONVERT_JOBS" \
+		> ./convert.log 2>&1
 
 	RESULT=$?
 
@@ -359,13 +538,7 @@ convert_library() {
 }
 
 audit_converted() {
-	echo -e "Auditing missing converted\n"
-	audit_converted_music
-
-	if [ $? == '1' ]; then
-		echo -e "$BELL \nConverted music missing! Check converted.log, fix and press any key to continue"
-		read < /dev/tty
-	fi
+	run_pipeline audit_converted
 }
 
 audit_converted_music() {	
@@ -373,6 +546,7 @@ audit_converted_music() {
 	$PYTHON_BIN audit_missing_converted_music.py \
 		--db="$BEETS_DB" \
 		--dir="$CONVERTED_DIR" \
+		--index="$LIBRARY_INDEX" \
 		--beetsdir="$BEETS_SUBDIR" \
 		--librarydir="$CONVERTED_SUBDIR" \
 		--ext="$CONVERTED_EXTENSION"
@@ -386,24 +560,62 @@ audit_converted_music() {
 	fi
 }
 
+verify_converted_music() {
+	echo "Verifying music in $CONVERTED_DIR against $LIBRARY_DIR"
+	$PYTHON_BIN audit_missing_converted_music.py \
+		--db="$BEETS_DB" \
+		--dir="$CONVERTED_DIR" \
+		--index="$LIBRARY_INDEX" \
+		--beetsdir="$BEETS_SUBDIR" \
+		--librarydir="$CONVERTED_SUBDIR" \
+		--ext="$CONVERTED_EXTENSION" \
+		--verify \
+		--verifycache="$VERIFY_CACHE" \
+		--jobs="$CONVERT_JOBS"
+
+	RESULT=$?
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
 fix_converted() {
-	echo -e "Fixing missing converted covers\n"
-	fix_converted_covers
+	run_pipeline fix_converted
 }
 
 fix_converted_covers() {	
+	PLAN=
+	PLAN_ARGS=()
+
+	# Only resize covers if a size has been configured
+	COVER_ARGS=()
+	if [[ -n $COVER_MAX_SIZE ]]; then
+		COVER_ARGS+=("--maxsize=$COVER_MAX_SIZE" "--quality=$COVER_QUALITY" "--cachedir=$COVER_CACHE_DIR")
+	fi
+
 	if [[ $INTERACTIVE == 'true' ]]; then
+		PLAN=$(mktemp)
 		echo -e "Listing covers in $CONVERTED_DIR \n"
 		$PYTHON_BIN copy_covers.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--librarydir="$LIBRARY_SUBDIR" \
 			--converteddir="$CONVERTED_SUBDIR" \
-			--dryrun
+			--dryrun \
+			--embed \
+			--plan="$PLAN" \
+			"${COVER_ARGS[@]}"
 		RESULT=$?
 
 		if [[ $RESULT == '1' ]]; then
 			echo -e "$BELL \nThe above covers will be copied and embedded, press any key to continue"
 			read < /dev/tty
+
+			# Apply exactly what was listed, rather than searching the library again
+			PLAN_ARGS=("--applyplan=$PLAN")
 		fi
 	fi
 
@@ -411,9 +623,60 @@ fix_converted_covers() {
 	echo "Copying and embedding covers in $CONVERTED_DIR"
 		$PYTHON_BIN copy_covers.py \
 			--dir="$LIBRARY_DIR" \
+			--index="$LIBRARY_INDEX" \
 			--librarydir="$LIBRARY_SUBDIR" \
 			--converteddir="$CONVERTED_SUBDIR" \
-			--embed
+			--embed \
+			"${COVER_ARGS[@]}" \
+			"${PLAN_ARGS[@]}"
+		RESULT=$?
+	fi
+
+	if [[ -n $PLAN ]]; then
+		rm -f "$PLAN"
+	fi
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
+sync_converted_artifacts() {
+	SYNC_ARGS=(
+		"--dir=$LIBRARY_DIR"
+		"--index=$LIBRARY_INDEX"
+		"--librarydir=$LIBRARY_SUBDIR"
+		"--converteddir=$CONVERTED_SUBDIR"
+		"--patterns=$SYNC_PATTERNS"
+		"--scanjobs=$SCAN_JOBS"
+	)
+
+	# Only hardlink if configured, since a change to either copy then changes both
+	if [[ $SYNC_HARDLINK == 'true' ]]; then
+		SYNC_ARGS+=("--hardlink")
+	fi
+
+	RESULT=1
+
+	if [[ $INTERACTIVE == 'true' ]]; then
+		echo -e "Listing artifacts to sync in $CONVERTED_DIR \n"
+		$PYTHON_BIN sync_artifacts.py \
+			"${SYNC_ARGS[@]}" \
+			--dryrun
+		RESULT=$?
+
+		if [[ $RESULT == '1' ]]; then
+			echo -e "$BELL \nThe above artifacts will be synced, press any key to continue"
+			read < /dev/tty
+		fi
+	fi
+
+	if [[ $RESULT == '1' ]]; then
+		echo "Syncing artifacts in $CONVERTED_DIR"
+		$PYTHON_BIN sync_artifacts.py \
+			"${SYNC_ARGS[@]}"
 		RESULT=$?
 	fi
 
@@ -470,13 +733,45 @@ update_subsonic() {
 	fi
 }
 
+watch() {
+	echo "Watching $IMPORT_DIR, $LIBRARY_DIR and $CONVERTED_DIR for changes"
+
+	METRICS_ARGS=()
+	if [[ -n $PIPELINE_PROMETHEUS ]]; then
+		METRICS_ARGS+=("--prometheus=$PIPELINE_PROMETHEUS")
+	fi
+
+	COVER_ARGS=()
+	if [[ -n $COVER_MAX_SIZE ]]; then
+		COVER_ARGS+=("--maxsize=$COVER_MAX_SIZE" "--quality=$COVER_QUALITY" "--cachedir=$COVER_CACHE_DIR")
+	fi
+
+	$PYTHON_BIN watch.py \
+		--db="$BEETS_DB" \
+		--config="$BEETS_CONFIG" \
+		--manifest="$CONVERT_MANIFEST" \
+		--import="$IMPORT_DIR" \
+		--artifactdir="$ARTIFACT_DIR" \
+		--rules="$ARTIFACT_RULES" \
+		--fix="$WATCH_FIX" \
+		--beet="$BEETS_BIN" \
+		--debounce="$WATCH_DEBOUNCE" \
+		--jobs="$CONVERT_JOBS" \
+		"${COVER_ARGS[@]}" \
+		"${METRICS_ARGS[@]}"
+
+	RESULT=$?
+
+	if [[ $INTERACTIVE == 'false' ]]; then
+		exit $RESULT
+	else
+		return $RESULT
+	fi
+}
+
 full() {
 	import_library
-	audit_library
-	fix_library
-	convert_library
-	audit_converted
-	fix_converted
+	run_pipeline full
 	cleanup_import
 
 	if [[ $USE_SUBSONIC == 'true' ]]; then
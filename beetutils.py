@@ -1,34 +1,67 @@
 #!/usr/bin/env/python3
 # beetutils.py
 # A collection of helper functions for managing a beets library
-import os,fnmatch,sqlite3
+import os,fnmatch,hashlib,sqlite3,threading,time,json,cProfile
+from datetime import datetime
+from stat import S_ISDIR
 from sys import version_info
-from argparse import ArgumentTypeError
-from typing import List
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from urllib.request import pathname2url
 
-def get_library_albums(library_dir: str) -> List[str]:
+def get_library_albums(library_dir: str, index_path: str = None, scan_jobs: int = None) -> List[str]:
     """
     Retrieve all paths to albums in a library
 
     Args:
-        library_dir: Path to the library which contains the artist folders
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
+        index_path: Path to a persistent library index, if provided only directories whose mtime changed are re-listed
+        scan_jobs: Number of directories to list at once, see scan_library
     
     Returns:
         An array of full paths to albums in the library
     """
 
-    library_albums = []
+    return list(iter_library_albums(library_dir, index_path, scan_jobs))
 
-    # Create the paths to all artist subdirectories in the provided directory
-    library_artists = [os.path.join(library_dir, file) for file in os.listdir(os.path.abspath(library_dir))]
-	
-    # Go through each artist in the library
-    for library_artist in library_artists:
-        # Append the full path to each album subdirectory within this artist subdirectory
-        for library_album in os.listdir(library_artist):
-            library_albums.append(os.path.join(library_artist, library_album))
-    
-    return library_albums
+def iter_library_albums(library_dir: str, index_path: str = None, scan_jobs: int = None) -> Iterator[str]:
+    """
+    Stream all paths to albums in a library, as each artist folder is listed
+
+    Args:
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
+        index_path: Path to a persistent library index, if provided only directories whose mtime changed are re-listed
+        scan_jobs: Number of directories to list at once, see scan_library
+
+    Returns:
+        A generator of full paths to albums in the library
+    """
+
+    # Defer to the snapshot when using an index or listing concurrently, both of which need the whole library
+    if index_path is not None or (scan_jobs or 1) > 1:
+        yield from scan_library(library_dir, index_path, scan_jobs).get_library_albums()
+        return
+
+    for root in library_roots(library_dir):
+        # Go through each artist in the library, skipping any stray files like scan_library does
+        for library_artist in _subdirectories(root, _list_directory(root)):
+            # Yield the full path to each album subdirectory within this artist subdirectory
+            yield from _subdirectories(library_artist, _list_directory(library_artist))
+
+def library_roots(library_dir: str) -> List[str]:
+    """
+    Split a library into its roots, for libraries spread over several folders such as one per disk
+
+    Args:
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
+
+    Returns:
+        An array of the expanded path to each root
+    """
+
+    return [os.path.expanduser(root) for root in library_dir.split(os.pathsep) if root]
 
 def get_folder_artifacts(folder: str, artifact_extension: str) -> List[str]:
     """
@@ -42,65 +75,1242 @@ def get_folder_artifacts(folder: str, artifact_extension: str) -> List[str]:
         An array of all artifact file paths that match an extension
     """
 
-    artifacts = []
+    return list(iter_folder_artifacts(folder, artifact_extension))
+
+def iter_folder_artifacts(folder: str, artifact_extension: str) -> Iterator[str]:
+    """
+    Stream all artifacts that match an extension within a folder
+
+    Args:
+        folder: Folder to list artifacts for
+        artifact_extension: Extension to match artifacts for, or "dir" if listing directories
+
+    Returns:
+        A generator of artifact file paths that match an extension
+    """
 
     if artifact_extension == "dir":
         for root, dirs, files in os.walk(folder):
+            METRICS.count("directories_listed")
             for directory in dirs:
-                artifacts.append(os.path.join(root, directory))
+                yield os.path.join(root, directory)
     else:
         for root, dirs, files in os.walk(folder):
+            METRICS.count("directories_listed")
             for artifact in fnmatch.filter(files, "*.%s" % artifact_extension):
-                artifacts.append(os.path.join(root, artifact))
+                yield os.path.join(root, artifact)
+
+def get_album_artifacts(folder: str) -> Dict[str, List[str]]:
+    """
+    Retrieve every artifact within a folder in a single traversal, classified by extension
+
+    Args:
+        folder: Folder to list artifacts for
+
+    Returns:
+        Arrays of artifact file paths keyed by extension, along with the paths of every subdirectory keyed by "dir"
+    """
+
+    artifacts = {}
+    directories = []
+
+    for root, dirs, files in os.walk(folder):
+        METRICS.count("directories_listed")
+        for directory in dirs:
+            directories.append(os.path.join(root, directory))
+        for artifact in files:
+            artifacts.setdefault(os.path.splitext(artifact)[1][1:], []).append(os.path.join(root, artifact))
+
+    artifacts["dir"] = directories
 
     return artifacts
 
-def get_beets_songs(db: str, extension: str = "flac") -> List[str]:
+def connect_beets_db(db: str, timeout: float = 30.0) -> sqlite3.Connection:
+    """
+    Open a read-only connection to a beets database
+
+    Args:
+        db: Path to the SQLite beets database
+        timeout: Seconds to wait on a lock held by a running beets command before giving up
+
+    Returns:
+        A read-only SQLite connection to the beets database
+    """
+
+    # Opening through a URI with mode=ro ensures nothing here can ever take a write lock on the library
+    return sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(db)), uri=True, timeout=timeout)
+
+def iter_beets_rows(db: str, columns: List[str], since: float = None, batch_size: int = 1000, folder: str = None) -> Iterator[tuple]:
+    """
+    Stream rows from the items table of a beets database
+
+    Args:
+        db: Path to the SQLite beets database
+        columns: Names of the item columns to select
+        since: If provided, only select items modified or added at or after this UNIX timestamp
+        batch_size: Number of rows to fetch from SQLite at a time
+        folder: If provided, only select items within this folder, such as a single album
+
+    Returns:
+        A generator of tuples containing the selected columns of each item
+    """
+
+    query = "SELECT %s FROM items" % ", ".join(columns)
+    conditions = []
+    parameters = ()
+
+    if since is not None:
+        conditions.append("(mtime >= ? OR added >= ?)")
+        parameters += (since, since)
+
+    if folder is not None:
+        # Paths are stored as blobs, so everything within the folder sorts between "folder/" and "folder0", "0" following "/"
+        conditions.append("path >= ? AND path < ?")
+        parameters += (os.path.join(folder, "").encode("UTF-8"), (folder.rstrip(os.sep) + "0").encode("UTF-8"))
+
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+
+    conn = connect_beets_db(db)
+
+    try:
+        cursor = conn.execute(query, parameters)
+
+        # Fetch in batches rather than all at once, keeping only one batch in memory
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            METRICS.count("db_rows", len(rows))
+            for row in rows:
+                yield row
+
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        conn.close()
+
+def iter_beets_songs(db: str, extension: str = "flac", since: float = None, folder: str = None) -> Iterator[str]:
+    """
+    Stream all paths to songs in a beets database
+
+    Args:
+        db: Path to the SQLite beets database
+        extension: File extension of paths to return, if comparing converted files
+        since: If provided, only return songs modified or added at or after this UNIX timestamp
+        folder: If provided, only return songs within this folder, such as a single album
+
+    Returns:
+        A generator of full song paths in a beets database
+    """
+
+    for row in iter_beets_rows(db, ["path"], since, folder=folder):
+        yield with_extension(decode_beets_path(row[0]), extension)
+
+def get_beets_songs(db: str, extension: str = "flac", since: float = None) -> List[str]:
     """
     Retrieve all paths to songs in a beets database
 
     Args:
         db: Path to the SQLite beets database
         extension: File extension of paths to return, if comparing converted files
+        since: If provided, only return songs modified or added at or after this UNIX timestamp
     
     Returns:
         An array of all full song paths in a beets database
     """
 
-    try:
-        conn = sqlite3.connect(db)
+    return list(iter_beets_songs(db, extension, since))
 
-        if version_info > (3, 0):
-            beets_songs = [row[0].decode("UTF-8") for row in conn.execute("SELECT path FROM items")]
-        else:
-            beets_songs = [str(row[0]) for row in conn.execute("SELECT path FROM items")]
-        
-        return [os.path.splitext(beets_song)[0] + ".%s" % extension for beets_song in beets_songs]
-    finally:
-        conn.close()
+def with_extension(path: str, extension: str) -> str:
+    """
+    Replace the extension of a path
+
+    Args:
+        path: Path to change the extension of
+        extension: New extension, without the leading period
 
-def get_library_songs(library_dir: str, extension: str = "flac") -> List[str]:
+    Returns:
+        The path with the new extension
+    """
+
+    suffix = ".%s" % extension
+
+    # Only rebuild the path if it does not already have the requested extension
+    if path.endswith(suffix):
+        return path
+
+    return os.path.splitext(path)[0] + suffix
+
+def decode_beets_path(path) -> str:
+    """
+    Decode a path as stored by beets in the database
+
+    Args:
+        path: Path value from the database, beets stores these as blobs
+
+    Returns:
+        The path as a string
+    """
+
+    if version_info > (3, 0):
+        return path.decode("UTF-8") if isinstance(path, bytes) else path
+    else:
+        return str(path)
+
+def load_beets_config(config_path: str) -> dict:
+    """
+    Load a beets configuration file
+
+    Args:
+        config_path: Path to the beets config.yaml
+
+    Returns:
+        The parsed configuration
+    """
+
+    # PyYAML is installed alongside beets, but is only needed by the scripts which read its configuration
+    import yaml
+
+    with open(config_path) as config_file:
+        return yaml.safe_load(config_file) or {}
+
+def get_library_songs(library_dir: str, extension: str = "flac", index_path: str = None, scan_jobs: int = None) -> List[str]:
     """
     Retrieve all paths to songs in a music library
 
     Args:
-        library_dir: Path to the library which contains the artist folders
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
         extension: Extension of song files, defaults to flac
+        index_path: Path to a persistent library index, if provided only directories whose mtime changed are re-listed
+        scan_jobs: Number of directories to list at once, see scan_library
     
     Returns:
         An array of all full song paths in a music library
     """
 
+    return list(iter_library_songs(library_dir, extension, index_path, scan_jobs))
+
+def iter_library_songs(library_dir: str, extension: str = "flac", index_path: str = None, scan_jobs: int = None) -> Iterator[str]:
+    """
+    Stream all paths to songs in a music library, as each directory is listed
+
+    Args:
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
+        extension: Extension of song files, defaults to flac
+        index_path: Path to a persistent library index, if provided only directories whose mtime changed are re-listed
+        scan_jobs: Number of directories to list at once, see scan_library
+
+    Returns:
+        A generator of full song paths in a music library
+    """
+
+    # Defer to the snapshot when using an index or listing concurrently, both of which need the whole library
+    if index_path is not None or (scan_jobs or 1) > 1:
+        yield from scan_library(library_dir, index_path, scan_jobs).get_library_songs(extension)
+        return
+
     pattern = "*.%s" % extension
-    library_songs = []
 
-    # Walk through each the entire directory structure of the library
-    for root, dirs, files in os.walk(library_dir):
-        # Append any .flac files found
-        for filename in fnmatch.filter(files, pattern):
-            library_songs.append(os.path.join(root, filename))
-    
-    return library_songs
+    for library_root in library_roots(library_dir):
+        # Walk through each the entire directory structure of the library
+        for root, dirs, files in os.walk(library_root):
+            METRICS.count("directories_listed")
+            # Yield any .flac files found
+            for filename in fnmatch.filter(files, pattern):
+                yield os.path.join(root, filename)
+
+def iter_missing_files(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Stream the paths which do not exist as files, checking each one directly rather than scanning
+
+    Args:
+        paths: Full paths to check
+
+    Returns:
+        A generator of the paths which are not files
+    """
+
+    for path in paths:
+        METRICS.count("stat_calls")
+        if not os.path.isfile(path):
+            yield path
+
+def iter_reconcile(left: Iterable[str], right: Iterable[str], right_only: bool = True) -> Iterator[Tuple[bool, str]]:
+    """
+    Stream the paths only in either of two collections, yielding those only in left as soon as they are found
+    Paths in both collections are counted as files_reconciled, which is the size of their intersection
+
+    Args:
+        left: Paths on the left side, streamed and never held in memory, such as the songs in the beets database
+        right: Paths on the right side, such as the songs in the library folder
+        right_only: Whether to also yield the paths only in right, once left has been exhausted
+
+    Returns:
+        A generator of (whether the path is on the left, path) tuples, each side in its original order
+    """
+
+    # Only the right side is held, and it doubles as the record of which paths were seen on the left
+    pending = dict.fromkeys(right, False)
+
+    for path in left:
+        if path in pending:
+            # Duplicates on the left are only counted once
+            if not pending[path]:
+                METRICS.count("files_reconciled")
+            pending[path] = True
+        else:
+            yield True, path
+
+    if right_only:
+        for path, matched in pending.items():
+            if not matched:
+                yield False, path
+
+class PathIndex:
+    """
+    Compact keys for paths under a root, or each of several roots such as a library spread over one folder per disk
+    Paths are keyed relative to their root as tuples of the position of the root then their components, with the
+    artist and album folder names interned, so the names shared by every song of an album are only held once
+
+    Attributes:
+        root: Absolute path to the root that every path is relative to, or each of them separated by os.pathsep
+        roots: Absolute path to each root
+    """
+
+    def __init__(self, root: str, components: Dict[str, str] = None):
+        self.roots = [os.path.abspath(library_root) for library_root in library_roots(root)]
+        self.root = os.pathsep.join(self.roots)
+        self._prefixes = [os.path.join(library_root, "") for library_root in self.roots]
+        self._components = components if components is not None else {}
+
+    def with_root(self, root: str) -> "PathIndex":
+        """
+        Create an index for other roots which shares this index's components, such as the
+        converted library beside the library, so that a key from either index is valid in both
+
+        Args:
+            root: Full path to the root of the new index, or one for each root of this index separated by os.pathsep
+
+        Returns:
+            The new index
+        """
+
+        path_index = PathIndex(root, components=self._components)
+
+        # Keys hold the position of their root, so each root must have a counterpart
+        if len(path_index.roots) != len(self.roots):
+            raise ValueError("%s does not have a root for each of %s" % (root, self.root))
+
+        return path_index
+
+    def key(self, path: str) -> Tuple:
+        """
+        Find the compact key of a path relative to its root
+
+        Args:
+            path: Full path under a root, which may be relative, e.g. when listing a library given as ./FLAC
+
+        Returns:
+            A tuple of the position of the root then the components of the path below it, or None if the path is not under any root
+        """
+
+        position = self._find_root(path)
+
+        # Paths from the beets database are already absolute, so only normalise those which do not match as they are
+        if position is None:
+            path = os.path.abspath(path)
+            position = self._find_root(path)
+
+            if position is None:
+                return None
+
+        # File names are almost always unique, so interning them would only add an entry per song
+        names = path[len(self._prefixes[position]):].split(os.sep)
+        components = self._components
+        return tuple([position] + [components.setdefault(name, name) for name in names[:-1]] + names[-1:])
+
+    def _find_root(self, path: str) -> int:
+        """
+        Find the root a path is under, as given
+
+        Args:
+            path: Full path to find the root of
+
+        Returns:
+            The position of the root in roots, or None if the path is not under any root
+        """
+
+        for position, prefix in enumerate(self._prefixes):
+            if path.startswith(prefix):
+                return position
+
+        return None
+
+    def path(self, key: Tuple) -> str:
+        """
+        Rebuild the full path of a key under its root
+
+        Args:
+            key: Key returned by key, from this index or one sharing its root mapping
+
+        Returns:
+            The full path
+        """
+
+        return self._prefixes[key[0]] + os.sep.join(key[1:])
+
+    def map_path(self, path: str, target: "PathIndex") -> str:
+        """
+        Map a full path under this index's root onto the same relative path under another root,
+        e.g. ~/Music/FLAC/Artist/Album onto ~/Music/V2/Artist/Album
+
+        Args:
+            path: Full path under this index's root
+            target: Index of the root to map the path onto
+
+        Returns:
+            The full path under the target root
+        """
+
+        key = self.key(path)
+
+        if key is None:
+            raise ValueError("%s is not within %s" % (path, self.root))
+
+        return target.path(key)
+
+def sibling_root(root: str, subdir: str, sibling_subdir: str) -> str:
+    """
+    Find the root of a library kept beside another, by swapping the folder named subdir for sibling_subdir,
+    e.g. ~/Music/V2 from ~/Music/FLAC, FLAC and V2
+
+    Args:
+        root: Full path to the known library, or several separated by os.pathsep
+        subdir: Name of the folder of the known library within root, normally its last component
+        sibling_subdir: Name of the folder of the sibling library
+
+    Returns:
+        The absolute path to the sibling library, or the sibling of each root separated by os.pathsep
+    """
+
+    roots = library_roots(root)
+
+    # Libraries spread over several disks keep a sibling beside each, e.g. /disk1/V2 beside /disk1/FLAC
+    if len(roots) > 1:
+        return os.pathsep.join(sibling_root(library_root, subdir, sibling_subdir) for library_root in roots)
+
+    components = os.path.abspath(root).split(os.sep)
+
+    if subdir not in components:
+        raise ValueError("%s is not within a folder named %s" % (root, subdir))
+
+    # Swap the last match, so a parent folder which happens to share the name is left alone
+    index = len(components) - 1 - components[::-1].index(subdir)
+    components[index] = sibling_subdir
+
+    return os.sep.join(components)
+
+class LibrarySnapshot:
+    """
+    In-memory representation of a library, built by a single traversal in scan_library
+
+    Attributes:
+        library_dir: Path to the library which contains the artist folders
+        albums: Full paths to albums in the library
+        files: Full paths to every file in the library, keyed by extension
+        album_files: Full paths to every file within each album, keyed by album path and then extension
+        album_dirs: Full paths to every subdirectory within each album, keyed by album path
+        root_seconds: Seconds taken to scan each root of the library, keyed by root
+    """
+
+    def __init__(self, library_dir: str):
+        self.library_dir = library_dir
+        self.albums = []
+        self.files = {}
+        self.album_files = {}
+        self.album_dirs = {}
+        self.root_seconds = {}
+
+    def get_library_albums(self) -> List[str]:
+        """
+        Retrieve all paths to albums in the snapshot, equivalent to get_library_albums
+
+        Returns:
+            An array of full paths to albums in the library
+        """
+
+        return self.albums
+
+    def get_library_songs(self, extension: str = "flac") -> List[str]:
+        """
+        Retrieve all paths to songs in the snapshot, equivalent to get_library_songs
+
+        Args:
+            extension: Extension of song files, defaults to flac
+
+        Returns:
+            An array of all full song paths in the library
+        """
+
+        return self.files.get(extension, [])
+
+    def get_folder_artifacts(self, folder: str, artifact_extension: str) -> List[str]:
+        """
+        Retrieve all artifacts that match an extension within an album, equivalent to get_folder_artifacts
+
+        Args:
+            folder: Album folder to list artifacts for
+            artifact_extension: Extension to match artifacts for, or "dir" if listing directories
+
+        Returns:
+            An array of all artifact file paths that match an extension
+        """
+
+        # Fall back to walking the folder if it is not an album in this snapshot
+        if folder not in self.album_files:
+            return get_folder_artifacts(folder, artifact_extension)
+
+        if artifact_extension == "dir":
+            return self.album_dirs[folder]
+        else:
+            return self.album_files[folder].get(artifact_extension, [])
+
+    def get_album_artifacts(self, folder: str) -> Dict[str, List[str]]:
+        """
+        Retrieve every artifact within an album classified by extension, equivalent to get_album_artifacts
+
+        Args:
+            folder: Album folder to list artifacts for
+
+        Returns:
+            Arrays of artifact file paths keyed by extension, along with the paths of every subdirectory keyed by "dir"
+        """
+
+        # Fall back to walking the folder if it is not an album in this snapshot
+        if folder not in self.album_files:
+            return get_album_artifacts(folder)
+
+        artifacts = dict(self.album_files[folder])
+        artifacts["dir"] = self.album_dirs[folder]
+
+        return artifacts
+
+def scan_library(library_dir: str, index_path: str = None, jobs: int = None) -> LibrarySnapshot:
+    """
+    Build a snapshot of a library, collecting albums, songs, artifacts and directories in one traversal
+
+    Args:
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep, such as one per disk
+        index_path: Path to a persistent library index, if provided only directories whose mtime changed are re-listed
+        jobs: Number of directories to list at once across every root, for network mounts and libraries spread over several disks
+              Directories are listed one at a time if not provided
+
+    Returns:
+        A LibrarySnapshot of the library, the same no matter how many jobs listed it
+    """
+
+    snapshot = LibrarySnapshot(library_dir)
+    roots = library_roots(library_dir)
+    index = None
+    list_directory = _list_directory
+
+    if index_path is not None:
+        # Imported here since library_index itself relies on beetutils
+        from library_index import LibraryIndex
+
+        index = LibraryIndex(index_path)
+        list_directory = index.list_directory
+
+    try:
+        if (jobs or 1) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                _scan_roots_concurrently(snapshot, roots, list_directory, pool)
+        else:
+            for root in roots:
+                start = time.perf_counter()
+                _scan_root(snapshot, root, list_directory)
+                snapshot.root_seconds[root] = time.perf_counter() - start
+
+        for root in roots:
+            METRICS.add_stage("scan_root:%s" % root, snapshot.root_seconds[root])
+
+        # Persist any re-listed directories, and forget any that no longer exist
+        if index is not None:
+            for root in roots:
+                index.save(root)
+    finally:
+        if index is not None:
+            index.close()
+
+    return snapshot
+
+def _scan_root(snapshot: LibrarySnapshot, root: str, list_directory: Callable) -> None:
+    """
+    Scan a single root of a library into a snapshot, listing one directory at a time
+
+    Args:
+        snapshot: Snapshot to record into
+        root: Full path to the root which contains the artist folders
+        list_directory: Function used to list each directory, see _list_directory
+    """
+
+    # Go through each entry at the root of the library, the artist folders
+    for artist in _record_directory(snapshot, root, list_directory(root)):
+        # Go through each entry in the artist folder, the album folders
+        for album in _record_directory(snapshot, artist, list_directory(artist)):
+            # Recursively collect everything within the album
+            _record_album(snapshot, album, _list_album(album, list_directory))
+
+def _scan_roots_concurrently(snapshot: LibrarySnapshot, roots: List[str], list_directory: Callable, pool: ThreadPoolExecutor) -> None:
+    """
+    Scan every root of a library into a snapshot, listing directories across a pool of threads
+    Each level is submitted in full before waiting on the next, so that every root and disk is kept busy at once,
+    then the listings are recorded in the same order as _scan_root would have
+
+    Args:
+        snapshot: Snapshot to record into
+        roots: Full paths to each root which contains artist folders
+        list_directory: Function used to list each directory, see _list_directory
+        pool: Pool of threads to list the directories across
+    """
+
+    start = time.perf_counter()
+    finished = {root: [start] for root in roots}
+
+    def submit(root: str, function: Callable, *args) -> Future:
+        future = pool.submit(function, *args)
+        # A root has been scanned once the last of its listings has finished
+        future.add_done_callback(lambda done: finished[root].append(time.perf_counter()))
+        return future
+
+    root_listings = [(root, submit(root, list_directory, root)) for root in roots]
+
+    artist_listings = []
+    for root, listing in root_listings:
+        entries = listing.result()
+        artist_listings.append((root, entries, [(artist, submit(root, list_directory, artist)) for artist in _subdirectories(root, entries)]))
+
+    album_listings = []
+    for root, root_entries, artists in artist_listings:
+        listed_artists = []
+        for artist, listing in artists:
+            entries = listing.result()
+            listed_artists.append((artist, entries, [(album, submit(root, _list_album, album, list_directory)) for album in _subdirectories(artist, entries)]))
+        album_listings.append((root, root_entries, listed_artists))
+
+    for root, root_entries, artists in album_listings:
+        _record_directory(snapshot, root, root_entries)
+
+        for artist, artist_entries, albums in artists:
+            _record_directory(snapshot, artist, artist_entries)
+
+            for album, listing in albums:
+                _record_album(snapshot, album, listing.result())
+
+        snapshot.root_seconds[root] = max(finished[root]) - start
+
+def _list_directory(directory: str) -> List[Tuple[str, bool, bool]]:
+    """
+    List the entries of a single directory
+
+    Args:
+        directory: Full path to the directory to list
+
+    Returns:
+        An array of (name, is directory, is symlink) tuples for each entry in the directory
+    """
+
+    METRICS.count("directories_listed")
+
+    with os.scandir(directory) as entries:
+        return [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in entries]
+
+def _subdirectories(directory: str, entries: List[Tuple[str, bool, bool]]) -> List[str]:
+    """
+    Find the subdirectories of a listed directory that should be descended into
+
+    Args:
+        directory: Full path to the listed directory
+        entries: Listing of the directory, see _list_directory
+
+    Returns:
+        An array of full paths to the subdirectories
+    """
+
+    # Like get_library_albums, artist and album folders are followed even if symlinked
+    return [os.path.join(directory, name) for name, is_dir, is_symlink in entries if is_dir]
+
+def _record_directory(snapshot: LibrarySnapshot, directory: str, entries: List[Tuple[str, bool, bool]]) -> List[str]:
+    """
+    Record any files in a listed artist or root directory into a snapshot, returning the subdirectories
+
+    Args:
+        snapshot: Snapshot to record files into
+        directory: Full path to the listed directory
+        entries: Listing of the directory, see _list_directory
+
+    Returns:
+        An array of full paths to the subdirectories that should be descended into
+    """
+
+    for name, is_dir, is_symlink in entries:
+        if not is_dir:
+            extension = os.path.splitext(name)[1][1:]
+            snapshot.files.setdefault(extension, []).append(os.path.join(directory, name))
+
+    return _subdirectories(directory, entries)
+
+def _list_album(directory: str, list_directory: Callable, listings: List[Tuple[str, List[Tuple[str, bool, bool]]]] = None) -> List[Tuple[str, List[Tuple[str, bool, bool]]]]:
+    """
+    Recursively list every directory within an album, top-down like os.walk
+
+    Args:
+        directory: Full path to the directory within the album to list
+        list_directory: Function used to list each directory, see _list_directory
+        listings: Listings collected so far, used when recursing
+
+    Returns:
+        An array of (full directory path, listing) tuples, starting with the album itself
+    """
+
+    if listings is None:
+        listings = []
+
+    entries = list_directory(directory)
+    listings.append((directory, entries))
+
+    # Mirror os.walk, symlinked directories are reported but never descended into
+    for name, is_dir, is_symlink in entries:
+        if is_dir and not is_symlink:
+            _list_album(os.path.join(directory, name), list_directory, listings)
+
+    return listings
+
+def _record_album(snapshot: LibrarySnapshot, album: str, listings: List[Tuple[str, List[Tuple[str, bool, bool]]]]) -> None:
+    """
+    Record an album, along with all files and subdirectories within it, into a snapshot
+
+    Args:
+        snapshot: Snapshot to record into
+        album: Full path to the album
+        listings: Listings of every directory within the album, see _list_album
+    """
+
+    snapshot.albums.append(album)
+    album_files = snapshot.album_files[album] = {}
+    album_dirs = snapshot.album_dirs[album] = []
+
+    for directory, entries in listings:
+        for name, is_dir, is_symlink in entries:
+            path = os.path.join(directory, name)
+
+            if is_dir:
+                album_dirs.append(path)
+            else:
+                extension = os.path.splitext(name)[1][1:]
+                snapshot.files.setdefault(extension, []).append(path)
+                album_files.setdefault(extension, []).append(path)
+
+class Metrics:
+    """
+    Counters and stage timings for a run, exported as a JSON report or a Prometheus textfile
+
+    Attributes:
+        counters: Totals of each counter across the run
+        stages: Timings and counters for each stage, in the order they finished
+        profile_stage: Name of the stage to profile, or None to profile the outermost stage
+        profile_path: Path to write cProfile stats to, or None to disable profiling
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.stages = []
+        self.profile_stage = None
+        self.profile_path = None
+        self._active = []
+        # Counters may be added to from the threads of a concurrent scan
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """
+        Add to a counter, for the run and for every active stage
+
+        Args:
+            name: Name of the counter, e.g. directories_listed
+            amount: Amount to add to the counter
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+            for stage in self._active:
+                stage["counters"][name] = stage["counters"].get(name, 0) + amount
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        """
+        Record a stage which was timed separately, such as one of several which ran at the same time, within any active stage
+
+        Args:
+            name: Name of the stage, e.g. scan_root:/mnt/disk1/Music
+            seconds: Wall time of the stage
+        """
+
+        path = "/".join([stage["name"] for stage in self._active] + [name])
+        self.stages.append({"name": name, "stage": path, "seconds": seconds, "counters": {}})
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage of the run, nesting within any stage already active
+
+        Args:
+            name: Name of the stage, e.g. audit_library
+        """
+
+        path = "/".join([stage["name"] for stage in self._active] + [name])
+        stage = {"name": name, "stage": path, "seconds": 0.0, "counters": {}}
+        profiler = None
+
+        # Profile the requested stage, or the outermost one if none was requested
+        if self.profile_path is not None and (name == self.profile_stage or (self.profile_stage is None and len(self._active) == 0)):
+            profiler = cProfile.Profile()
+
+        self._active.append(stage)
+        start = time.perf_counter()
+
+        try:
+            if profiler is not None:
+                profiler.enable()
+
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+
+            stage["seconds"] = time.perf_counter() - start
+            self._active.pop()
+            self.stages.append(stage)
+
+    def merge_stages(self) -> None:
+        """
+        Merge the finished stages which share a path into one, summing their timings and counters
+        Long running processes call this after each unit of work, so stages are kept once per path rather than once per run of them
+        """
+
+        self.stages = _merge_stages(self.stages)
+
+    def report(self) -> dict:
+        """
+        Build a report of the run
+
+        Returns:
+            A dictionary of the counters and stages
+        """
+
+        return {"timestamp": time.time(), "counters": self.counters, "stages": self.stages}
+
+    def write_report(self, report_path: str) -> None:
+        """
+        Write the report of the run as JSON
+
+        Args:
+            report_path: Path to write the report to
+        """
+
+        with open(report_path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    def write_prometheus(self, prometheus_path: str) -> None:
+        """
+        Write the run in the Prometheus text format, for the node exporter textfile collector
+
+        Args:
+            prometheus_path: Path to write the metrics to, ending in .prom
+        """
+
+        lines = [
+            "# HELP beets_pipeline_stage_seconds Wall time of each stage of the last run",
+            "# TYPE beets_pipeline_stage_seconds gauge"
+        ]
+        # A stage that ran several times, such as a step of each batch, can only be written as a single series
+        stages = _merge_stages(self.stages)
+        lines += ['beets_pipeline_stage_seconds{stage="%s"} %f' % (_escape_label(stage["stage"]), stage["seconds"]) for stage in stages]
+
+        for name in sorted(self.counters):
+            lines += [
+                "# HELP beets_pipeline_%s Number of %s in the last run" % (name, name.replace("_", " ")),
+                "# TYPE beets_pipeline_%s gauge" % name,
+                "beets_pipeline_%s %d" % (name, self.counters[name])
+            ]
+            lines += [
+                "# HELP beets_pipeline_stage_%s Number of %s in each stage of the last run" % (name, name.replace("_", " ")),
+                "# TYPE beets_pipeline_stage_%s gauge" % name
+            ]
+            lines += ['beets_pipeline_stage_%s{stage="%s"} %d' % (name, _escape_label(stage["stage"]), stage["counters"][name]) for stage in stages if name in stage["counters"]]
+
+        lines += [
+            "# HELP beets_pipeline_last_run_timestamp_seconds Time the last run finished",
+            "# TYPE beets_pipeline_last_run_timestamp_seconds gauge",
+            "beets_pipeline_last_run_timestamp_seconds %f" % time.time()
+        ]
+
+        # Write then rename, so the collector never reads a partial file
+        temp_path = "%s.%d" % (prometheus_path, os.getpid())
+        with open(temp_path, "w") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, prometheus_path)
+
+def _escape_label(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format, where a stray quote or newline would invalidate the whole file
+
+    Args:
+        value: Label value, such as a stage name which may contain a library root
+
+    Returns:
+        The value with backslashes, double quotes and newlines escaped
+    """
+
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _merge_stages(stages: List[dict]) -> List[dict]:
+    """
+    Merge stages which share a path into one, summing their timings and counters
+
+    Args:
+        stages: Stages to merge, see Metrics.stage
+
+    Returns:
+        An array of a single stage for each path, in the order each path first finished
+    """
+
+    merged = {}
+
+    for stage in stages:
+        if stage["stage"] not in merged:
+            merged[stage["stage"]] = {"name": stage["name"], "stage": stage["stage"], "seconds": 0.0, "counters": {}}
+
+        total = merged[stage["stage"]]
+        total["seconds"] += stage["seconds"]
+        for name, amount in stage["counters"].items():
+            total["counters"][name] = total["counters"].get(name, 0) + amount
+
+    return list(merged.values())
+
+# Metrics for the current run, shared by every helper and script
+METRICS = Metrics()
+
+def add_metrics_arguments(parser: ArgumentParser) -> None:
+    """
+    Add the arguments used by instrumented to a script's parser
+
+    Args:
+        parser: Parser to add the arguments to
+    """
+
+    parser.add_argument("--report", nargs="?", default=None, help="Write a JSON report of stage timings and counters to this file")
+    parser.add_argument("--prometheus", nargs="?", default=None, help="Write stage timings and counters to this Prometheus textfile collector file")
+    parser.add_argument("--profile", nargs="?", default=None, help="Write cProfile stats of the run to this file")
+
+@contextmanager
+def instrumented(args: Namespace, name: str, profile_stage: str = None):
+    """
+    Time a script as a stage, writing any requested report, metrics and profile once it finishes
+
+    Args:
+        args: Parsed arguments, including those added by add_metrics_arguments
+        name: Name of the outermost stage, typically the script name
+        profile_stage: Name of a nested stage to profile instead of the whole script
+    """
+
+    if args.profile is not None:
+        METRICS.profile_path = os.path.expanduser(args.profile)
+        METRICS.profile_stage = profile_stage
+
+    try:
+        with METRICS.stage(name):
+            yield
+    finally:
+        if args.report is not None:
+            METRICS.write_report(os.path.expanduser(args.report))
+        if args.prometheus is not None:
+            METRICS.write_prometheus(os.path.expanduser(args.prometheus))
+
+# Formats that findings can be written in, see add_output_arguments
+OUTPUT_FORMATS = ["text", "ndjson"]
+
+def add_output_arguments(parser: ArgumentParser) -> None:
+    """
+    Add the --output argument used by emit to a script's parser
+
+    Args:
+        parser: Parser to add the argument to
+    """
+
+    parser.add_argument("--output", choices=OUTPUT_FORMATS, nargs="?", default="text", help="Write findings as plain paths (text) or one JSON record per line (ndjson)")
+
+def emit(output: str, kind: str, path: str, album: str = None, action: str = None, text: str = None, **fields) -> None:
+    """
+    Write a single finding as soon as it is found
+
+    Args:
+        output: Output format, one of OUTPUT_FORMATS
+        kind: Kind of finding, e.g. missing_library_song
+        path: Full path the finding is about
+        album: Full path to the album the finding belongs to, if any
+        action: Suggested or performed action, e.g. rename
+        text: Line to write in text output, defaults to the path
+        fields: Any additional fields to include in the record
+    """
+
+    if output == "ndjson":
+        record = {"kind": kind, "path": path, "album": album, "action": action}
+        record.update(fields)
+        print(json.dumps(record))
+    else:
+        print(path if text is None else text)
+
+def plan_entry(kind: str, path: str, album: str, action: str, source: str = None, **fields) -> dict:
+    """
+    Build an entry for a plan file, recording the state of its source as the precondition for applying it
+    Paths are stored absolute, so the plan can be applied from any directory
+
+    Args:
+        kind: Kind of finding, e.g. artifact
+        path: Full path the entry is about
+        album: Full path to the album the entry belongs to
+        action: Action to apply, e.g. rename
+        source: Full path to the file whose size and mtime must be unchanged to apply the entry, defaults to the path
+        fields: Any additional fields needed to apply the entry, e.g. target, with any paths already absolute
+
+    Returns:
+        The plan entry, in the same form as an ndjson record
+    """
+
+    path = os.path.abspath(path)
+    album = os.path.abspath(album)
+    source = path if source is None else os.path.abspath(source)
+    METRICS.count("stat_calls")
+    source_stat = os.stat(source)
+
+    entry = {"kind": kind, "path": path, "album": album, "action": action, "source": source}
+    entry.update(fields)
+
+    # The size and mtime of a directory change as its contents are fixed, so only its existence is checked
+    if S_ISDIR(source_stat.st_mode):
+        entry.update({"size": None, "mtime": None})
+    else:
+        entry.update({"size": source_stat.st_size, "mtime": source_stat.st_mtime_ns})
+
+    return entry
+
+def write_plan(plan_path: str, entries: Iterable[dict]) -> None:
+    """
+    Write a plan file of the actions found by a dry run, one JSON entry per line
+
+    Args:
+        plan_path: Path to write the plan to
+        entries: Entries built by plan_entry, in the order they should be applied
+    """
+
+    # Write then rename, so an interrupted dry run never leaves a partial plan to be applied
+    temp_path = "%s.%d" % (plan_path, os.getpid())
+    with open(temp_path, "w") as plan_file:
+        for entry in entries:
+            plan_file.write(json.dumps(entry) + "\n")
+    os.replace(temp_path, plan_path)
+
+def read_plan(plan_path: str) -> Iterator[dict]:
+    """
+    Stream the entries of a plan file written by write_plan
+
+    Args:
+        plan_path: Path to the plan to read
+
+    Returns:
+        A generator of plan entries, in the order they should be applied
+    """
+
+    with open(plan_path) as plan_file:
+        for line in plan_file:
+            if line.strip():
+                yield json.loads(line)
+
+def is_plan_entry_current(entry: dict) -> bool:
+    """
+    Check that the source of a plan entry is unchanged since the plan was written, with a single stat
+
+    Args:
+        entry: Entry built by plan_entry
+
+    Returns:
+        True if the entry can still be applied, False if it is stale
+    """
+
+    METRICS.count("stat_calls")
+
+    try:
+        source_stat = os.stat(entry["source"])
+    except FileNotFoundError:
+        return False
+
+    if entry["size"] is None:
+        return S_ISDIR(source_stat.st_mode)
+
+    return source_stat.st_size == entry["size"] and source_stat.st_mtime_ns == entry["mtime"]
+
+class ResultCache:
+    """
+    Persistent cache of the results of reading files, keyed on the size and mtime of every file read,
+    so only files which have changed since are read again
+
+    Attributes:
+        cache_path: Path to the SQLite cache database
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+
+        self._conn = sqlite3.connect(cache_path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (path TEXT PRIMARY KEY, stamp TEXT NOT NULL, result TEXT NOT NULL)")
+
+        # Load the whole cache up front, a single query is far cheaper than one per file
+        self._results = {path: (stamp, result) for path, stamp, result in self._conn.execute("SELECT path, stamp, result FROM results")}
+        self._changed = {}
+
+    def get(self, path: str, stamp: Tuple[int, ...]) -> Tuple[bool, object]:
+        """
+        Find the cached result for a path, if none of the files it was read from have changed
+
+        Args:
+            path: Full path the result is about
+            stamp: Current stamp of the files the result is read from, see file_stamp
+
+        Returns:
+            A tuple of True and the cached result if it is current, otherwise False and None
+        """
+
+        entry = self._results.get(path)
+
+        if entry is None or entry[0] != json.dumps(stamp):
+            return False, None
+
+        return True, json.loads(entry[1])
+
+    def put(self, path: str, stamp: Tuple[int, ...], result) -> None:
+        """
+        Cache the result for a path, until save is called
+
+        Args:
+            path: Full path the result is about
+            stamp: Stamp of the files the result was read from, see file_stamp
+            result: Result to cache, anything that can be written as JSON
+        """
+
+        entry = (json.dumps(stamp), json.dumps(result))
+        self._results[path] = entry
+        self._changed[path] = entry
+
+    def save(self) -> None:
+        """
+        Write any results cached since the last save to the database
+        """
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results (path, stamp, result) VALUES (?, ?, ?)",
+                [(path, stamp, result) for path, (stamp, result) in self._changed.items()]
+            )
+
+        self._changed = {}
+
+    def close(self) -> None:
+        """
+        Close the cache database
+        """
+
+        self._conn.close()
+
+def file_stamp(*paths: str) -> Tuple[int, ...]:
+    """
+    Stamp a set of files with their sizes and mtimes, to tell whether a cached result read from them is current
+
+    Args:
+        paths: Full paths to the files
+
+    Returns:
+        A tuple of the size and mtime of each file in turn, raising FileNotFoundError if any do not exist
+    """
+
+    stamp = ()
+
+    for path in paths:
+        METRICS.count("stat_calls")
+        path_stat = os.stat(path)
+        stamp += (path_stat.st_size, path_stat.st_mtime_ns)
+
+    return stamp
+
+def hash_file(path: str) -> str:
+    """
+    Hash the contents of a file
+
+    Args:
+        path: Path to the file to hash
+
+    Returns:
+        The SHA-1 hex digest of the file
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1048576), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def map_in_processes(function: Callable, *iterables: Iterable, jobs: int = None, chunksize: int = 32) -> Iterator:
+    """
+    Call a function for each set of arguments across a pool of worker processes
+
+    Args:
+        function: Function to call, which must be importable by the workers
+        iterables: Arguments to call the function with, one iterable per argument like map
+        jobs: Number of worker processes, defaults to the number of CPUs
+        chunksize: Number of calls sent to a worker at once, since reading a single file takes less time than sending it to a worker
+
+    Returns:
+        A generator of the result of each call, in the same order as the arguments
+    """
+
+    iterables = [list(iterable) for iterable in iterables]
+
+    # Avoid starting a pool at all when everything was cached
+    if len(iterables) == 0 or len(iterables[0]) == 0:
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(function, *iterables, chunksize=chunksize)
+
+def album_of(path: str, library_dir: str) -> str:
+    """
+    Find the album a path belongs to, in the "$artist/$album/..." layout of a library
+
+    Args:
+        path: Full path to a song or artifact
+        library_dir: Path to the library which contains the artist folders, or several separated by os.pathsep
+
+    Returns:
+        The full path to the album folder, or the parent folder if the path is not within an album of the library
+    """
+
+    for root in library_roots(library_dir):
+        parts = os.path.relpath(path, root).split(os.sep)
+
+        if parts[0] != os.pardir and len(parts) >= 3:
+            return os.path.join(root, parts[0], parts[1])
+
+    return os.path.dirname(path)
 
 def string_to_boolean(string_value: str) -> bool:
     """
@@ -122,3 +1332,34 @@ def string_to_boolean(string_value: str) -> bool:
         return False
     else:
         raise ArgumentTypeError('Boolean value expected.')
+
+
+def string_to_timestamp(string_value: str) -> float:
+    """
+    Convert a string argument to a UNIX timestamp
+
+    Args:
+        string_value: Either a relative age such as 90s, 30m, 12h, 1d or 2w, an ISO date such as 2020-01-31, or a UNIX timestamp
+
+    Returns:
+        The UNIX timestamp represented by the string value
+
+    Raises:
+        argparse.ArgumentTypeError: If the string provided is not a recognized age, date or timestamp
+    """
+
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+    try:
+        # Relative age, e.g. 1d is one day before now
+        if string_value[-1:].lower() in units and string_value[:-1].isdigit():
+            return time.time() - int(string_value[:-1]) * units[string_value[-1].lower()]
+
+        # Absolute UNIX timestamp
+        if string_value.replace(".", "", 1).isdigit():
+            return float(string_value)
+
+        # ISO formatted date, in local time
+        return datetime.fromisoformat(string_value).timestamp()
+    except ValueError:
+        raise ArgumentTypeError('Age (e.g. 1d), date (e.g. 2020-01-31) or UNIX timestamp expected.')
\ No newline at end of file
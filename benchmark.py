@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Times the library scanning, database and audit functions against a synthetic library
+# Generates a library in the "$albumartist/$albumartist - $album/..." layout used by config.yaml,
+# seeded with cue, log, jpg and directory artifacts at the chosen rates, along with a converted
+# library and a matching beets database. Results are written as JSON so that runs of different
+# releases can be compared
+# USAGE:
+# --workdir - Directory to generate the synthetic library in, a temporary directory by default
+#             Must be new, empty, or generated into by an earlier run, since the library in it is replaced
+# --artists - Number of artists to generate
+# --albums - Number of albums to generate for each artist
+# --tracks - Number of tracks to generate for each album
+# --coverrate - Fraction of albums with a cover.jpg
+# --cuerate - Fraction of albums with a misnamed cue artifact
+# --lograte - Fraction of albums with a misnamed log artifact
+# --jpgrate - Fraction of albums with a jpg artifact other than cover.jpg
+# --dirrate - Fraction of albums with a stray subdirectory
+# --convertedrate - Fraction of tracks that have been converted
+# --repeat - Number of times to run each benchmark
+# --seed - Random seed, so that libraries can be regenerated identically
+# --label - Label to record with the results, such as a release or commit
+# --output - File to write the JSON results to, printed if not provided
+# EXAMPLE:
+# Benchmark a library of 200 artists with 5 albums of 12 tracks each
+# python3 benchmark.py --artists=200 --albums=5 --tracks=12 --output=results.json
+import argparse,json,os,platform,random,shutil,sqlite3,statistics,sys,tempfile,time,beetutils
+import audit_missing_artifacts,audit_missing_beets_music,audit_missing_converted_music,audit_missing_library_music,fix_artifacts
+from contextlib import redirect_stdout
+from typing import Callable, Dict
+
+# Left in every work dir the library is generated into, so a later run knows it can replace what is there
+MARKER_NAME = ".beets-benchmark"
+
+def main(args: argparse.Namespace) -> int:
+    work_dir = tempfile.mkdtemp(prefix="beets-benchmark-") if args.workdir is None else os.path.expanduser(args.workdir)
+    library_dir = os.path.join(work_dir, "FLAC")
+    converted_dir = os.path.join(work_dir, "V2")
+    db = os.path.join(work_dir, "library.db")
+
+    # The generated library replaces anything in the work dir, which must never be a real library
+    if not is_generated_dir(work_dir):
+        print("%s is not empty and was not generated by benchmark.py, refusing to replace its contents" % work_dir, file=sys.stderr)
+        return 1
+
+    os.makedirs(work_dir, exist_ok=True)
+    _touch(os.path.join(work_dir, MARKER_NAME))
+
+    try:
+        # Generate the synthetic library, timing it as a point of reference for the filesystem
+        start = time.perf_counter()
+        counts = generate_library(args, library_dir, converted_dir, db)
+        generate_time = time.perf_counter() - start
+
+        benchmarks = {
+            "scan_library": lambda: beetutils.scan_library(library_dir),
+            "get_library_albums": lambda: beetutils.get_library_albums(library_dir),
+            "get_library_songs": lambda: beetutils.get_library_songs(library_dir),
+            "get_beets_songs": lambda: beetutils.get_beets_songs(db),
+            "audit_missing_beets_music": lambda: audit_missing_beets_music.main(db, library_dir),
+            "audit_missing_library_music": lambda: audit_missing_library_music.main(db, library_dir),
+            "audit_missing_converted_music": lambda: audit_missing_converted_music.main(db, converted_dir, "FLAC", "V2", "mp3"),
+            "audit_missing_artifacts": lambda: audit_missing_artifacts.main(library_dir, "cover.jpg"),
+            "fix_artifacts": lambda: fix_artifacts.main(library_dir, [("cue", "rename")], True, None),
+            "fix_artifacts_all_rules": lambda: fix_artifacts.main(library_dir, fix_artifacts.string_to_rules(fix_artifacts.DEFAULT_RULES), True, work_dir)
+        }
+
+        # copy_covers requires mutagen, so only benchmark it if it can be imported
+        try:
+            import copy_covers
+            benchmarks["copy_covers"] = lambda: copy_covers.main(library_dir, "FLAC", "V2", True, False)
+        except ImportError as e:
+            print("Skipping copy_covers: %s" % e, file=sys.stderr)
+
+        results = {name: run_benchmark(benchmark, args.repeat) for name, benchmark in benchmarks.items()}
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(work_dir)
+
+    report = {
+        "label": args.label,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "artists": args.artists,
+            "albums": args.albums,
+            "tracks": args.tracks,
+            "cover_rate": args.coverrate,
+            "cue_rate": args.cuerate,
+            "log_rate": args.lograte,
+            "jpg_rate": args.jpgrate,
+            "dir_rate": args.dirrate,
+            "converted_rate": args.convertedrate,
+            "repeat": args.repeat,
+            "seed": args.seed
+        },
+        "library": counts,
+        "generate_seconds": generate_time,
+        "results": results
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(os.path.expanduser(args.output), "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    return 0
+
+def is_generated_dir(work_dir: str) -> bool:
+    """
+    Checks whether a library can be generated into a directory, replacing what is there
+
+    Args:
+        work_dir: Path to the directory to generate the library in
+
+    Returns:
+        True if the directory does not exist, is empty, or holds a library generated by an earlier run
+    """
+
+    if not os.path.lexists(work_dir):
+        return True
+
+    if not os.path.isdir(work_dir):
+        return False
+
+    return len(os.listdir(work_dir)) == 0 or os.path.isfile(os.path.join(work_dir, MARKER_NAME))
+
+def generate_library(args: argparse.Namespace, library_dir: str, converted_dir: str, db: str) -> Dict[str, int]:
+    """
+    Generate a synthetic library, converted library and beets database
+    Anything left at these paths by an earlier run is removed first, so the same seed always generates the same library,
+    callers must check the paths are within a work dir accepted by is_generated_dir
+
+    Args:
+        args: Parsed command line arguments, containing the sizes and rates
+        library_dir: Path to generate the library in
+        converted_dir: Path to generate the converted library in
+        db: Path to create the beets database at
+
+    Returns:
+        The number of each kind of file and directory generated
+    """
+
+    generator = random.Random(args.seed)
+    counts = {"albums": 0, "tracks": 0, "converted": 0, "covers": 0, "cue": 0, "log": 0, "jpg": 0, "dir": 0}
+    now = time.time()
+
+    # Start from nothing when reusing a work dir, rather than adding to the last library
+    for generated_dir in [library_dir, converted_dir]:
+        if os.path.isdir(generated_dir):
+            shutil.rmtree(generated_dir)
+    if os.path.isfile(db):
+        os.remove(db)
+
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "CREATE TABLE items (id INTEGER PRIMARY KEY, path BLOB, album_id INTEGER, title TEXT, artist TEXT, albumartist TEXT, album TEXT, "
+        "track INTEGER, disc INTEGER, year INTEGER, genre TEXT, mtime REAL, added REAL)"
+    )
+
+    try:
+        for artist_number in range(args.artists):
+            artist = "Artist %05d" % artist_number
+
+            for album_number in range(args.albums):
+                album = "Album %03d" % album_number
+                album_name = "%s - %s" % (artist, album)
+                album_path = os.path.join(library_dir, artist, album_name)
+                converted_album_path = os.path.join(converted_dir, artist, album_name)
+                counts["albums"] += 1
+
+                os.makedirs(album_path)
+                os.makedirs(converted_album_path)
+
+                for track in range(1, args.tracks + 1):
+                    title = "Track %02d" % track
+                    song_name = "%02d - %s - %s" % (track, album_name, title)
+                    song_path = os.path.join(album_path, song_name + ".flac")
+                    added = now - generator.uniform(0, 365 * 86400)
+
+                    _touch(song_path)
+                    conn.execute(
+                        "INSERT INTO items (path, album_id, title, artist, albumartist, album, track, disc, year, genre, mtime, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (song_path.encode("UTF-8"), counts["albums"], title, artist, artist, album, track, 1, 2000 + album_number % 20, "Rock", added, added)
+                    )
+                    counts["tracks"] += 1
+
+                    if generator.random() < args.convertedrate:
+                        _touch(os.path.join(converted_album_path, song_name + ".mp3"))
+                        counts["converted"] += 1
+
+                # Seed the album with artifacts at the requested rates
+                if generator.random() < args.coverrate:
+                    _touch(os.path.join(album_path, "cover.jpg"))
+                    counts["covers"] += 1
+                if generator.random() < args.cuerate:
+                    _touch(os.path.join(album_path, "rip.cue"))
+                    counts["cue"] += 1
+                if generator.random() < args.lograte:
+                    _touch(os.path.join(album_path, "rip.log"))
+                    counts["log"] += 1
+                if generator.random() < args.jpgrate:
+                    _touch(os.path.join(album_path, "back.jpg"))
+                    counts["jpg"] += 1
+                if generator.random() < args.dirrate:
+                    os.makedirs(os.path.join(album_path, "Scans"))
+                    _touch(os.path.join(album_path, "Scans", "booklet.jpg"))
+                    counts["dir"] += 1
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    return counts
+
+def run_benchmark(benchmark: Callable, repeat: int) -> Dict[str, float]:
+    """
+    Time a benchmark, discarding anything it prints
+
+    Args:
+        benchmark: Function to time
+        repeat: Number of times to run the function
+
+    Returns:
+        The minimum, median and mean run time in seconds, along with every run
+    """
+
+    runs = []
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            benchmark()
+            runs.append(time.perf_counter() - start)
+
+    return {"min": min(runs), "median": statistics.median(runs), "mean": statistics.mean(runs), "runs": runs}
+
+def _touch(path: str) -> None:
+    """
+    Create an empty file
+
+    Args:
+        path: Path to the file to create
+    """
+
+    open(path, "w").close()
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", nargs="?", default=None, help="Directory to generate the library in, a temporary directory by default")
+    parser.add_argument("--artists", type=int, nargs="?", default=100, help="Number of artists to generate")
+    parser.add_argument("--albums", type=int, nargs="?", default=5, help="Number of albums to generate for each artist")
+    parser.add_argument("--tracks", type=int, nargs="?", default=12, help="Number of tracks to generate for each album")
+    parser.add_argument("--coverrate", type=float, nargs="?", default=0.95, help="Fraction of albums with a cover.jpg")
+    parser.add_argument("--cuerate", type=float, nargs="?", default=0.1, help="Fraction of albums with a misnamed cue artifact")
+    parser.add_argument("--lograte", type=float, nargs="?", default=0.1, help="Fraction of albums with a misnamed log artifact")
+    parser.add_argument("--jpgrate", type=float, nargs="?", default=0.05, help="Fraction of albums with a jpg artifact other than cover.jpg")
+    parser.add_argument("--dirrate", type=float, nargs="?", default=0.05, help="Fraction of albums with a stray subdirectory")
+    parser.add_argument("--convertedrate", type=float, nargs="?", default=0.99, help="Fraction of tracks that have been converted")
+    parser.add_argument("--repeat", type=int, nargs="?", default=3, help="Number of times to run each benchmark")
+    parser.add_argument("--seed", type=int, nargs="?", default=0, help="Random seed for generating the library")
+    parser.add_argument("--label", nargs="?", default=None, help="Label to record with the results")
+    parser.add_argument("--output", nargs="?", default=None, help="File to write the JSON results to")
+    args = parser.parse_args()
+
+    exit(main(args))
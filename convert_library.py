@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# convert_library.py
+# Converts every song in the beets database whose converted copy is missing or out of date
+# A manifest records the size, mtime and optionally the hash of each source at the time it
+# was converted, so only new or changed songs are converted regardless of when they were added
+# Songs are converted with the convert.command from the beets config across a pool of jobs,
+# writing to a temporary file that is only renamed into place once the conversion succeeds
+# Like beet convert, the tags of each song in the beets database are then written to its converted copy
+# Requires mediafile, which is installed alongside beets
+# USAGE:
+# --config - Path to the beets config.yaml
+# --db - Path to the beets datbase file
+# --manifest - Path to the conversion manifest database
+# --jobs - Number of songs to convert at once, defaults to the number of CPUs
+# --retries - Number of times to retry a failed conversion before giving up
+# --hash - Also hash the source songs, so a changed mtime alone does not cause a conversion
+# --dryrun - List the songs that need converting without converting them
+# --output - Write songs as plain lines (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
+# EXAMPLE:
+# Convert all new or changed songs in ~/library.db using ~/config.yaml
+# python3 convert_library.py --config=~/config.yaml --db=~/library.db
+# List the songs that would be converted
+# python3 convert_library.py --config=~/config.yaml --db=~/library.db --dryrun
+import argparse,os,shlex,shutil,sqlite3,subprocess,sys,time,beetutils
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from string import Template
+from typing import List, Tuple
+
+# Formats beets considers lossless, anything else is copied as is when never_convert_lossy_files is set
+LOSSLESS_EXTENSIONS = ["flac", "alac", "ape", "wav", "aiff", "aif", "wv"]
+
+def main(config_path: str, db: str, manifest_path: str, jobs: int, retries: int, hash_sources: bool, dry_run: bool, output: str = "text") -> int:
+    # Expansion
+    config_path = os.path.expanduser(config_path)
+    db = os.path.expanduser(db)
+    manifest_path = os.path.expanduser(manifest_path)
+
+    # Read the conversion settings from the beets config
+    library_dir, converted_dir, command, extension, never_convert_lossy, id3v23 = load_convert_settings(config_path)
+
+    manifest = open_manifest(manifest_path)
+
+    try:
+        # Work out which songs in the database need converting
+        conversions = []
+        for (path,) in beetutils.iter_beets_rows(db, ["path"]):
+            source = beetutils.decode_beets_path(path)
+            conversion = plan_conversion(manifest, source, library_dir, converted_dir, extension, never_convert_lossy, hash_sources)
+
+            if conversion is not None:
+                conversions.append(conversion)
+
+        # Keep any songs adopted into the manifest while planning
+        manifest.commit()
+
+        if dry_run:
+            for source, dest, encode, size, mtime, digest in conversions:
+                beetutils.emit(output, "unconverted_song", source, beetutils.album_of(source, library_dir), "convert" if encode else "copy", dest=dest)
+
+            return 0 if len(conversions) == 0 else 1
+
+        convert_result = run_conversions(manifest, conversions, command, jobs, retries, library_dir, converted_dir, output, db, id3v23)
+
+        return 0 if convert_result else 1
+    finally:
+        manifest.close()
+
+def load_convert_settings(config_path: str) -> Tuple[str, str, str, str, bool, bool]:
+    """
+    Read the conversion settings from a beets config
+
+    Args:
+        config_path: Path to the beets config.yaml
+
+    Returns:
+        A tuple of the library directory, converted directory, conversion command, converted extension, whether to copy lossy songs as is
+        and whether to write ID3v2.3 tags rather than ID3v2.4
+    """
+
+    config = beetutils.load_beets_config(config_path)
+    convert_config = config.get("convert", {})
+
+    return (
+        os.path.expanduser(config.get("directory", "~/Music")),
+        os.path.expanduser(convert_config["dest"]),
+        convert_config.get("command", "ffmpeg -i $source -y -vn -aq 2 $dest"),
+        convert_config.get("extension", "mp3"),
+        convert_config.get("never_convert_lossy_files", False),
+        config.get("id3v23", False)
+    )
+
+def run_conversions(manifest: sqlite3.Connection, conversions: List[Tuple[str, str, bool, int, int, str]], command: str, jobs: int, retries: int, library_dir: str, converted_dir: str, output: str = "text", db: str = None, id3v23: bool = False) -> bool:
+    """
+    Convert a set of songs across a pool, recording each result in the manifest as it completes
+
+    Args:
+        manifest: Connection to the conversion manifest
+        conversions: Songs to convert, as returned by plan_conversion
+        command: Conversion command from the beets config, with $source and $dest placeholders
+        jobs: Number of songs to convert at once
+        retries: Number of times to retry a failed conversion
+        library_dir: Path to the library the songs are in
+        converted_dir: Path to the converted library
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+        db: Path to the SQLite beets database to write the tags of each song from, if provided
+        id3v23: Write ID3v2.3 tags rather than ID3v2.4
+
+    Returns:
+        True if every song was converted, False if any failed
+    """
+
+    convert_result = True
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(convert_song, command, source, dest, encode, retries, db, id3v23): (source, dest, encode, size, mtime, digest) for source, dest, encode, size, mtime, digest in conversions}
+
+        for future in as_completed(futures):
+            source, dest, encode, size, mtime, digest = futures[future]
+            attempts, error = future.result()
+
+            if error is None:
+                beetutils.METRICS.count("songs_converted")
+                beetutils.METRICS.count("bytes_read", size)
+                beetutils.emit(output, "converted_song", dest, beetutils.album_of(dest, converted_dir), "convert" if encode else "copy", text="converted: %s -> %s" % (source, dest), source=source)
+            else:
+                convert_result = False
+                beetutils.METRICS.count("songs_failed")
+                if output == "ndjson":
+                    beetutils.emit(output, "failed_conversion", source, beetutils.album_of(source, library_dir), "retry", dest=dest, attempts=attempts, error=error)
+                else:
+                    print("failed: %s after %d attempts: %s" % (source, attempts, error), file=sys.stderr)
+
+            # Commit each result, so an interrupted run keeps everything converted so far
+            record_conversion(manifest, source, dest, size, mtime, digest, attempts, error)
+            manifest.commit()
+
+    return convert_result
+
+def open_manifest(manifest_path: str) -> sqlite3.Connection:
+    """
+    Open the conversion manifest, creating it if it does not exist
+
+    Args:
+        manifest_path: Path to the conversion manifest database
+
+    Returns:
+        A SQLite connection to the manifest
+    """
+
+    manifest = sqlite3.connect(manifest_path)
+    manifest.execute(
+        "CREATE TABLE IF NOT EXISTS conversions ("
+        "source TEXT PRIMARY KEY, dest TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, hash TEXT, "
+        "status TEXT NOT NULL, attempts INTEGER NOT NULL, error TEXT, converted REAL NOT NULL)"
+    )
+
+    return manifest
+
+def plan_conversion(manifest: sqlite3.Connection, source: str, library_dir: str, converted_dir: str, extension: str, never_convert_lossy: bool, hash_sources: bool) -> Tuple[str, str, bool, int, int, str]:
+    """
+    Decide whether a song needs converting by comparing it with the manifest
+
+    Args:
+        manifest: Connection to the conversion manifest
+        source: Full path to the song in the library
+        library_dir: Path to the library the song is in
+        converted_dir: Path to the converted library
+        extension: Extension of converted songs
+        never_convert_lossy: Copy lossy songs rather than converting them
+        hash_sources: Compare source hashes when the size matches but the mtime does not
+
+    Returns:
+        A tuple of (source, dest, whether to encode rather than copy, size, mtime, hash) if the song needs converting, otherwise None
+    """
+
+    source_base, source_extension = os.path.splitext(source)
+    source_extension = source_extension[1:].lower()
+
+    # Like beets, songs already in the target format and lossy songs (if configured) are copied instead of converted
+    encode = source_extension != extension and not (never_convert_lossy and source_extension not in LOSSLESS_EXTENSIONS)
+    relative_base = os.path.relpath(source_base, library_dir)
+
+    # Songs outside of the library have no place in the converted library, and would be written outside of it
+    if relative_base.split(os.sep)[0] == os.pardir:
+        print("Skipping %s, it is not within %s" % (source, library_dir), file=sys.stderr)
+        return None
+
+    dest = os.path.join(converted_dir, relative_base) + ".%s" % (extension if encode else source_extension)
+
+    try:
+        beetutils.METRICS.count("stat_calls")
+        source_stat = os.stat(source)
+    except FileNotFoundError:
+        # Missing library songs are reported by audit_missing_beets_music, there is nothing to convert
+        return None
+
+    row = manifest.execute("SELECT dest, size, mtime, hash, status FROM conversions WHERE source = ?", (source,)).fetchone()
+    digest = None
+
+    # Adopt songs converted before the manifest existed, as long as they are newer than their source
+    if row is None and os.path.isfile(dest) and os.stat(dest).st_mtime_ns >= source_stat.st_mtime_ns:
+        record_conversion(manifest, source, dest, source_stat.st_size, source_stat.st_mtime_ns, beetutils.hash_file(source) if hash_sources else None, 0, None)
+        return None
+
+    if row is not None and row[0] == dest and row[4] == "ok" and os.path.isfile(dest):
+        # Unchanged since the last successful conversion
+        if row[1] == source_stat.st_size and row[2] == source_stat.st_mtime_ns:
+            return None
+
+        # Only the mtime moved, such as from a touch or a copy, so compare the contents
+        if hash_sources and row[3] is not None and row[1] == source_stat.st_size:
+            digest = beetutils.hash_file(source)
+            if digest == row[3]:
+                record_conversion(manifest, source, dest, source_stat.st_size, source_stat.st_mtime_ns, digest, 0, None)
+                return None
+
+    if hash_sources and digest is None:
+        digest = beetutils.hash_file(source)
+
+    return source, dest, encode, source_stat.st_size, source_stat.st_mtime_ns, digest
+
+def convert_song(command: str, source: str, dest: str, encode: bool, retries: int, db: str = None, id3v23: bool = False) -> Tuple[int, str]:
+    """
+    Convert a single song, retrying on failure, and atomically move it into place
+
+    Args:
+        command: Conversion command from the beets config, with $source and $dest placeholders
+        source: Full path to the song in the library
+        dest: Full path to the converted song
+        encode: Whether to run the conversion command, or just copy the song
+        retries: Number of times to retry a failed conversion
+        db: Path to the SQLite beets database to write the tags of the song from, if provided
+        id3v23: Write ID3v2.3 tags rather than ID3v2.4
+
+    Returns:
+        A tuple of the number of attempts made, and the error of the last attempt if every attempt failed
+    """
+
+    dest_dir, dest_name = os.path.split(dest)
+    # Keep the real extension last, since ffmpeg picks the output format from it
+    temp_dest = os.path.join(dest_dir, ".%s.part%s" % os.path.splitext(dest_name))
+    error = None
+
+    os.makedirs(dest_dir, exist_ok=True)
+
+    for attempt in range(1, retries + 2):
+        try:
+            if encode:
+                # Substitute each argument separately, so paths never need quoting
+                arguments = [Template(argument).safe_substitute(source=source, dest=temp_dest) for argument in shlex.split(command)]
+                process = subprocess.run(arguments, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+                if process.returncode != 0:
+                    # The last line of output is typically the reason ffmpeg gave up
+                    output = process.stdout.decode("UTF-8", "replace").strip().splitlines()
+                    raise RuntimeError("exited with %d: %s" % (process.returncode, output[-1] if output else ""))
+            else:
+                shutil.copyfile(source, temp_dest)
+
+            # The converted song only carries the tags copied from the file, which may be behind edits made in beets
+            if db is not None:
+                write_song_tags(db, source, temp_dest, id3v23)
+
+            # Only replace the converted song once it is complete
+            os.replace(temp_dest, dest)
+
+            return attempt, None
+        except (OSError, RuntimeError) as e:
+            error = str(e)
+
+            if os.path.exists(temp_dest):
+                os.remove(temp_dest)
+
+    return retries + 1, error
+
+def write_song_tags(db: str, source: str, dest: str, id3v23: bool = False) -> None:
+    """
+    Write the tags of a song in the beets database to its converted copy, as beet convert does
+
+    Args:
+        db: Path to the SQLite beets database
+        source: Full path to the song in the library, as stored in the database
+        dest: Full path to the converted copy
+        id3v23: Write ID3v2.3 tags rather than ID3v2.4
+    """
+
+    # mediafile is only needed once a song has been converted, so planning and dry runs work without it
+    from mediafile import MediaFile
+
+    conn = beetutils.connect_beets_db(db)
+
+    try:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM items WHERE path = ?", (source.encode("UTF-8"),)).fetchone()
+    finally:
+        conn.close()
+
+    # Removed from the database since it was planned, so there are no tags to write
+    if row is None:
+        return
+
+    try:
+        # Only the columns which are also tags are written, the same as beets
+        media_file = MediaFile(dest, id3v23=id3v23)
+        media_file.update(dict(row))
+        media_file.save()
+    except Exception as e:
+        raise RuntimeError("could not write tags: %s: %s" % (type(e).__name__, e))
+
+def record_conversion(manifest: sqlite3.Connection, source: str, dest: str, size: int, mtime: int, digest: str, attempts: int, error: str) -> None:
+    """
+    Record the result of converting a song in the manifest, without committing it
+
+    Args:
+        manifest: Connection to the conversion manifest
+        source: Full path to the song in the library
+        dest: Full path to the converted song
+        size: Size of the source when it was converted
+        mtime: mtime of the source when it was converted, in nanoseconds
+        digest: Hash of the source, if hashing
+        attempts: Number of attempts made
+        error: Error of the last attempt, or None if the conversion succeeded
+    """
+
+    manifest.execute(
+        "INSERT OR REPLACE INTO conversions (source, dest, size, mtime, hash, status, attempts, error, converted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (source, dest, size, mtime, digest, "ok" if error is None else "failed", attempts, error, time.time())
+    )
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", nargs="?", default="~/.config/beets/config.yaml", help="The beets config")
+    parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
+    parser.add_argument("--manifest", nargs="?", default="~/.config/beets/convert_manifest.db", help="The conversion manifest database")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of songs to convert at once, defaults to the number of CPUs")
+    parser.add_argument("--retries", type=int, nargs="?", default=2, help="Number of times to retry a failed conversion")
+    parser.add_argument("--hash", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Hash source songs, so a changed mtime alone does not cause a conversion")
+    parser.add_argument("--dryrun", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Dry run, only list the songs that need converting")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with beetutils.instrumented(args, "convert_library"):
+        result = main(args.config, args.db, args.manifest, args.jobs or os.cpu_count(), args.retries, args.hash, args.dryrun, args.output)
+
+    exit(result)
@@ -1,74 +1,549 @@
 #!/usr/bin/env python3
 # copy_covers.py
 # Lists all albums in a music library as well as a converted library
-# then, if cover.jpg is not present, copies it from the music library
+# then, if cover.jpg is not present or is older than the cover in the music library, copies it from the music library
 # Optionally, it will also embed the art in the mp3s at time of copy
-# Requires mutagen
+# Covers are copied with sync_artifacts.py, so they are reflinked or copied in the kernel where possible
+# Covers can be shrunk on the way, through a cache of processed covers addressed by the hash of
+# each library cover, so a cover shared between albums or runs is only processed once
+# The cache also records the size and quality each cover was shrunk with, so changing either copies the covers again
+# Requires mutagen, and ImageMagick to shrink covers
 # USAGE:
 # --dir - Directory to search, in beets format
 # --librarydir - Name of the subdir for the library folder
 # --converteddir - Name of the subdir for the converted folder
-# --dryrun - List the folders without missing covers only
+# --dryrun - List the missing and changed covers only
 # --embed - Embed covers into the mp3 files at time of copy
+# --plan - With --dryrun, write the missing and changed covers along with the size and mtime of their sources to a plan file
+#          Use with --embed so that applying the plan also embeds the covers
+# --applyplan - Apply a plan file written by --plan, skipping any covers which have changed since, instead of searching the library
+# --maxsize - Optional largest width and height in pixels of the copied covers, larger covers are resized and recompressed
+# --quality - JPEG quality of resized covers, from 1 to 100
+# --cachedir - Directory to keep resized covers in
+# --jobs - Number of covers to resize and albums to embed covers into at once, defaults to the number of CPUs
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Copy all missing covers from ~/Music/FLAC into ~/Music/V2
 # python3 copy_covers.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2
 # Copy all missing covers from ~/Music/FLAC into ~/Music/V2 and embed
 # python3 copy_covers.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --embed
+# Copy all missing covers from ~/Music/FLAC into ~/Music/V2, shrinking them to at most 500x500 and embed
+# python3 copy_covers.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --embed --maxsize=500
 # List all missing covers from ~/Music/V2 without copying them
 # python3 copy_covers.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --dryrun
-import argparse,os,beetutils,fnmatch
+# List all missing covers, then copy and embed exactly those once they have been reviewed
+# python3 copy_covers.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --dryrun --embed --plan=covers.plan
+# python3 copy_covers.py --applyplan=covers.plan
+import argparse,os,beetutils,fnmatch,functools,hashlib,subprocess,sync_artifacts,sys,tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from shutil import copyfile
+from typing import Dict, Iterable, List, Tuple
 from mutagen.mp3 import MP3
 from mutagen.id3 import ID3, APIC, error
 
-def main(library_dir: str, library_subdir: str, converted_subdir: str, dry_run: bool, embed: bool) -> int:
+# ImageMagick binary used to resize covers, the same one beets uses for fetchart and embedart
+IMAGEMAGICK_BIN = "convert"
+DEFAULT_QUALITY = 85
+DEFAULT_CACHE_DIR = "~/.cache/beets/covers"
+# Record of the size and quality each converted cover was resized with, kept in the cache dir
+COPIED_COVERS_NAME = "copied.db"
+
+def main(library_dir: str, library_subdir: str, converted_subdir: str, dry_run: bool, embed: bool, jobs: int = None, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, output: str = "text", plan_path: str = None, max_size: int = None, quality: int = DEFAULT_QUALITY, cache_dir: str = DEFAULT_CACHE_DIR, scan_jobs: int = None) -> int:
     # Expansion
     library_dir = os.path.expanduser(library_dir)
+    cache_dir = os.path.expanduser(cache_dir)
+    if index_path is not None:
+        index_path = os.path.expanduser(index_path)
+
+    # Use the snapshot if one has been provided, otherwise stream the albums from the library
+    library_albums = snapshot.get_library_albums() if snapshot is not None else beetutils.iter_library_albums(library_dir, index_path, scan_jobs)
+    action = "copy" if not embed else "copy_and_embed"
+
+    # Map albums between the library and the converted library beside it, e.g. ~/Music/FLAC and ~/Music/V2
+    library_index = beetutils.PathIndex(library_dir)
+    converted_index = library_index.with_root(beetutils.sibling_root(library_dir, library_subdir, converted_subdir))
 
-    # List all albums in the library
-    library_albums = beetutils.get_library_albums(library_dir)
-    # Replace the library path with the converted path, e.g. ~/Music/FLAC/Artist becomse ~/Music/V2/Artist
-    converted_albums = [library_album.replace(library_subdir, converted_subdir) for library_album in library_albums]
+    # Resized covers are current only if they were resized with the same settings
+    copied_covers = open_copied_covers(cache_dir) if max_size is not None else None
 
     audit_result = True
 
+    # Library covers and where to copy them, once every cover has been found
+    copies = []
+    # Albums and the covers to embed in them, once all covers have been copied
+    embeds = []
+    # Covers listed by a dry run, to be written to the plan
+    plan = []
+
     # Go through each album in the library
-    for index, item in enumerate(library_albums):
+    for library_album in library_albums:
+        # Map the library path onto the converted path, e.g. ~/Music/FLAC/Artist becomes ~/Music/V2/Artist
+        converted_album = library_index.map_path(library_album, converted_index)
+
         # Form the cover.jpg path
-        library_cover_path = os.path.join(library_albums[index], "cover.jpg")
-        converted_cover_path = os.path.join(converted_albums[index], "cover.jpg")
+        library_cover_path = os.path.join(library_album, "cover.jpg")
+        converted_cover_path = os.path.join(converted_album, "cover.jpg")
 
-        # If the cover.jpg doesn't exist in the converted album path, print it
+        # Albums without a cover of their own have nothing to copy, audit_missing_artifacts.py reports those
+        beetutils.METRICS.count("stat_calls")
+        if not os.path.isfile(library_cover_path):
+            continue
+
+        # If the cover.jpg doesn't exist in the converted album path, or the library cover has changed since it was copied, print it
+        beetutils.METRICS.count("stat_calls")
         if not os.path.isfile(converted_cover_path):
-            print(converted_cover_path)
+            kind = "missing_cover"
+        elif is_cover_changed(library_cover_path, converted_cover_path, max_size, quality, copied_covers):
+            kind = "changed_cover"
+        else:
+            kind = None
+
+        if kind is not None:
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, kind, converted_cover_path, converted_album, action, source=library_cover_path)
 
             if not dry_run:
-                # Copy the cover.jpg from the library path to the converted path
-                copyfile(library_cover_path, converted_cover_path)
+                copies.append((library_cover_path, converted_cover_path))
 
-                # If embedding, embed the copied cover.jpg into every song in the album folder
+                # If embedding, queue the copied cover.jpg to be embedded into every song in the album folder
                 if embed:
-                    with open(converted_cover_path, "rb") as cover_file:
-                        # Load the cover
-                        cover = cover_file.read()
-
-                        for song in fnmatch.filter(os.listdir(converted_albums[index]), "*.mp3"):
-                            embed_cover(os.path.join(converted_albums[index], song), cover)
+                    embeds.append((converted_album, converted_cover_path))
             else:
                 audit_result = False
+
+                if plan_path is not None:
+                    try:
+                        plan.append(beetutils.plan_entry(kind, converted_cover_path, converted_album, action, library_cover_path, max_size=max_size, quality=quality, cache_dir=os.path.abspath(cache_dir)))
+                    except FileNotFoundError:
+                        print("Not planning %s, there is no cover in the library to copy" % converted_cover_path, file=sys.stderr)
+
+    if copied_covers is not None:
+        copied_covers.close()
+
+    # Record exactly what was listed, so it can be applied without searching the library again
+    if dry_run and plan_path is not None:
+        beetutils.write_plan(os.path.expanduser(plan_path), plan)
+
+    if len(copies) > 0 and not copy_album_covers(copies, max_size, quality, cache_dir, jobs):
+        audit_result = False
+
+    # Albums whose cover could not be copied have already been reported, so there is nothing to embed
+    beetutils.METRICS.count("stat_calls", len(embeds))
+    embeds = [(album, cover_path) for album, cover_path in embeds if os.path.isfile(cover_path)]
+
+    if len(embeds) > 0 and not embed_albums(embeds, jobs):
+        audit_result = False
     
     return 0 if audit_result else 1
 
-def embed_cover(song_path: str, cover: bytes) -> None:
+def apply_plan(plan_path: str, jobs: int = None, output: str = "text") -> int:
+    """
+    Apply a plan written by a dry run, skipping any covers which have changed or been copied since
+    Missing covers are skipped once they exist, and changed covers once they are no longer older than the library cover
+
+    Args:
+        plan_path: Path to the plan to apply
+        jobs: Number of albums to embed covers into at once, defaults to the number of CPUs
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+
+    Returns:
+        0 if every cover in the plan was copied and embedded, 1 if any were stale or failed
+    """
+
+    apply_result = True
+    # Covers to copy, grouped by the resizing they were planned with
+    copies = {}
+    embeds = []
+    # Record of the resizing of the copied covers in each cache dir, opened as they are needed
+    copied_covers = {}
+
+    for entry in beetutils.read_plan(os.path.expanduser(plan_path)):
+        converted_cover_path = entry["path"]
+        max_size = entry.get("max_size")
+        quality = entry.get("quality", DEFAULT_QUALITY)
+        cache_dir = entry.get("cache_dir", DEFAULT_CACHE_DIR)
+
+        if max_size is not None and cache_dir not in copied_covers:
+            copied_covers[cache_dir] = open_copied_covers(cache_dir)
+
+        # Anything changed since the dry run was not what was reviewed, so leave it alone
+        beetutils.METRICS.count("stat_calls")
+        if entry["kind"] == "changed_cover":
+            copied = not is_cover_changed(entry["source"], converted_cover_path, max_size, quality, copied_covers.get(cache_dir))
+        else:
+            copied = os.path.isfile(converted_cover_path)
+
+        if not beetutils.is_plan_entry_current(entry) or copied:
+            apply_result = False
+            print("Skipping %s, it has changed since the plan was written" % converted_cover_path, file=sys.stderr)
+            continue
+
+        beetutils.METRICS.count("files_matched")
+        beetutils.emit(output, entry["kind"], converted_cover_path, entry["album"], entry["action"], source=entry["source"])
+
+        # Plans written before covers could be resized copy them as they are
+        copies.setdefault((max_size, quality, cache_dir), []).append((entry["source"], converted_cover_path))
+
+        if entry["action"] == "copy_and_embed":
+            embeds.append((entry["album"], converted_cover_path))
+
+    for records in copied_covers.values():
+        records.close()
+
+    for (max_size, quality, cache_dir), plan_copies in copies.items():
+        if not copy_album_covers(plan_copies, max_size, quality, cache_dir, jobs):
+            apply_result = False
+
+    if len(embeds) > 0 and not embed_albums(embeds, jobs):
+        apply_result = False
+
+    return 0 if apply_result else 1
+
+def is_cover_changed(library_cover_path: str, converted_cover_path: str, max_size: int = None, quality: int = DEFAULT_QUALITY, copied_covers: beetutils.ResultCache = None) -> bool:
+    """
+    Checks whether a library cover has changed since it was copied into the converted library, or should be resized differently
+
+    Args:
+        library_cover_path: Full path to the cover in the library
+        converted_cover_path: Full path to the copied cover in the converted library
+        max_size: Largest width and height the cover should be resized to, if it should be, in which case the sizes are not compared
+        quality: JPEG quality the cover should be resized with
+        copied_covers: Record of the resizing of each copied cover, see open_copied_covers, required with a max size
+
+    Returns:
+        True if the library cover is newer than the copy, is a different size when covers are not resized,
+        or the copy was not resized with the same max size and quality
+    """
+
+    if max_size is not None:
+        try:
+            resized, settings = copied_covers.get(converted_cover_path, beetutils.file_stamp(converted_cover_path))
+        except FileNotFoundError:
+            return True
+
+        # Copied at full size, with other settings, or replaced since it was resized
+        if not resized or settings != [max_size, quality]:
+            return True
+
+    return sync_artifacts.compare_artifact(library_cover_path, converted_cover_path, compare_size=max_size is None) is not None
+
+def open_copied_covers(cache_dir: str) -> beetutils.ResultCache:
+    """
+    Open the record of the max size and quality each converted cover was resized with, kept in the cover cache
+
+    Args:
+        cache_dir: Directory the resized covers are kept in
+
+    Returns:
+        The record, keyed on the path, size and mtime of each converted cover
+    """
+
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return beetutils.ResultCache(os.path.join(cache_dir, COPIED_COVERS_NAME))
+
+def copy_album_covers(copies: List[Tuple[str, str]], max_size: int = None, quality: int = DEFAULT_QUALITY, cache_dir: str = DEFAULT_CACHE_DIR, jobs: int = None) -> bool:
     """
-    Embeds a provided jpg file into a song's ID3 metadata
+    Copies library covers into the converted library, resizing them through the cover cache first if a max size is given
+    Every copy carries the mtime of its library cover, even once resized, so later changes to the library cover are detected
+
+    Args:
+        copies: Array of (library cover path, converted cover path) tuples to copy
+        max_size: Largest width and height in pixels of the copied covers, or None to copy them as they are
+        quality: JPEG quality of resized covers
+        cache_dir: Directory to keep resized covers in
+        jobs: Number of covers to resize at once, defaults to the number of CPUs
+
+    Returns:
+        True if every cover was copied and resized as requested, False if any were missing, failed, or were copied at full size instead
+    """
+
+    processed = {}
+    copy_result = True
+
+    if max_size is not None:
+        processed, copy_result = process_covers(sorted(set(source for source, dest in copies)), max_size, quality, cache_dir, jobs)
+
+    # Covers which failed to resize are still better copied at full size than missing
+    failures = sync_artifacts.sync_files([(processed.get(source, source), dest, source) for source, dest in copies], jobs=jobs)
+
+    # Albums without a library cover are reported, rather than stopping every other album from being copied
+    for dest, failure in failures:
+        copy_result = False
+        print("Failed to copy cover %s: %s" % (dest, failure), file=sys.stderr)
+
+    if max_size is not None:
+        record_copied_covers([dest for source, dest in copies if source in processed], set(dest for dest, failure in failures), max_size, quality, cache_dir)
+
+    return copy_result
+
+def record_copied_covers(dests: List[str], failed: Iterable[str], max_size: int, quality: int, cache_dir: str) -> None:
+    """
+    Record the max size and quality a set of covers were resized with, so changing either copies them again
+
+    Args:
+        dests: Full paths to the covers which were resized and copied into the converted library
+        failed: Full paths to any of the covers which failed to copy, which are left out
+        max_size: Largest width and height in pixels the covers were resized to
+        quality: JPEG quality the covers were resized with
+        cache_dir: Directory the resized covers are kept in
+    """
+
+    copied_covers = open_copied_covers(cache_dir)
+
+    try:
+        for dest in dests:
+            if dest in failed:
+                continue
+
+            try:
+                copied_covers.put(dest, beetutils.file_stamp(dest), [max_size, quality])
+            except FileNotFoundError:
+                # Removed as soon as it was copied, such as with its album
+                continue
+
+        copied_covers.save()
+    finally:
+        copied_covers.close()
+
+def process_covers(sources: List[str], max_size: int, quality: int, cache_dir: str, jobs: int = None) -> Tuple[Dict[str, str], bool]:
+    """
+    Resizes and recompresses covers across a pool, through a cache addressed by the hash of each cover
+    Identical covers are only processed once, no matter how many albums share them
+
+    Args:
+        sources: Array of paths to the covers to process
+        max_size: Largest width and height in pixels of the processed covers
+        quality: JPEG quality of the processed covers
+        cache_dir: Directory to keep processed covers in
+        jobs: Number of covers to process at once, defaults to the number of CPUs
+
+    Returns:
+        A tuple of the path to the processed copy of each cover that succeeded, and True if every cover succeeded
+    """
+
+    cache_dir = os.path.expanduser(cache_dir)
+    process_result = True
+    processed = {}
+
+    # The work happens in ImageMagick and in hashlib, both outside of the GIL, so threads are enough
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        digests = {}
+        for source, (digest, failure) in zip(sources, pool.map(_try_hash_cover, sources)):
+            if failure is not None:
+                process_result = False
+                print("Failed to read cover %s: %s" % (source, failure), file=sys.stderr)
+            else:
+                digests.setdefault(digest, []).append(source)
+
+        process = functools.partial(_try_process_cover, max_size=max_size, quality=quality, cache_dir=cache_dir)
+        for (digest, digest_sources), (cached_path, reused, failure) in zip(digests.items(), pool.map(process, [digest_sources[0] for digest_sources in digests.values()], digests.keys())):
+            if failure is not None:
+                process_result = False
+                print("Failed to resize cover %s: %s" % (digest_sources[0], failure), file=sys.stderr)
+                continue
+
+            beetutils.METRICS.count("covers_reused" if reused else "covers_processed")
+            for source in digest_sources:
+                processed[source] = cached_path
+
+    return processed, process_result
+
+def process_cover(source: str, digest: str, max_size: int, quality: int, cache_dir: str) -> Tuple[str, bool]:
+    """
+    Resizes and recompresses a single cover into the cache, unless it has already been processed with the same settings
+
+    Args:
+        source: Path to the cover to process
+        digest: SHA-1 hex digest of the cover
+        max_size: Largest width and height in pixels of the processed cover
+        quality: JPEG quality of the processed cover
+        cache_dir: Directory to keep processed covers in
+
+    Returns:
+        A tuple of the path to the processed cover in the cache, and True if it was already cached
+    """
+
+    # Fan out on the start of the digest, rather than keeping every cover in a single directory
+    cached_path = os.path.join(cache_dir, digest[:2], "%s-%d-%d.jpg" % (digest, max_size, quality))
+
+    if os.path.isfile(cached_path):
+        return cached_path, True
+
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    temp_fd, temp_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(cached_path))
+    os.close(temp_fd)
+
+    try:
+        # Only shrink covers larger than the max size, and drop metadata such as embedded thumbnails and colour profiles
+        subprocess.run(
+            [IMAGEMAGICK_BIN, source, "-resize", "%dx%d>" % (max_size, max_size), "-strip", "-quality", str(quality), "jpg:" + temp_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True
+        )
+
+        # Recompressing an already small cover can make it larger, in which case keep the original
+        if os.path.getsize(temp_path) >= os.path.getsize(source):
+            copyfile(source, temp_path)
+
+        # Only ever expose complete covers in the cache, since other runs may be reading it
+        os.replace(temp_path, cached_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return cached_path, False
+
+def _try_hash_cover(source: str) -> Tuple[str, str]:
+    """
+    Hashes a cover, capturing any failure
+
+    Args:
+        source: Path to the cover to hash
+
+    Returns:
+        A tuple of the SHA-1 hex digest of the cover, and the failure message if it could not be read
+    """
+
+    try:
+        return beetutils.hash_file(source), None
+    except OSError as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+def _try_process_cover(source: str, digest: str, max_size: int, quality: int, cache_dir: str) -> Tuple[str, bool, str]:
+    """
+    Processes a cover with process_cover, capturing any failure
+
+    Args:
+        source: Path to the cover to process
+        digest: SHA-1 hex digest of the cover
+        max_size: Largest width and height in pixels of the processed cover
+        quality: JPEG quality of the processed cover
+        cache_dir: Directory to keep processed covers in
+
+    Returns:
+        A tuple of the path to the processed cover, True if it was already cached, and the failure message if it failed
+    """
+
+    try:
+        return process_cover(source, digest, max_size, quality, cache_dir) + (None,)
+    except subprocess.CalledProcessError as e:
+        return None, False, "%s exited with %d: %s" % (IMAGEMAGICK_BIN, e.returncode, e.stderr.decode(errors="replace").strip())
+    except OSError as e:
+        return None, False, "%s: %s" % (type(e).__name__, e)
+
+def embed_albums(embeds: List[Tuple[str, str]], jobs: int = None) -> bool:
+    """
+    Embeds covers into every song of a set of albums, spread across a pool of worker processes
+
+    Args:
+        embeds: Array of (album path, cover path) tuples to embed
+        jobs: Number of albums to embed at once, defaults to the number of CPUs
+
+    Returns:
+        True if every album was embedded, False if any album failed
+    """
+
+    albums = [album for album, cover_path in embeds]
+    cover_paths = [cover_path for album, cover_path in embeds]
+
+    # Run in process with a single job, avoiding the pool entirely
+    if jobs == 1:
+        return _report_embeds(albums, map(_try_embed_album, albums, cover_paths))
+
+    # Each album is a single task, so its cover is only read once per album rather than per song
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return _report_embeds(albums, pool.map(_try_embed_album, albums, cover_paths))
+
+def _report_embeds(albums: List[str], results: Iterable[Tuple[int, int, str]]) -> bool:
+    """
+    Reports any albums which failed to embed, as their results arrive
+
+    Args:
+        albums: Array of album paths that were embedded
+        results: Results of _try_embed_album for each album, in the same order
+
+    Returns:
+        True if every album was embedded, False if any album failed
+    """
+
+    embed_result = True
+
+    for album, (embedded, skipped, failure) in zip(albums, results):
+        # Workers have their own metrics, so count what they report back
+        beetutils.METRICS.count("tags_written", embedded)
+        beetutils.METRICS.count("tags_skipped", skipped)
+
+        # Report the failure and carry on with the remaining albums
+        if failure is not None:
+            embed_result = False
+            print("Failed to embed cover in %s: %s" % (album, failure), file=sys.stderr)
+
+    return embed_result
+
+def embed_album(album_path: str, cover: bytes) -> Tuple[int, int]:
+    """
+    Embeds a provided jpg file into every mp3 in an album
+
+    Args:
+        album_path: Path to the album containing the songs
+        cover: Bytes object containing album cover
+
+    Returns:
+        A tuple of the number of songs embedded, and the number skipped since they already had the cover
+    """
+
+    cover_hash = hashlib.sha1(cover).digest()
+    embedded = 0
+    skipped = 0
+
+    for song in fnmatch.filter(os.listdir(album_path), "*.mp3"):
+        if embed_cover(os.path.join(album_path, song), cover, cover_hash):
+            embedded += 1
+        else:
+            skipped += 1
+
+    return embedded, skipped
+
+def _try_embed_album(album_path: str, cover_path: str) -> Tuple[int, int, str]:
+    """
+    Reads a cover and embeds it into an album with embed_album, capturing any failure
+
+    Args:
+        album_path: Path to the album containing the songs
+        cover_path: Path to the jpg file to embed
+
+    Returns:
+        A tuple of the number of songs embedded, the number skipped, and the failure message if the album failed
+    """
+
+    try:
+        with open(cover_path, "rb") as cover_file:
+            return embed_album(album_path, cover_file.read()) + (None,)
+    except Exception as e:
+        return 0, 0, "%s: %s" % (type(e).__name__, e)
+
+def embed_cover(song_path: str, cover: bytes, cover_hash: bytes = None) -> bool:
+    """
+    Embeds a provided jpg file into a song's ID3 metadata, unless it is already embedded
 
     Args:
         song_path: Path to the song to embed within
         cover: Bytes object containing song cover
+        cover_hash: SHA-1 digest of the cover, computed from cover if not provided
+
+    Returns:
+        True if the cover was embedded, False if the song already had an identical cover
     """
 
+    if cover_hash is None:
+        cover_hash = hashlib.sha1(cover).digest()
+
     # Mutagen MP3 object using the song path
     song = MP3(song_path, ID3=ID3)
 
@@ -77,6 +552,11 @@ def embed_cover(song_path: str, cover: bytes) -> None:
         song.add_tags()
     except error:
         pass
+
+    # Leave the song untouched if it already carries this exact cover
+    for frame in song.tags.getall("APIC"):
+        if hashlib.sha1(frame.data).digest() == cover_hash:
+            return False
     
     # Add the cover file as an ID3 tag
     song.tags.add(
@@ -92,6 +572,8 @@ def embed_cover(song_path: str, cover: bytes) -> None:
     # Save the song
     song.save()
 
+    return True
+
 if __name__ == "__main__":
     # Interactive command line arguments
     parser = argparse.ArgumentParser()
@@ -100,6 +582,22 @@ if __name__ == "__main__":
     parser.add_argument("--converteddir", nargs="?", default="V2", help="Name of the subdir for the converted folder")
     parser.add_argument("--dryrun", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Dry run, don't modify artifacts")
     parser.add_argument("--embed", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Embed the cover in the songs")
+    parser.add_argument("--plan", nargs="?", default=None, help="With --dryrun, write the missing covers and the size and mtime of their sources to this plan file")
+    parser.add_argument("--applyplan", nargs="?", default=None, help="Apply a plan file written by --plan instead of searching the library, skipping anything changed since")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    parser.add_argument("--maxsize", type=int, nargs="?", default=None, help="Largest width and height in pixels of copied covers, larger covers are resized")
+    parser.add_argument("--quality", type=int, nargs="?", default=DEFAULT_QUALITY, help="JPEG quality of resized covers")
+    parser.add_argument("--cachedir", nargs="?", default=DEFAULT_CACHE_DIR, help="Directory to keep resized covers in")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of covers to resize and albums to embed covers into at once, defaults to the number of CPUs")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.dir, args.librarydir, args.converteddir, args.dryrun, args.embed))
+    with beetutils.instrumented(args, "copy_covers"):
+        if args.applyplan is not None:
+            result = apply_plan(args.applyplan, args.jobs, args.output)
+        else:
+            result = main(args.dir, args.librarydir, args.converteddir, args.dryrun, args.embed, args.jobs, index_path=args.index, output=args.output, plan_path=args.plan, max_size=args.maxsize, quality=args.quality, cache_dir=args.cachedir, scan_jobs=args.scanjobs)
+
+    exit(result)
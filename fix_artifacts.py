@@ -1,88 +1,372 @@
 #!/usr/bin/env python3
 # fix_artifacts.py
 # A tool for managing artifacts within a music library
-# Detects all artifacts matching an extension and either deletes them, or
-# renames them in "$artist - $album" format
+# Detects all artifacts matching a set of rules and either renames them in "$artist - $album"
+# format, moves them or deletes them. Every rule is applied in a single pass over the library,
+# classifying the contents of each album once, with the albums fixed across a pool of workers
 # USAGE:
 # --dir - Directory to search, in beets format
-# --ext - File extension of artifacts to search for, jpg will skip cover.jpg
-# --move - Move the matched artifacts to a specified movedir
+# --rules - Space separated extension:action rules, e.g. "cue:rename log:rename jpg:move dir:delete"
+# --ext - File extension of artifacts to search for if --rules is not provided, jpg will skip cover.jpg
+# --move - Move the matched artifacts to a specified movedir, if --rules is not provided
 # --movedir - The directory to move matched artifacts to
-# --delete - Delete the artifacts instead of correcting them
+# --delete - Delete the artifacts instead of correcting them, if --rules is not provided
 # --dryrun - List the nonstandard artifacts without correction
+# --plan - With --dryrun, write the artifacts found along with their size and mtime to a plan file
+# --applyplan - Apply a plan file written by --plan, skipping any artifacts which have changed since, instead of searching the library
+# --jobs - Number of albums to fix at once
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
 # EXAMPLE:
 # Search ~/media/Music/FLAC for cue files and rename them
 # python3 fix_artifacts.py --dir=~/media/Music/FLAC --ext=cue
 # Search ~/Music for jpg files other than cover.jpg and delete them
 # python3 fix_artifacts.py --dir=~/media/Music/FLAC --ext=jpg --delete
-import argparse,os,beetutils
+# Fix cue and log files, move jpg files and delete stray directories in a single pass
+# python3 fix_artifacts.py --dir=~/media/Music/FLAC --rules="cue:rename log:rename jpg:move dir:delete"
+# List cue files to rename, then rename exactly those once they have been reviewed
+# python3 fix_artifacts.py --dir=~/media/Music/FLAC --ext=cue --dryrun --plan=cue.plan
+# python3 fix_artifacts.py --applyplan=cue.plan
+import argparse,os,sys,beetutils
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-def main(library_dir: str, artifact_extension: str, delete: bool, dry_run: bool, move: bool, move_dir: str) -> int:
-    # Extension
+# Actions which can be applied to artifacts by a rule
+ACTIONS = ["rename", "move", "delete"]
+
+# Rules applied by fix_library in beets.sh and pipeline.py
+DEFAULT_RULES = "cue:rename log:rename jpg:move dir:delete"
+
+def main(library_dir: str, rules: List[Tuple[str, str]], dry_run: bool, move_dir: str, jobs: int = 4, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, output: str = "text", plan_path: str = None, scan_jobs: int = None) -> int:
+    # Expansion
     library_dir = os.path.expanduser(library_dir)
-    if move:
+    if index_path is not None:
+        index_path = os.path.expanduser(index_path)
+    if move_dir is not None:
         move_dir = os.path.expanduser(move_dir)
 
-    library_albums = beetutils.get_library_albums(library_dir)
+    # Use the snapshot if one has been provided, otherwise stream the albums from the library
+    library_albums = snapshot.get_library_albums() if snapshot is not None else beetutils.iter_library_albums(library_dir, index_path, scan_jobs)
+    album_fixes = iter_album_fixes(library_albums, rules, move_dir, snapshot)
+
+    # Artifacts are reported as soon as they are found, other than the text output of several rules, which is grouped by rule
+    grouped = len(rules) > 1 and output == "text"
+    # Artifacts matched by each rule, only held when grouping or planning
+    matches = {rule: [] for rule in rules} if grouped or (dry_run and plan_path is not None) else None
+    report_output = None if grouped else output
+    failures = []
+
+    if dry_run:
+        found = 0
+        for library_album, fixes in album_fixes:
+            found += len(_record_matches(matches, library_album, fixes, report_output))
+    else:
+        failures = fix_albums((_record_matches(matches, library_album, fixes, report_output) for library_album, fixes in album_fixes), jobs)
+
+    # Report the artifacts grouped by rule, once the pass has finished
+    if grouped:
+        for (extension, action), artifacts in matches.items():
+            if len(artifacts) > 0:
+                print("%s artifacts to %s:" % (extension, action))
+
+            for artifact, target, library_album in artifacts:
+                beetutils.emit(output, "artifact", artifact, library_album, action, rule="%s:%s" % (extension, action), target=target)
+
+    _report_failures(failures)
+
+    # A dry run which found artifacts fails the audit, as does any artifact which could not be fixed
+    if dry_run:
+        # Record exactly what was listed, so it can be applied without matching the library again
+        if plan_path is not None:
+            beetutils.write_plan(os.path.expanduser(plan_path), _iter_plan_entries(matches))
+
+        return 0 if found == 0 else 1
+
+    return 0 if len(failures) == 0 else 1
+
+def apply_plan(plan_path: str, jobs: int = 4, output: str = "text") -> int:
+    """
+    Apply a plan written by a dry run, skipping any artifacts which have changed since
+
+    Args:
+        plan_path: Path to the plan to apply
+        jobs: Number of albums to fix at once
+        output: Output format, one of beetutils.OUTPUT_FORMATS
+
+    Returns:
+        0 if every artifact in the plan was fixed, 1 if any were stale or failed
+    """
+
+    album_fixes = {}
+    stale = 0
+
+    for entry in beetutils.read_plan(os.path.expanduser(plan_path)):
+        # Anything changed since the dry run was not what was reviewed, so leave it alone
+        if not beetutils.is_plan_entry_current(entry):
+            stale += 1
+            print("Skipping %s, it has changed since the plan was written" % entry["path"], file=sys.stderr)
+            continue
+
+        extension, action = entry["rule"].split(":")
+        album_fixes.setdefault(entry["album"], []).append(((extension, action), entry["path"], entry["target"]))
+        beetutils.METRICS.count("files_matched")
+        beetutils.emit(output, "artifact", entry["path"], entry["album"], action, rule=entry["rule"], target=entry["target"])
+
+    failures = fix_albums(album_fixes.values(), jobs)
+    _report_failures(failures)
+
+    return 0 if stale == 0 and len(failures) == 0 else 1
+
+def iter_album_fixes(library_albums: Iterable[str], rules: List[Tuple[str, str]], move_dir: str, snapshot: beetutils.LibrarySnapshot = None) -> Iterator[Tuple[str, List[Tuple[Tuple[str, str], str, str]]]]:
+    """
+    Stream the fixes for each album, classifying everything in the album once
 
-    audit_result = True
+    Args:
+        library_albums: Full paths to the albums to match
+        rules: Array of (extension, action) rules to apply, in order
+        move_dir: Directory to move artifacts to, for move rules
+        snapshot: Snapshot to read the contents of albums from, otherwise they are listed from disk
+
+    Returns:
+        A generator of (album path, fixes) tuples, see match_album_artifacts
+    """
 
-    # Go through each album in the library
     for library_album in library_albums:
-        # Retrieve only the folder name from the full path, which is the album name
-        album_name = os.path.basename(library_album)
+        if snapshot is not None:
+            album_artifacts = snapshot.get_album_artifacts(library_album)
+        else:
+            album_artifacts = beetutils.get_album_artifacts(library_album)
+
+        yield library_album, match_album_artifacts(library_album, album_artifacts, rules, move_dir)
+
+def fix_albums(album_fixes: Iterable[List[Tuple[Tuple[str, str], str, str]]], jobs: int = 4) -> List[Tuple[str, str]]:
+    """
+    Apply the fixes for a set of albums across a bounded pool of workers
+
+    Args:
+        album_fixes: Fixes for each album, see match_album_artifacts
+        jobs: Number of albums to fix at once
+
+    Returns:
+        An array of (artifact path, failure message) tuples for any fixes which failed
+    """
+
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+
+        for fixes in album_fixes:
+            if len(fixes) == 0:
+                continue
+
+            # Keep the number of queued albums bounded, rather than queueing the whole library
+            if len(pending) >= jobs * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failures += future.result()
+
+            # Each album is fixed in order by a single worker, so a directory is only deleted once its artifacts are moved
+            pending.add(pool.submit(fix_album, fixes))
+
+        for future in pending:
+            failures += future.result()
+
+    return failures
+
+def match_album_artifacts(library_album: str, album_artifacts: Dict[str, List[str]], rules: List[Tuple[str, str]], move_dir: str) -> List[Tuple[Tuple[str, str], str, str]]:
+    """
+    Match the artifacts in an album against a set of rules
+
+    Args:
+        library_album: Full path to the album
+        album_artifacts: Full paths to the artifacts in the album keyed by extension, with subdirectories under "dir", see get_album_artifacts
+        rules: Array of (extension, action) rules to apply, in order
+        move_dir: Directory to move artifacts to, for move rules
+
+    Returns:
+        An array of (rule, artifact path, target path) tuples, in the order they should be applied, with no target for deletes
+    """
+
+    # Retrieve only the folder name from the full path, which is the album name
+    album_name = os.path.basename(library_album)
+    fixes = []
+
+    for rule in rules:
+        extension, action = rule
+        artifacts = album_artifacts.get(extension, [])
+
+        # Delete the deepest directories first, so their parents are empty by the time they are deleted
+        if extension == "dir":
+            artifacts = sorted(artifacts, key=lambda artifact: artifact.count(os.sep), reverse=True)
 
-        # Retrieve artifacts in this album's folder and go through them
-        for artifact in beetutils.get_folder_artifacts(library_album, artifact_extension):
+        for artifact in artifacts:
             # Extract only the filename itself
             artifact_base = os.path.basename(artifact)
-            
+
             # Skip the artifact if it is just cover.jpg
             if artifact_base == "cover.jpg":
                 continue
-            
-            # Retrieve the name of the file without the extension, test.jpg becomes test
-            artifact_album = os.path.splitext(artifact_base)[0]
-
-            # If the name of the file does not match the album name, act on it
-            if artifact_album != album_name:
-                # Create the full path to the artifact and print it
-                print(artifact)
-
-                # If this is not a dry run, act on it
-                if not dry_run:
-                    if move:
-                        # Form a new path composed of the Album Name and the artifact's original filename
-                        new_path = os.path.join(move_dir, "%s - %s" % (album_name, artifact_base))
-                        # Move the artifact
-                        os.rename(artifact, new_path)
-                    elif delete:
-                        if artifact_extension == "dir":
-                            # Delete the directory
-                            os.removedirs(artifact)
-                        else:
-                            # Delete the artifact, unless it is a directory
-                            os.remove(artifact, dir_fd=None)
-                    else:
-                        # Create the "corrected" filename and path "$artist - $album.$extension"
-                        fixed_path = os.path.join(library_album, "%s.%s" % (album_name, artifact_extension))
-                        
-                        # Perform the correction rename
-                        os.rename(artifact, fixed_path)
+
+            # If the name of the file, test.jpg becomes test, matches the album name there is nothing to do
+            if os.path.splitext(artifact_base)[0] == album_name:
+                continue
+
+            if action == "move":
+                # Form a new path composed of the Album Name and the artifact's original filename
+                target = os.path.join(move_dir, "%s - %s" % (album_name, artifact_base))
+            elif action == "delete":
+                target = None
+            else:
+                # Create the "corrected" filename and path "$artist - $album.$extension"
+                target = os.path.join(library_album, "%s.%s" % (album_name, extension))
+
+            fixes.append((rule, artifact, target))
+
+    return fixes
+
+def fix_album(fixes: List[Tuple[Tuple[str, str], str, str]]) -> List[Tuple[str, str]]:
+    """
+    Apply the fixes for a single album in order, carrying on past any that fail
+
+    Args:
+        fixes: Array of (rule, artifact path, target path) tuples, see match_album_artifacts
+
+    Returns:
+        An array of (artifact path, failure message) tuples for any fixes which failed
+    """
+
+    failures = []
+
+    for (extension, action), artifact, target in fixes:
+        try:
+            if action == "delete":
+                if extension == "dir":
+                    # Delete the directory, which only succeeds once it is empty
+                    os.removedirs(artifact)
                 else:
-                    audit_result = False
-    
-    return 0 if audit_result else 1
+                    os.remove(artifact)
+            else:
+                # Move or rename the artifact
+                os.rename(artifact, target)
+        except OSError as e:
+            failures.append((artifact, "%s: %s" % (type(e).__name__, e)))
+
+    return failures
+
+def _record_matches(matches: Dict[Tuple[str, str], List[Tuple[str, str, str]]], library_album: str, fixes: List[Tuple[Tuple[str, str], str, str]], output: str = "text") -> List[Tuple[Tuple[str, str], str, str]]:
+    """
+    Report the fixes for an album as they are found, and record them against the rules which matched them
+
+    Args:
+        matches: Arrays of (artifact path, target path, album path) tuples keyed by rule, added to if provided
+        library_album: Full path to the album
+        fixes: Fixes for the album, see match_album_artifacts
+        output: Output format, one of beetutils.OUTPUT_FORMATS, or None to only record the fixes for a grouped report
+
+    Returns:
+        The same fixes, so this can be chained in front of fix_albums
+    """
+
+    for rule, artifact, target in fixes:
+        beetutils.METRICS.count("files_matched")
+
+        if output is not None:
+            extension, action = rule
+            beetutils.emit(output, "artifact", artifact, library_album, action, rule="%s:%s" % (extension, action), target=target)
+
+        if matches is not None:
+            matches[rule].append((artifact, target, library_album))
+
+    return fixes
+
+def _iter_plan_entries(matches: Dict[Tuple[str, str], List[Tuple[str, str, str]]]) -> Iterator[dict]:
+    """
+    Build the plan entries for every matched artifact, rules in order so each album is fixed in the same order as a real run
+
+    Args:
+        matches: Arrays of (artifact path, target path, album path) tuples keyed by rule
+
+    Returns:
+        A generator of plan entries, see beetutils.plan_entry
+    """
+
+    for (extension, action), artifacts in matches.items():
+        for artifact, target, library_album in artifacts:
+            try:
+                yield beetutils.plan_entry("artifact", artifact, library_album, action, rule="%s:%s" % (extension, action), target=os.path.abspath(target) if target is not None else None)
+            except FileNotFoundError:
+                # Gone since it was listed, so there is nothing left to plan
+                continue
+
+def _report_failures(failures: List[Tuple[str, str]]) -> None:
+    """
+    Report any artifacts which could not be fixed
+
+    Args:
+        failures: Array of (artifact path, failure message) tuples
+    """
+
+    for artifact, failure in failures:
+        print("Failed to fix %s: %s" % (artifact, failure), file=sys.stderr)
+
+def string_to_rules(string_value: str) -> List[Tuple[str, str]]:
+    """
+    Convert a string argument to a set of rules
+
+    Args:
+        string_value: Space separated extension:action rules, e.g. "cue:rename dir:delete"
+
+    Returns:
+        An array of (extension, action) tuples
+
+    Raises:
+        argparse.ArgumentTypeError: If a rule is not an extension and a known action separated by a colon
+    """
+
+    rules = []
+
+    for rule in string_value.split():
+        extension, separator, action = rule.partition(":")
+
+        if not extension or not separator or action not in ACTIONS:
+            raise argparse.ArgumentTypeError("Rules of extension:action expected, with an action of %s." % ", ".join(ACTIONS))
+
+        rules.append((extension, action))
+
+    return rules
 
 if __name__ == "__main__":
     # Interactive command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
-    parser.add_argument("--ext", nargs="?", default="cue", help="The extension of the artifact to fix")
+    parser.add_argument("--rules", type=string_to_rules, nargs="?", default=None, help="Space separated extension:action rules, e.g. \"%s\"" % DEFAULT_RULES)
+    parser.add_argument("--ext", nargs="?", default="cue", help="The extension of the artifact to fix, if --rules is not provided")
     parser.add_argument("--move", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Move the artifact to a specified folder instead of renaming it")
     parser.add_argument("--movedir", nargs="?", default="~/media/Music/Misc/Artifacts", help="Directory to move artifacts to, if --move specified")
     parser.add_argument("--delete", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Delete the artifact instead of renaming it (DANGEROUS)")
     parser.add_argument("--dryrun", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Dry run, don't modify artifacts")
+    parser.add_argument("--plan", nargs="?", default=None, help="With --dryrun, write the artifacts found and their current size and mtime to this plan file")
+    parser.add_argument("--applyplan", nargs="?", default=None, help="Apply a plan file written by --plan instead of searching the library, skipping anything changed since")
+    parser.add_argument("--jobs", type=int, nargs="?", default=4, help="Number of albums to fix at once")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    exit(main(args.dir, args.ext, args.delete, args.dryrun, args.move, args.movedir))
+    # Without any rules, build a single rule from the original flags
+    if args.rules is None:
+        args.rules = [(args.ext, "move" if args.move else "delete" if args.delete else "rename")]
+
+    with beetutils.instrumented(args, "fix_artifacts"):
+        if args.applyplan is not None:
+            result = apply_plan(args.applyplan, args.jobs, args.output)
+        else:
+            result = main(args.dir, args.rules, args.dryrun, args.movedir, args.jobs, index_path=args.index, output=args.output, plan_path=args.plan, scan_jobs=args.scanjobs)
+
+    exit(result)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# library_index.py
+# Maintains a persistent index of the directories in a music library
+# Each directory is stored along with its mtime and listing, so that scans of the
+# library only need to re-list the directories which have changed since the last run
+# USAGE:
+# --dir - Directory to index, in beets format
+# --index - Path to the index database
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --rebuild - Discard the existing index for the directory and list everything again
+# --check - Compare the index against the library without updating it
+# --output - Write inconsistent directories as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
+# EXAMPLE:
+# Update the index of ~/Music stored at ~/library_index.db
+# python3 library_index.py --dir=~/Music --index=~/library_index.db
+# Rebuild the index of ~/Music from scratch
+# python3 library_index.py --dir=~/Music --index=~/library_index.db --rebuild
+# Report any directories in ~/Music whose listing does not match the index
+# python3 library_index.py --dir=~/Music --index=~/library_index.db --check
+import argparse,os,sqlite3,threading,time,beetutils
+from typing import List, Tuple
+
+# Directories modified more recently than this many seconds are not cached, since a change
+# landing within the same mtime tick as the listing would otherwise go unnoticed
+MTIME_GRACE = 2
+
+class LibraryIndex:
+    """
+    Persistent index of directory listings keyed on directory mtimes
+
+    Attributes:
+        index_path: Path to the SQLite index database
+        listed: Number of directories which were listed from disk
+        reused: Number of directories whose listing was reused from the index
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.listed = 0
+        self.reused = 0
+
+        self._conn = sqlite3.connect(index_path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, entries TEXT NOT NULL)")
+
+        # Load the whole index up front, a single query is far cheaper than one per directory
+        self._directories = {path: (mtime, entries) for path, mtime, entries in self._conn.execute("SELECT path, mtime, entries FROM directories")}
+        self._changed = {}
+        self._visited = set()
+        # Directories may be listed from the threads of a concurrent scan
+        self._lock = threading.Lock()
+
+    def list_directory(self, directory: str) -> List[Tuple[str, bool, bool]]:
+        """
+        List the entries of a single directory, reusing the indexed listing if its mtime has not changed
+
+        Args:
+            directory: Full path to the directory to list
+
+        Returns:
+            An array of (name, is directory, is symlink) tuples for each entry in the directory
+        """
+
+        self._visited.add(directory)
+        beetutils.METRICS.count("stat_calls")
+        mtime = os.stat(directory).st_mtime_ns
+        indexed = self._directories.get(directory)
+
+        if indexed is not None and indexed[0] == mtime:
+            with self._lock:
+                self.reused += 1
+            beetutils.METRICS.count("directories_reused")
+            return _decode_entries(indexed[1])
+
+        # The directory is new or has changed, so list it from disk
+        with self._lock:
+            self.listed += 1
+        beetutils.METRICS.count("directories_listed")
+        with os.scandir(directory) as scanned:
+            entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in scanned]
+
+        # Only remember the listing if the directory has had time to settle
+        if time.time_ns() - mtime > MTIME_GRACE * 1000000000:
+            encoded = _encode_entries(entries)
+            self._directories[directory] = (mtime, encoded)
+            self._changed[directory] = (mtime, encoded)
+        elif indexed is not None:
+            del self._directories[directory]
+            self._changed[directory] = None
+
+        return entries
+
+    def save(self, root: str) -> None:
+        """
+        Write any re-listed directories to the index, and remove directories under root which were not visited
+
+        Args:
+            root: Path to the library that was scanned
+        """
+
+        # Any indexed directory under the root which was not reached during the scan no longer exists
+        prefix = os.path.join(root, "")
+        for directory in [directory for directory in self._directories if directory.startswith(prefix) or directory == root]:
+            if directory not in self._visited:
+                del self._directories[directory]
+                self._changed[directory] = None
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO directories (path, mtime, entries) VALUES (?, ?, ?)",
+                [(directory, entry[0], entry[1]) for directory, entry in self._changed.items() if entry is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM directories WHERE path = ?",
+                [(directory,) for directory, entry in self._changed.items() if entry is None]
+            )
+
+        self._changed = {}
+
+    def clear(self, root: str) -> None:
+        """
+        Remove every directory under root from the index
+
+        Args:
+            root: Path to the library to forget
+        """
+
+        prefix = os.path.join(root, "")
+
+        with self._conn:
+            self._conn.execute("DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?", (root, len(prefix), prefix))
+
+        self._directories = {directory: entry for directory, entry in self._directories.items() if not (directory == root or directory.startswith(prefix))}
+
+    def check(self, root: str) -> List[str]:
+        """
+        Compare every indexed directory under root against its listing on disk
+
+        Args:
+            root: Path to the library to check
+
+        Returns:
+            An array of full paths to directories whose indexed listing does not match the disk
+        """
+
+        inconsistent = []
+        prefix = os.path.join(root, "")
+
+        for directory, (mtime, encoded) in sorted(self._directories.items()):
+            if directory != root and not directory.startswith(prefix):
+                continue
+
+            try:
+                with os.scandir(directory) as scanned:
+                    entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in scanned]
+            except FileNotFoundError:
+                inconsistent.append(directory)
+                continue
+
+            if sorted(entries) != sorted(_decode_entries(encoded)):
+                inconsistent.append(directory)
+
+        return inconsistent
+
+    def close(self) -> None:
+        """
+        Close the index database
+        """
+
+        self._conn.close()
+
+def _encode_entries(entries: List[Tuple[str, bool, bool]]) -> str:
+    """
+    Encode a directory listing into a compact string for storage
+
+    Args:
+        entries: Array of (name, is directory, is symlink) tuples
+
+    Returns:
+        The listing as a string of NUL separated names, each prefixed with f (file), d (directory) or l (symlinked directory)
+    """
+
+    return "\0".join(("l" if is_symlink else "d") + name if is_dir else "f" + name for name, is_dir, is_symlink in entries)
+
+def _decode_entries(encoded: str) -> List[Tuple[str, bool, bool]]:
+    """
+    Decode a directory listing stored by _encode_entries
+
+    Args:
+        encoded: Encoded directory listing
+
+    Returns:
+        An array of (name, is directory, is symlink) tuples
+    """
+
+    if not encoded:
+        return []
+
+    return [(entry[1:], entry[0] != "f", entry[0] == "l") for entry in encoded.split("\0")]
+
+def main(library_dir: str, index_path: str, rebuild: bool, check: bool, output: str = "text", scan_jobs: int = None) -> int:
+    # Expansion
+    index_path = os.path.expanduser(index_path)
+
+    if check:
+        index = LibraryIndex(index_path)
+
+        try:
+            inconsistent = [directory for root in beetutils.library_roots(library_dir) for directory in index.check(root)]
+        finally:
+            index.close()
+
+        # Print any directories that have drifted from the index
+        for directory in inconsistent:
+            beetutils.emit(output, "stale_directory", directory, None, "rebuild")
+
+        return 0 if len(inconsistent) == 0 else 1
+
+    if rebuild:
+        index = LibraryIndex(index_path)
+
+        try:
+            for root in beetutils.library_roots(library_dir):
+                index.clear(root)
+        finally:
+            index.close()
+
+    # Scan the library through the index, which updates it
+    snapshot = beetutils.scan_library(library_dir, index_path, scan_jobs)
+    print("Indexed %d albums in %s" % (len(snapshot.get_library_albums()), library_dir))
+
+    for root, seconds in snapshot.root_seconds.items():
+        print("Scanned %s in %.2fs" % (root, seconds))
+
+    return 0
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--index", nargs="?", default="~/.config/beets/library_index.db", help="The library index database")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    parser.add_argument("--rebuild", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Discard the index and list the whole library again")
+    parser.add_argument("--check", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Report directories whose listing does not match the index")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with beetutils.instrumented(args, "library_index"):
+        result = main(args.dir, args.index, args.rebuild, args.check, args.output, args.scanjobs)
+
+    exit(result)
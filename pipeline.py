@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# pipeline.py
+# Runs the audit, fix, convert and cover steps of beets.sh within a single process
+# The library scans and beets database results are shared between every step, and dry runs
+# reuse the same scan as the real run that follows them, rather than each script starting
+# over. Step names, exit codes and confirmation prompts match those of beets.sh
+# USAGE:
+# STEP - Name of the step to run, e.g. full, audit_library or fix_cue_artifacts
+# --db - Path to the beets datbase file
+# --dir - Location of the beets music library files
+# --converted - Location of the converted music files
+# --artifactdir - Directory to move jpg artifacts to
+# --rules - Space separated extension:action artifact rules applied by fix_library, see fix_artifacts.py
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --config - Path to the beets config.yaml, used for conversion
+# --manifest - Path to the conversion manifest database
+# --convertlog - File to write the conversion output to
+# --jobs - Number of songs or albums to process at once, defaults to the number of CPUs
+# --beetsdir - Name of the subdir for the beets library present in the db
+# --librarydir - Name of the subdir for the library folder
+# --converteddir - Name of the subdir for the converted folder
+# --ext - File format of the converted directory
+# --interactive - Pause for confirmation when a step finds something, like beets.sh
+# --bell - String printed before each confirmation prompt
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson), with progress messages on stderr
+# --report - Optional path to write a JSON report of the timings and counters of each step to
+# --prometheus - Optional path to write the timings and counters of each step to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
+# --profilestep - Only profile the named step, e.g. fix_library, rather than the whole run
+# EXAMPLE:
+# Run every step from auditing through to fixing converted covers, pausing for confirmation
+# python3 pipeline.py full --db=~/library.db --dir=~/Music/FLAC --converted=~/Music/V2
+# Audit the library without pausing
+# python3 pipeline.py audit_library --db=~/library.db --dir=~/Music/FLAC --interactive=no
+import argparse,codecs,functools,os,sys,tempfile,beetutils
+from contextlib import redirect_stderr, redirect_stdout
+import audit_missing_artifacts,audit_missing_beets_music,audit_missing_library_music,audit_missing_converted_music
+import convert_library,copy_covers,fix_artifacts
+from typing import Callable, Dict, List, Tuple
+
+class PipelineContext:
+    """
+    Settings and shared results for a pipeline run
+
+    Attributes:
+        args: Parsed command line arguments
+        interactive: Whether to pause for confirmation
+        plan_dir: Directory to write the plans of dry runs to, so the reviewed plan is applied after confirmation
+    """
+
+    def __init__(self, args: argparse.Namespace, plan_dir: str = None):
+        self.args = args
+        self.interactive = args.interactive
+        self.plan_dir = plan_dir
+        self._library_snapshot = None
+        self._converted_snapshot = None
+        self._beets_paths = None
+        self._beets_songs = {}
+
+    @property
+    def library_snapshot(self) -> beetutils.LibrarySnapshot:
+        """
+        Snapshot of the library folder, scanned the first time it is needed
+        """
+
+        if self._library_snapshot is None:
+            self._library_snapshot = beetutils.scan_library(self.args.dir, self.args.index, self.args.scanjobs)
+
+        return self._library_snapshot
+
+    @property
+    def converted_snapshot(self) -> beetutils.LibrarySnapshot:
+        """
+        Snapshot of the converted folder, scanned the first time it is needed
+        """
+
+        if self._converted_snapshot is None:
+            self._converted_snapshot = beetutils.scan_library(self.args.converted, self.args.index, self.args.scanjobs)
+
+        return self._converted_snapshot
+
+    def beets_songs(self, extension: str = "flac") -> List[str]:
+        """
+        Retrieve all paths to songs in the beets database, reading the database only once per run
+
+        Args:
+            extension: File extension of paths to return, if comparing converted files
+
+        Returns:
+            An array of all full song paths in the beets database
+        """
+
+        if self._beets_paths is None:
+            self._beets_paths = [beetutils.decode_beets_path(row[0]) for row in beetutils.iter_beets_rows(self.args.db, ["path"])]
+
+        if extension not in self._beets_songs:
+            self._beets_songs[extension] = [beetutils.with_extension(path, extension) for path in self._beets_paths]
+
+        return self._beets_songs[extension]
+
+    def invalidate_library(self) -> None:
+        """
+        Discard the library snapshot after the library folder has been modified
+        """
+
+        self._library_snapshot = None
+
+    def invalidate_converted(self) -> None:
+        """
+        Discard the converted snapshot after the converted folder has been modified
+        """
+
+        self._converted_snapshot = None
+
+    def invalidate_beets(self) -> None:
+        """
+        Discard the songs read from the beets database after it has been modified, e.g. by beet remove
+        """
+
+        self._beets_paths = None
+        self._beets_songs = {}
+
+    def log(self, message: str) -> None:
+        """
+        Print a progress message, keeping it apart from the findings when writing them as ndjson
+
+        Args:
+            message: Message to print
+        """
+
+        print(message, file=sys.stderr if self.args.output == "ndjson" else sys.stdout, flush=True)
+
+    def confirm(self, message: str) -> None:
+        """
+        Ring the bell and wait for a keypress, if running interactively
+
+        Args:
+            message: Message describing what needs attention
+        """
+
+        if not self.interactive:
+            return
+
+        self.log("%s \n%s" % (self.args.bell, message))
+
+        # Read from the terminal, like beets.sh, so a redirected stdin cannot skip the prompt
+        try:
+            with open("/dev/tty") as tty:
+                tty.readline()
+        except OSError:
+            input()
+
+def pipeline_step(name: str) -> Callable[[Callable[[PipelineContext], int]], Callable[[PipelineContext], int]]:
+    """
+    Time a step as a stage of the run, so its timings and counters are reported separately
+
+    Args:
+        name: Name of the stage, matching the step name
+
+    Returns:
+        A decorator wrapping the step in a stage
+    """
+
+    def decorator(step: Callable[[PipelineContext], int]) -> Callable[[PipelineContext], int]:
+        @functools.wraps(step)
+        def wrapper(context: PipelineContext) -> int:
+            with beetutils.METRICS.stage(name):
+                return step(context)
+
+        return wrapper
+
+    return decorator
+
+@pipeline_step("audit_library")
+def audit_library(context: PipelineContext) -> int:
+    context.log("Auditing missing beets and library music\n")
+    result = audit_all_music(context)
+    if result != 0 and not context.interactive:
+        return result
+    elif result == 1:
+        context.confirm("Music in beets db not in library, or in library not in beets db! Fix and press any key to continue")
+
+        # Anything after this needs to see what was fixed, in the library or in beets
+        context.invalidate_library()
+        context.invalidate_beets()
+
+    context.log("Auditing missing music covers\n")
+    result = audit_music_covers(context)
+    if result != 0 and not context.interactive:
+        return result
+    elif result == 1:
+        context.confirm("Covers missing! Fix and press any key to continue")
+        context.invalidate_library()
+        context.invalidate_beets()
+
+    return 0
+
+@pipeline_step("audit_beets_music")
+def audit_beets_music(context: PipelineContext) -> int:
+    context.log("Checking for music in %s not present in %s" % (context.args.db, context.args.dir))
+    return audit_missing_beets_music.main(context.args.db, context.args.dir, snapshot=context.library_snapshot, beets_songs=context.beets_songs(), output=context.args.output)
+
+@pipeline_step("audit_library_music")
+def audit_library_music(context: PipelineContext) -> int:
+    context.log("Checking for music in %s not present in %s" % (context.args.dir, context.args.db))
+    return audit_missing_library_music.main(context.args.db, context.args.dir, snapshot=context.library_snapshot, beets_songs=context.beets_songs(), output=context.args.output)
+
+@pipeline_step("audit_all_music")
+def audit_all_music(context: PipelineContext) -> int:
+    context.log("Checking for music in %s not present in %s, and in %s not present in %s" % (context.args.db, context.args.dir, context.args.dir, context.args.db))
+    return audit_missing_beets_music.main(context.args.db, context.args.dir, True, snapshot=context.library_snapshot, beets_songs=context.beets_songs(), output=context.args.output)
+
+@pipeline_step("audit_music_covers")
+def audit_music_covers(context: PipelineContext) -> int:
+    context.log("Checking for missing covers in %s" % context.args.dir)
+    return audit_missing_artifacts.main(context.args.dir, "cover.jpg", snapshot=context.library_snapshot, output=context.args.output)
+
+@pipeline_step("fix_library")
+def fix_library(context: PipelineContext) -> int:
+    # Every rule is applied in a single pass over the library
+    return _fix_artifacts(context, context.args.rules, "The above artifacts will be fixed, moved or DELETED, press any key to continue")
+
+def _fix_artifacts(context: PipelineContext, rules: List[Tuple[str, str]], prompt: str) -> int:
+    """
+    Run fix_artifacts for a set of rules, listing the artifacts and confirming first if interactive
+
+    Args:
+        context: Context of the pipeline run
+        rules: Array of (extension, action) rules to apply, see fix_artifacts.string_to_rules
+        prompt: Confirmation message shown after listing the artifacts
+
+    Returns:
+        The exit code of fix_artifacts
+    """
+
+    library_dir = context.args.dir
+    description = " ".join("%s:%s" % rule for rule in rules)
+
+    try:
+        if context.interactive:
+            plan_path = os.path.join(context.plan_dir, "fix_artifacts.plan")
+
+            context.log("Listing %s artifacts in %s \n" % (description, library_dir))
+            result = fix_artifacts.main(library_dir, rules, True, context.args.artifactdir, snapshot=context.library_snapshot, output=context.args.output, plan_path=plan_path)
+
+            if result == 0:
+                return result
+
+            context.confirm(prompt)
+
+            # Apply the plan that was listed, so exactly what was reviewed is fixed
+            context.log("Fixing %s artifacts in %s" % (description, library_dir))
+            return fix_artifacts.apply_plan(plan_path, output=context.args.output)
+
+        context.log("Fixing %s artifacts in %s" % (description, library_dir))
+        return fix_artifacts.main(library_dir, rules, False, context.args.artifactdir, snapshot=context.library_snapshot, output=context.args.output)
+    finally:
+        # Anything after this needs to see the fixed library
+        context.invalidate_library()
+
+@pipeline_step("fix_cue_artifacts")
+def fix_cue_artifacts(context: PipelineContext) -> int:
+    return _fix_artifacts(context, [("cue", "rename")], "The above cues will be fixed, press any key to continue")
+
+@pipeline_step("fix_log_artifacts")
+def fix_log_artifacts(context: PipelineContext) -> int:
+    return _fix_artifacts(context, [("log", "rename")], "The above logs will be fixed, press any key to continue")
+
+@pipeline_step("fix_jpg_artifacts")
+def fix_jpg_artifacts(context: PipelineContext) -> int:
+    return _fix_artifacts(context, [("jpg", "move")], "The above jpgs will be moved, press any key to continue")
+
+@pipeline_step("fix_dir_artifacts")
+def fix_dir_artifacts(context: PipelineContext) -> int:
+    return _fix_artifacts(context, [("dir", "delete")], "The above dirs will be DELETED, press any key to continue")
+
+@pipeline_step("convert_library")
+def convert_library_step(context: PipelineContext) -> int:
+    context.log("Converting music in %s" % context.args.dir)
+
+    # Keep the per song output out of the way, like beets.sh did with beet convert
+    with open(context.args.convertlog, "w") as convert_log, redirect_stdout(convert_log), redirect_stderr(convert_log):
+        result = convert_library.main(context.args.config, context.args.db, context.args.manifest, context.args.jobs or os.cpu_count(), context.args.retries, False, False, context.args.output)
+
+    # Newly converted songs need to be seen by the converted audits
+    context.invalidate_converted()
+
+    return result
+
+@pipeline_step("audit_converted")
+def audit_converted(context: PipelineContext) -> int:
+    context.log("Auditing missing converted\n")
+    result = audit_converted_music(context)
+    if result != 0 and not context.interactive:
+        return result
+    elif result == 1:
+        context.confirm("Converted music missing! Check converted.log, fix and press any key to continue")
+
+        # Anything after this needs to see what was fixed, in either folder or in beets
+        context.invalidate_library()
+        context.invalidate_converted()
+        context.invalidate_beets()
+
+    return 0
+
+@pipeline_step("audit_converted_music")
+def audit_converted_music(context: PipelineContext) -> int:
+    context.log("Checking for music in %s not present in %s" % (context.args.converted, context.args.db))
+    return audit_missing_converted_music.main(
+        context.args.db, context.args.converted, context.args.beetsdir, context.args.converteddir, context.args.ext,
+        snapshot=context.converted_snapshot, beets_songs=context.beets_songs(context.args.ext), output=context.args.output
+    )
+
+@pipeline_step("fix_converted")
+def fix_converted(context: PipelineContext) -> int:
+    context.log("Fixing missing converted covers\n")
+    return fix_converted_covers(context)
+
+@pipeline_step("fix_converted_covers")
+def fix_converted_covers(context: PipelineContext) -> int:
+    args = context.args
+
+    if context.interactive:
+        plan_path = os.path.join(context.plan_dir, "copy_covers.plan")
+
+        context.log("Listing covers in %s \n" % args.converted)
+        result = copy_covers.main(args.dir, args.librarydir, args.converteddir, True, True, snapshot=context.library_snapshot, output=args.output, plan_path=plan_path, max_size=args.maxsize, quality=args.quality, cache_dir=args.cachedir)
+
+        if result == 0:
+            return result
+
+        context.confirm("The above covers will be copied and embedded, press any key to continue")
+
+        # Apply the plan that was listed, so exactly what was reviewed is copied
+        context.log("Copying and embedding covers in %s" % args.converted)
+        return copy_covers.apply_plan(plan_path, args.jobs, args.output)
+
+    context.log("Copying and embedding covers in %s" % args.converted)
+    return copy_covers.main(args.dir, args.librarydir, args.converteddir, False, True, args.jobs, snapshot=context.library_snapshot, output=args.output, max_size=args.maxsize, quality=args.quality, cache_dir=args.cachedir)
+
+@pipeline_step("full")
+def full(context: PipelineContext) -> int:
+    return run_steps(context, [audit_library, fix_library, convert_library_step, audit_converted, fix_converted])
+
+def run_steps(context: PipelineContext, steps: List[Callable[[PipelineContext], int]]) -> int:
+    """
+    Run a series of steps, stopping at the first failure if not interactive
+
+    Args:
+        context: Context of the pipeline run
+        steps: Steps to run in order
+
+    Returns:
+        The exit code of the failed step, or 0 if every step succeeded
+    """
+
+    for step in steps:
+        result = step(context)
+
+        # Without anyone to fix things as they are found, stop rather than build on a broken library
+        if result != 0 and not context.interactive:
+            return result
+
+    return 0
+
+# Steps which can be ran, named after their beets.sh equivalents
+STEPS: Dict[str, Callable[[PipelineContext], int]] = {
+    "audit_library": audit_library,
+    "audit_beets_music": audit_beets_music,
+    "audit_library_music": audit_library_music,
+    "audit_all_music": audit_all_music,
+    "audit_music_covers": audit_music_covers,
+    "fix_library": fix_library,
+    "fix_cue_artifacts": fix_cue_artifacts,
+    "fix_log_artifacts": fix_log_artifacts,
+    "fix_jpg_artifacts": fix_jpg_artifacts,
+    "fix_dir_artifacts": fix_dir_artifacts,
+    "convert_library": convert_library_step,
+    "audit_converted": audit_converted,
+    "audit_converted_music": audit_converted_music,
+    "fix_converted": fix_converted,
+    "fix_converted_covers": fix_converted_covers,
+    "full": full
+}
+
+def main(args: argparse.Namespace) -> int:
+    # Expansion
+    for path in ["db", "dir", "converted", "artifactdir", "config", "manifest", "convertlog", "index"]:
+        if getattr(args, path) is not None:
+            setattr(args, path, os.path.expanduser(getattr(args, path)))
+
+    # Allow escapes such as \a, since the bell is passed through from beets.sh
+    args.bell = codecs.decode(args.bell, "unicode_escape")
+
+    # Plans only need to last until they are applied, later in the same run
+    with beetutils.instrumented(args, "pipeline", args.profilestep), tempfile.TemporaryDirectory(prefix="beets-pipeline-") as plan_dir:
+        return STEPS[args.step](PipelineContext(args, plan_dir))
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("step", choices=STEPS.keys(), help="The step to run")
+    parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
+    parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--converted", nargs="?", default="~/media/Music/V2", help="Location of the converted music files")
+    parser.add_argument("--artifactdir", nargs="?", default="~/media/Music/Misc/Artifacts", help="Directory to move jpg artifacts to")
+    parser.add_argument("--rules", type=fix_artifacts.string_to_rules, nargs="?", default=fix_artifacts.DEFAULT_RULES, help="Artifact rules applied by fix_library, see fix_artifacts.py")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    parser.add_argument("--config", nargs="?", default="~/.config/beets/config.yaml", help="The beets config")
+    parser.add_argument("--manifest", nargs="?", default="~/.config/beets/convert_manifest.db", help="The conversion manifest database")
+    parser.add_argument("--convertlog", nargs="?", default="./convert.log", help="File to write the conversion output to")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of songs or albums to process at once, defaults to the number of CPUs")
+    parser.add_argument("--retries", type=int, nargs="?", default=2, help="Number of times to retry a failed conversion")
+    parser.add_argument("--beetsdir", nargs="?", default="FLAC", help="Name of the subdir for the beets library present in the db")
+    parser.add_argument("--librarydir", nargs="?", default="FLAC", help="Name of the subdir for the library folder")
+    parser.add_argument("--converteddir", nargs="?", default="V2", help="Name of the subdir for the converted folder")
+    parser.add_argument("--ext", nargs="?", default="mp3", help="File format of the converted directory")
+    parser.add_argument("--maxsize", type=int, nargs="?", default=None, help="Largest width and height in pixels of covers copied to the converted folder, see copy_covers.py")
+    parser.add_argument("--quality", type=int, nargs="?", default=copy_covers.DEFAULT_QUALITY, help="JPEG quality of resized covers")
+    parser.add_argument("--cachedir", nargs="?", default=copy_covers.DEFAULT_CACHE_DIR, help="Directory to keep resized covers in")
+    parser.add_argument("--interactive", type=beetutils.string_to_boolean, nargs="?", const=True, default="yes", help="Pause for confirmation when a step finds something")
+    parser.add_argument("--bell", nargs="?", default="\\a", help="Printed before each confirmation prompt, set to blank to disable")
+    parser.add_argument("--profilestep", choices=STEPS.keys(), nargs="?", default=None, help="Only profile this step, rather than the whole run")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# sync_artifacts.py
+# Lists all albums in a music library as well as a converted library
+# then mirrors any artifacts matching a set of patterns, such as cue and log files, into the converted album
+# if they are missing or have changed since they were last mirrored
+# Covers are left to copy_covers.py, which may resize them, so they are not mirrored by default
+# Artifacts are cloned with a reflink where the filesystem supports it, otherwise copied in the kernel with
+# copy_file_range, and only copied through Python as a last resort. Hardlinks can be used instead with --hardlink
+# USAGE:
+# --dir - Directory to search, in beets format
+# --librarydir - Name of the subdir for the library folder
+# --converteddir - Name of the subdir for the converted folder
+# --patterns - Space separated filename patterns of the artifacts to mirror, e.g. "*.cue *.log"
+# --dryrun - List the artifacts which would be mirrored only
+# --hash - Compare the contents of artifacts which have the same size but a different mtime, rather than copying any which are newer
+# --hardlink - Hardlink artifacts into the converted library instead of copying them, where both are on the same filesystem
+# --jobs - Number of artifacts to copy at once, defaults to the number of CPUs
+# --index - Optional path to a persistent library index, see library_index.py
+# --scanjobs - Number of directories to list at once, for network mounts and libraries spread over several disks
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson)
+# --report - Optional path to write a JSON report of stage timings and counters to
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector
+# --profile - Optional path to write cProfile stats of the run to
+# EXAMPLE:
+# Mirror cue and log files from ~/Music/FLAC into ~/Music/V2
+# python3 sync_artifacts.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2
+# List the logs in ~/Music/V2 which are missing or older than the log in ~/Music/FLAC, without copying them
+# python3 sync_artifacts.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --patterns="*.log" --dryrun
+# Hardlink the cue files instead of copying them
+# python3 sync_artifacts.py --dir=~/Music/FLAC --librarydir=FLAC --converteddir=V2 --patterns="*.cue" --hardlink
+import argparse,beetutils,errno,fcntl,fnmatch,os,shutil,sys,threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+# ioctl which clones the extents of one file into another, FICLONE from linux/fs.h
+FICLONE = 0x40049409
+# Covers are left out, since copy_covers.py may have resized them and a mirror would replace them at full size
+DEFAULT_PATTERNS = "*.cue *.log"
+# Errors which mean the filesystem cannot perform a copy method, rather than that the copy itself failed
+UNSUPPORTED_ERRORS = [errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM]
+
+def main(library_dir: str, library_subdir: str, converted_subdir: str, patterns: List[str], dry_run: bool, use_hash: bool = False, hardlink: bool = False, jobs: int = None, snapshot: beetutils.LibrarySnapshot = None, index_path: str = None, scan_jobs: int = None, output: str = "text") -> int:
+    # Expansion
+    library_dir = os.path.expanduser(library_dir)
+    if index_path is not None:
+        index_path = os.path.expanduser(index_path)
+
+    # Map albums between the library and the converted library beside it, e.g. ~/Music/FLAC and ~/Music/V2
+    library_index = beetutils.PathIndex(library_dir)
+    converted_index = library_index.with_root(beetutils.sibling_root(library_dir, library_subdir, converted_subdir))
+
+    # Use the snapshot if one has been provided, otherwise stream the albums from the library
+    library_albums = snapshot.get_library_albums() if snapshot is not None else beetutils.iter_library_albums(library_dir, index_path, scan_jobs)
+
+    # Artifacts to copy, once every album has been compared
+    syncs = []
+
+    for library_album in library_albums:
+        converted_album = library_index.map_path(library_album, converted_index)
+
+        # Albums which have not been converted yet are left alone, rather than creating an album of only artifacts
+        beetutils.METRICS.count("stat_calls")
+        if not os.path.isdir(converted_album):
+            continue
+
+        for source in _iter_album_artifacts(library_album, patterns, snapshot):
+            dest = os.path.join(converted_album, os.path.basename(source))
+            change = compare_artifact(source, dest, use_hash, hardlink)
+
+            if change is None:
+                continue
+
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "unsynced_artifact", dest, converted_album, change, source=source)
+            syncs.append((source, dest, None))
+
+    if dry_run:
+        return 0 if len(syncs) == 0 else 1
+
+    failures = sync_files(syncs, hardlink, jobs)
+
+    for dest, failure in failures:
+        print("Failed to sync %s: %s" % (dest, failure), file=sys.stderr)
+
+    return 0 if len(failures) == 0 else 1
+
+def _iter_album_artifacts(library_album: str, patterns: List[str], snapshot: beetutils.LibrarySnapshot = None) -> Iterator[str]:
+    """
+    Stream the files directly within an album which match any of the patterns
+
+    Args:
+        library_album: Full path to the album in the library
+        patterns: Filename patterns of the artifacts to mirror
+        snapshot: Snapshot of the library, if one has been built
+
+    Returns:
+        A generator of full paths to each matching file
+    """
+
+    if snapshot is not None:
+        artifacts = snapshot.get_album_artifacts(library_album)
+        paths = [path for extension, paths in artifacts.items() if extension != "dir" for path in paths if os.path.dirname(path) == library_album]
+    else:
+        with os.scandir(library_album) as entries:
+            paths = [entry.path for entry in entries if not entry.is_dir()]
+
+    for path in paths:
+        name = os.path.basename(path)
+
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            yield path
+
+def compare_artifact(source: str, dest: str, use_hash: bool = False, hardlink: bool = False, compare_size: bool = True) -> str:
+    """
+    Compare an artifact with its mirror, to decide whether it needs copying
+
+    Args:
+        source: Full path to the artifact in the library
+        dest: Full path to its mirror in the converted library
+        use_hash: Compare the contents of artifacts with the same size but a different mtime, rather than copying any which are newer
+        hardlink: Whether the mirror should be a hardlink to the artifact
+        compare_size: Whether the mirror should have the same size as the artifact, rather than being a processed copy
+
+    Returns:
+        "add" if the mirror is missing, "update" if it is out of date, or None if it is current or the artifact no longer exists
+    """
+
+    try:
+        beetutils.METRICS.count("stat_calls")
+        source_stat = os.stat(source)
+    except FileNotFoundError:
+        # Removed since the album was listed, there is nothing left to mirror
+        return None
+
+    try:
+        beetutils.METRICS.count("stat_calls")
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return "add"
+
+    # The same file, so it can never be out of date
+    if hardlink and (source_stat.st_dev, source_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return None
+
+    if compare_size and source_stat.st_size != dest_stat.st_size:
+        return "update"
+
+    # Mirrors carry the mtime of their artifact, so one with the same size and mtime is current without reading either
+    if source_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+        return None
+
+    # Only the mtime differs, such as after a touch or a restore from backup, so read both to be sure
+    if use_hash:
+        beetutils.METRICS.count("files_hashed", 2)
+        return "update" if beetutils.hash_file(source) != beetutils.hash_file(dest) else None
+
+    # Anything newer has changed since it was mirrored
+    return "update" if source_stat.st_mtime_ns > dest_stat.st_mtime_ns else None
+
+def sync_files(syncs: List[Tuple[str, str, str]], hardlink: bool = False, jobs: int = None) -> List[Tuple[str, str]]:
+    """
+    Copy a set of files across a pool of threads, continuing past any which fail
+
+    Args:
+        syncs: Array of (source path, destination path, path to take the mtime from) tuples, with None to take the mtime from the source
+        hardlink: Hardlink the files instead of copying them, where both are on the same filesystem
+        jobs: Number of files to copy at once, defaults to the number of CPUs
+
+    Returns:
+        An array of (destination path, failure message) tuples for each file which failed
+    """
+
+    failures = []
+
+    if len(syncs) == 0:
+        return failures
+
+    # Copies spend their time in the kernel, outside of the GIL, so threads are enough
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        results = pool.map(lambda sync: _try_copy_file(sync[0], sync[1], hardlink, sync[2]), syncs)
+
+        for (source, dest, times_from), (method, size, failure) in zip(syncs, results):
+            if failure is not None:
+                failures.append((dest, failure))
+                continue
+
+            beetutils.METRICS.count("files_%s" % method)
+            if method not in ["reflinked", "hardlinked"]:
+                beetutils.METRICS.count("bytes_copied", size)
+
+    return failures
+
+def _try_copy_file(source: str, dest: str, hardlink: bool = False, times_from: str = None) -> Tuple[str, int, str]:
+    """
+    Copies a file with copy_file, capturing any failure
+
+    Args:
+        source: Path to the file to copy
+        dest: Path to copy the file to
+        hardlink: Hardlink the file instead of copying it, where possible
+        times_from: Path to take the mtime of the copy from, the source if not provided
+
+    Returns:
+        A tuple of how the file was copied, the size of the file, and the failure message if it failed
+    """
+
+    try:
+        return copy_file(source, dest, hardlink, times_from) + (None,)
+    except FileNotFoundError as e:
+        # Either the source was removed since it was listed, or the destination album does not exist
+        return None, 0, "%s does not exist" % (source if e.filename == source else os.path.dirname(dest))
+    except OSError as e:
+        return None, 0, "%s: %s" % (type(e).__name__, e)
+
+def copy_file(source: str, dest: str, hardlink: bool = False, times_from: str = None) -> Tuple[str, int]:
+    """
+    Copies a file as cheaply as the filesystem allows, replacing the destination atomically
+    A hardlink is tried first if requested, then a reflink, then copy_file_range, then an ordinary copy
+
+    Args:
+        source: Path to the file to copy
+        dest: Path to copy the file to
+        hardlink: Hardlink the file instead of copying it, where possible
+        times_from: Path to take the mtime of the copy from, the source if not provided
+
+    Returns:
+        A tuple of how the file was copied, one of hardlinked, reflinked, copy_file_ranged or copied, and the size of the file
+    """
+
+    # Unique to this thread, so concurrent copies into the same album never collide
+    temp_path = "%s.%d-%d.sync" % (dest, os.getpid(), threading.get_ident())
+
+    try:
+        if hardlink:
+            try:
+                os.link(source, temp_path)
+                os.replace(temp_path, dest)
+                return "hardlinked", os.path.getsize(dest)
+            except OSError as e:
+                # Fall back to copying when the library and converted library are on different filesystems
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+
+        with open(source, "rb") as source_file, open(temp_path, "wb") as temp_file:
+            method = _copy_data(source_file, temp_file)
+            size = os.fstat(temp_file.fileno()).st_size
+
+        # Carry the mtime over, which is how later runs tell the copy is current
+        times_stat = os.stat(times_from if times_from is not None else source)
+        os.utime(temp_path, ns=(times_stat.st_atime_ns, times_stat.st_mtime_ns))
+
+        # Only ever expose a complete copy
+        os.replace(temp_path, dest)
+
+        return method, size
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+def _copy_data(source_file, dest_file) -> str:
+    """
+    Copies the contents of one open file to another, as cheaply as the filesystem allows
+
+    Args:
+        source_file: File to copy from, opened for reading in binary mode
+        dest_file: Empty file to copy to, opened for writing in binary mode
+
+    Returns:
+        How the file was copied, one of reflinked, copy_file_ranged or copied
+    """
+
+    # A reflink shares the extents of the source, taking no extra space until either file changes
+    try:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+        return "reflinked"
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRORS:
+            raise
+
+    # copy_file_range copies within the kernel, and can still share extents on some filesystems, such as NFS and XFS
+    if hasattr(os, "copy_file_range"):
+        size = os.fstat(source_file.fileno()).st_size
+        copied = 0
+
+        try:
+            while copied < size:
+                length = os.copy_file_range(source_file.fileno(), dest_file.fileno(), size - copied)
+
+                if length == 0:
+                    break
+
+                copied += length
+        except OSError as e:
+            # Only fall back if nothing was copied, otherwise the file positions are partway through
+            if e.errno not in UNSUPPORTED_ERRORS or copied > 0:
+                raise
+
+        if copied == size:
+            return "copy_file_ranged"
+
+        # Stopped short, as the source changed size or the filesystem gave up early, so copy the rest from where it stopped
+        source_file.seek(copied)
+        dest_file.seek(copied)
+
+    shutil.copyfileobj(source_file, dest_file, 1048576)
+    return "copied"
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", nargs="?", default="~/media/Music/FLAC", help="Location of the beets music library files")
+    parser.add_argument("--librarydir", nargs="?", default="FLAC", help="Name of the subdir for the library folder")
+    parser.add_argument("--converteddir", nargs="?", default="V2", help="Name of the subdir for the converted folder")
+    parser.add_argument("--patterns", type=str.split, nargs="?", default=DEFAULT_PATTERNS, help="Space separated filename patterns of the artifacts to mirror")
+    parser.add_argument("--dryrun", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Dry run, only list the artifacts which would be mirrored")
+    parser.add_argument("--hash", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Compare the contents of artifacts with the same size but a different mtime, rather than copying any which are newer")
+    parser.add_argument("--hardlink", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Hardlink artifacts instead of copying them, where possible")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of artifacts to copy at once, defaults to the number of CPUs")
+    parser.add_argument("--index", nargs="?", default=None, help="Persistent library index, only changed directories are re-listed")
+    parser.add_argument("--scanjobs", type=int, nargs="?", default=None, help="Number of directories to list at once, one at a time by default")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with beetutils.instrumented(args, "sync_artifacts"):
+        result = main(args.dir, args.librarydir, args.converteddir, args.patterns, args.dryrun, args.hash, args.hardlink, args.jobs, index_path=args.index, scan_jobs=args.scanjobs, output=args.output)
+
+    exit(result)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# test_beetutils.py
+# Tests for mapping library paths between the library and the converted library
+# USAGE:
+# python3 -m unittest test_beetutils
+import os,tempfile,unittest,beetutils,sync_artifacts
+from contextlib import redirect_stdout
+from io import StringIO
+
+class PathIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.TemporaryDirectory(prefix="beets-test-")
+        os.chdir(self.work_dir.name)
+
+        os.makedirs(os.path.join("Music", "FLAC", "Artist", "Album"))
+        os.makedirs(os.path.join("Music", "V2", "Artist", "Album"))
+        with open(os.path.join("Music", "FLAC", "Artist", "Album", "Album.cue"), "w") as cue_file:
+            cue_file.write("cue")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.work_dir.cleanup()
+
+    def test_map_path_relative_root(self):
+        converted_album = os.path.abspath(os.path.join("Music", "V2", "Artist", "Album"))
+
+        for library_dir in ["./Music/FLAC", "Music/FLAC/", "Music//FLAC", os.path.abspath("Music/FLAC")]:
+            library_index = beetutils.PathIndex(library_dir)
+            converted_index = library_index.with_root(beetutils.sibling_root(library_dir, "FLAC", "V2"))
+
+            # Albums are listed in the same form as the root they were listed from
+            for library_album in beetutils.iter_library_albums(library_dir):
+                self.assertEqual(library_index.map_path(library_album, converted_index), converted_album)
+
+    def test_map_path_several_roots(self):
+        os.makedirs(os.path.join("Disk", "FLAC", "Artist", "Album"))
+        library_dir = os.pathsep.join(["Music/FLAC", "Disk/FLAC"])
+
+        library_index = beetutils.PathIndex(library_dir)
+        converted_index = library_index.with_root(beetutils.sibling_root(library_dir, "FLAC", "V2"))
+
+        # The same album on each disk maps onto the converted library beside it
+        for disk in ["Music", "Disk"]:
+            library_album = os.path.join(disk, "FLAC", "Artist", "Album")
+            self.assertEqual(library_index.map_path(library_album, converted_index), os.path.abspath(os.path.join(disk, "V2", "Artist", "Album")))
+
+    def test_key_outside_root(self):
+        self.assertIsNone(beetutils.PathIndex("./Music/FLAC").key("./Music/V2/Artist/Album"))
+
+    def test_sync_artifacts_relative_dir(self):
+        with redirect_stdout(StringIO()) as output:
+            result = sync_artifacts.main("./Music/FLAC", "FLAC", "V2", ["*.cue"], True)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(output.getvalue().split(), [os.path.abspath(os.path.join("Music", "V2", "Artist", "Album", "Album.cue"))])
+
+if __name__ == "__main__":
+    unittest.main()
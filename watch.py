@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+# watch.py
+# Watches the import directory, library and converted library with inotify, doing only the work
+# needed for the albums that changed, rather than waiting for the next run of beets.sh full
+# Bursts of events are debounced, then new arrivals in the import directory are imported, and each
+# touched library album is audited for missing songs, its cover and artifacts, and converted. The
+# beets config, conversion manifest and beets database results are kept between events. Linux only
+# USAGE:
+# --db - Path to the beets datbase file
+# --config - Path to the beets config.yaml, the library and converted directories are read from it
+# --manifest - Path to the conversion manifest database
+# --import - Directory to import new music from
+# --artifactdir - Directory to move jpg artifacts to
+# --rules - Space separated extension:action artifact rules, see fix_artifacts.py
+# --fix - Apply the artifact rules, rather than only reporting the artifacts found
+# --beet - Path to the beet binary used to import
+# --ext - Extension of the songs in the library
+# --debounce - Seconds without any events before acting on them
+# --maxdelay - Most seconds to wait while events keep arriving before acting on them
+# --maxsize - Optional largest width and height in pixels of covers copied to the converted library, see copy_covers.py
+# --quality - JPEG quality of resized covers
+# --cachedir - Directory to keep resized covers in
+# --jobs - Number of songs to convert at once, defaults to the number of CPUs
+# --retries - Number of times to retry a failed conversion
+# --output - Write findings as plain paths (text, the default) or one JSON record per line (ndjson), with progress messages on stderr
+# --report - Optional path to write a JSON report of stage timings and counters to, once stopped
+# --prometheus - Optional path to write stage timings and counters to for the Prometheus textfile collector, after every batch
+# --profile - Optional path to write cProfile stats of the run to, once stopped
+# EXAMPLE:
+# Watch ~/media/Music/Import and the library in ~/config.yaml, importing and converting new albums as they arrive
+# python3 watch.py --config=~/config.yaml --db=~/library.db --import=~/media/Music/Import
+# Also fix artifacts in the albums as they change
+# python3 watch.py --config=~/config.yaml --db=~/library.db --import=~/media/Music/Import --fix
+import argparse,ctypes,ctypes.util,errno,os,select,struct,subprocess,sys,time,beetutils
+import convert_library,copy_covers,fix_artifacts
+from typing import List, Tuple
+
+# inotify event masks, see inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events which change the contents of a directory, IN_MODIFY is left out since IN_CLOSE_WRITE follows the writes
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event, which is followed by a NUL padded name of len bytes
+EVENT_HEADER = struct.Struct("iIII")
+
+class Inotify:
+    """
+    Minimal inotify binding over the C library with ctypes
+
+    Attributes:
+        fd: The inotify file descriptor, which becomes readable when events are waiting
+        watches: Full paths of the watched directories, keyed by watch descriptor
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.watches = {}
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, directory: str) -> None:
+        """
+        Watch a single directory
+
+        Args:
+            directory: Full path to the directory to watch
+        """
+
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+
+        if wd < 0:
+            error = ctypes.get_errno()
+
+            # Every directory takes a watch, and the limit is shared by every inotify instance of the user
+            if error == errno.ENOSPC:
+                raise OSError(error, "Ran out of inotify watches after watching %d directories, raise fs.inotify.max_user_watches above the number of directories, currently %s, e.g. with sudo sysctl fs.inotify.max_user_watches=%d" % (len(self.watches), _read_watch_limit(), max(len(self.watches) * 2, 524288)), directory)
+
+            raise OSError(error, os.strerror(error), directory)
+
+        self.watches[wd] = directory
+
+    def add_tree(self, root: str) -> List[str]:
+        """
+        Watch a directory and every directory within it
+
+        Args:
+            root: Full path to the directory to watch
+
+        Returns:
+            An array of full paths to every directory now watched
+
+        Raises:
+            OSError: With errno.ENOSPC if the watch limit was reached partway through the tree
+        """
+
+        directories = []
+
+        for directory, dirs, files in os.walk(root):
+            try:
+                self.add_watch(directory)
+                directories.append(directory)
+            except FileNotFoundError:
+                # Removed again before it could be watched
+                continue
+
+        return directories
+
+    def remove_tree(self, root: str) -> None:
+        """
+        Stop watching a directory and every directory within it, such as when it is moved away
+
+        Args:
+            root: Full path to the directory to stop watching
+        """
+
+        prefix = os.path.join(root, "")
+
+        for wd, directory in list(self.watches.items()):
+            if directory == root or directory.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self) -> List[Tuple[str, int]]:
+        """
+        Read every event waiting, without blocking
+
+        Returns:
+            An array of (full path, mask) tuples for each event, with a path of None for a queue overflow
+        """
+
+        events = []
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+
+                # Events were dropped, so the caller has to assume anything could have changed
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+
+                # The watch was removed, either explicitly or because the directory is gone
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                directory = self.watches.get(wd)
+                if directory is not None:
+                    events.append((os.path.join(directory, os.fsdecode(name)) if name else directory, mask))
+
+    def close(self) -> None:
+        """
+        Close the inotify file descriptor, removing every watch
+        """
+
+        os.close(self.fd)
+
+class Watcher:
+    """
+    State kept warm between batches of events
+
+    Attributes:
+        args: Parsed command line arguments
+        library_dir: Path to the library, from the beets config
+        converted_dir: Path to the converted library, from the beets config
+        inotify: The inotify instance watching every directory
+        pending_imports: Full paths to entries in the import directory which have changed
+        pending_albums: Full paths to library albums which have changed
+        pending_converted: Full paths to converted albums which have changed
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.library_dir, self.converted_dir, self.command, self.extension, self.never_convert_lossy, self.id3v23 = convert_library.load_convert_settings(args.config)
+        self.manifest = convert_library.open_manifest(args.manifest)
+        self.inotify = Inotify()
+        self.pending_imports = set()
+        self.pending_albums = set()
+        self.pending_converted = set()
+
+        # Songs in the beets database for each album, discarded whenever the database changes
+        self._album_songs = {}
+        self._db_mtime = None
+
+        try:
+            for root in [args.import_dir, self.library_dir, self.converted_dir]:
+                self.log("Watching %d directories in %s" % (len(self.inotify.add_tree(root)), root))
+        except OSError:
+            self.close()
+            raise
+
+        # Anything dropped in while not watching would otherwise wait for the next event
+        for entry in os.listdir(args.import_dir):
+            self.pending_imports.add(os.path.join(args.import_dir, entry))
+
+    def log(self, message: str) -> None:
+        """
+        Print a progress message, keeping it apart from the findings when writing them as ndjson
+
+        Args:
+            message: Message to print
+        """
+
+        print(message, file=sys.stderr if self.args.output == "ndjson" else sys.stdout, flush=True)
+
+    def watch(self) -> None:
+        """
+        Wait for events, acting on them once they have stopped arriving for the debounce period
+        """
+
+        first_event = None
+        last_event = None
+
+        while True:
+            timeout = None
+            if first_event is not None:
+                # Wait for the burst to settle, but not forever if events keep trickling in
+                timeout = max(0, min(last_event + self.args.debounce, first_event + self.args.maxdelay) - time.monotonic())
+
+            readable, _, _ = select.select([self.inotify], [], [], timeout)
+
+            if readable:
+                for path, mask in self.inotify.read_events():
+                    self.queue(path, mask)
+
+                last_event = time.monotonic()
+                if first_event is None:
+                    first_event = last_event
+
+                continue
+
+            first_event = None
+            last_event = None
+
+            with beetutils.METRICS.stage("batch"):
+                self.process()
+
+            # Keep a running total for each stage, rather than a stage for every batch the daemon ever runs
+            beetutils.METRICS.merge_stages()
+
+            if self.args.prometheus is not None:
+                beetutils.METRICS.write_prometheus(os.path.expanduser(self.args.prometheus))
+
+    def queue(self, path: str, mask: int) -> None:
+        """
+        Queue the work affected by a single event
+
+        Args:
+            path: Full path the event is about, or None if the event queue overflowed
+            mask: inotify mask of the event
+        """
+
+        beetutils.METRICS.count("events")
+
+        if path is None:
+            # Events were lost, so check everything rather than miss an album
+            self.log("inotify queue overflowed, checking every album")
+            self.pending_imports.update(os.path.join(self.args.import_dir, entry) for entry in os.listdir(self.args.import_dir))
+            self.pending_albums.update(beetutils.iter_library_albums(self.library_dir))
+            return
+
+        paths = [path]
+
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # Watch new directories, and queue everything already within them since their own events were missed
+            try:
+                paths += self.inotify.add_tree(path)
+            except OSError as e:
+                # The directory is still checked this once, but later changes within it are missed until restarted
+                if e.errno != errno.ENOSPC:
+                    raise
+
+                self.log("Not watching %s: %s" % (path, e.strerror))
+        elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+            self.inotify.remove_tree(path)
+
+        for path in paths:
+            import_entry = _top_entry(path, self.args.import_dir)
+            if import_entry is not None:
+                self.pending_imports.add(import_entry)
+                continue
+
+            album = _album_dir(path, self.library_dir)
+            if album is not None:
+                self.pending_albums.add(album)
+                continue
+
+            converted_album = _album_dir(path, self.converted_dir)
+            if converted_album is not None:
+                self.pending_converted.add(converted_album)
+
+    def process(self) -> None:
+        """
+        Do the work queued by the last batch of events
+        """
+
+        imports, self.pending_imports = sorted(self.pending_imports), set()
+        albums, self.pending_albums = sorted(self.pending_albums), set()
+
+        # Any import lands in the library, which queues its albums for the next batch
+        for import_entry in imports:
+            if os.path.exists(import_entry):
+                with beetutils.METRICS.stage("import"):
+                    self.import_entry(import_entry)
+
+        # Only re-read the database once it has changed, such as after an import
+        db_mtime = os.stat(self.args.db).st_mtime_ns
+        if db_mtime != self._db_mtime:
+            self._album_songs = {}
+            self._db_mtime = db_mtime
+
+        for album in albums:
+            if os.path.isdir(album):
+                with beetutils.METRICS.stage("album"):
+                    self.process_album(album)
+
+        # Converted albums are queued both by their own events, and by converting their library album
+        converted_albums, self.pending_converted = sorted(self.pending_converted), set()
+
+        for converted_album in converted_albums:
+            if os.path.isdir(converted_album):
+                with beetutils.METRICS.stage("converted_album"):
+                    self.process_converted_album(converted_album)
+
+    def import_entry(self, import_entry: str) -> None:
+        """
+        Import a single entry from the import directory with beets, without prompting
+
+        Args:
+            import_entry: Full path to the album or file in the import directory
+        """
+
+        self.log("Importing %s" % import_entry)
+
+        # Keep the output of beets out of the records when writing ndjson
+        process = subprocess.run([self.args.beet, "import", "-q", import_entry], stdin=subprocess.DEVNULL, stdout=sys.stderr if self.args.output == "ndjson" else None)
+
+        if process.returncode != 0:
+            print("Failed to import %s: beet exited with %d" % (import_entry, process.returncode), file=sys.stderr)
+
+    def album_songs(self, album: str) -> List[str]:
+        """
+        Retrieve the songs in the beets database within an album, reading the database only once per album until it changes
+
+        Args:
+            album: Full path to the album in the library
+
+        Returns:
+            An array of full song paths in the album
+        """
+
+        if album not in self._album_songs:
+            self._album_songs[album] = [beetutils.decode_beets_path(row[0]) for row in beetutils.iter_beets_rows(self.args.db, ["path"], folder=album)]
+
+        return self._album_songs[album]
+
+    def process_album(self, album: str) -> None:
+        """
+        Audit, fix and convert a single library album
+
+        Args:
+            album: Full path to the album in the library
+        """
+
+        args = self.args
+        output = args.output
+        self.log("Checking %s" % album)
+
+        # Classify everything in the album once, for every check
+        album_artifacts = beetutils.get_album_artifacts(album)
+        album_songs = self.album_songs(album)
+
+        # Songs in beets missing from the album, and in the album missing from beets
+        for in_beets, song in beetutils.iter_reconcile([song for song in album_songs if song.endswith("." + args.ext)], album_artifacts.get(args.ext, [])):
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "missing_library_song" if in_beets else "missing_db_song", song, album, "remove_from_db" if in_beets else "import")
+
+        cover_path = os.path.join(album, "cover.jpg")
+        if cover_path not in album_artifacts.get("jpg", []):
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "missing_artifact", cover_path, album, "add")
+
+        fixes = fix_artifacts.match_album_artifacts(album, album_artifacts, args.rules, args.artifactdir)
+        for (extension, action), artifact, target in fixes:
+            beetutils.METRICS.count("files_matched")
+            beetutils.emit(output, "artifact", artifact, album, action, rule="%s:%s" % (extension, action), target=target)
+
+        if args.fix and len(fixes) > 0:
+            for artifact, failure in fix_artifacts.fix_album(fixes):
+                print("Failed to fix %s: %s" % (artifact, failure), file=sys.stderr)
+
+        # Convert any songs in the album which are new or have changed, according to the manifest
+        conversions = []
+        for source in album_songs:
+            conversion = convert_library.plan_conversion(self.manifest, source, self.library_dir, self.converted_dir, self.extension, self.never_convert_lossy, False)
+
+            if conversion is not None:
+                conversions.append(conversion)
+
+        self.manifest.commit()
+
+        if len(conversions) > 0:
+            self.log("Converting %d songs in %s" % (len(conversions), album))
+            convert_library.run_conversions(self.manifest, conversions, self.command, args.jobs, args.retries, self.library_dir, self.converted_dir, output, args.db, self.id3v23)
+
+        # Check the converted album once it exists, even if nothing needed converting
+        self.pending_converted.add(os.path.join(self.converted_dir, os.path.relpath(album, self.library_dir)))
+
+    def process_converted_album(self, converted_album: str) -> None:
+        """
+        Copy and embed the cover of a single converted album, if it is missing or the library cover has changed since
+
+        Args:
+            converted_album: Full path to the album in the converted library
+        """
+
+        library_cover_path = os.path.join(self.library_dir, os.path.relpath(converted_album, self.converted_dir), "cover.jpg")
+        converted_cover_path = os.path.join(converted_album, "cover.jpg")
+
+        beetutils.METRICS.count("stat_calls", 2)
+        if not os.path.isfile(library_cover_path):
+            return
+
+        # Resized covers are current only if they were resized with the same settings
+        copied_covers = copy_covers.open_copied_covers(self.args.cachedir) if self.args.maxsize is not None else None
+
+        try:
+            if not os.path.isfile(converted_cover_path):
+                kind = "missing_cover"
+            elif copy_covers.is_cover_changed(library_cover_path, converted_cover_path, self.args.maxsize, self.args.quality, copied_covers):
+                kind = "changed_cover"
+            else:
+                return
+        finally:
+            if copied_covers is not None:
+                copied_covers.close()
+
+        beetutils.METRICS.count("files_matched")
+        beetutils.emit(self.args.output, kind, converted_cover_path, converted_album, "copy_and_embed", source=library_cover_path)
+
+        # A single album gains nothing from a pool of workers
+        copy_covers.copy_album_covers([(library_cover_path, converted_cover_path)], self.args.maxsize, self.args.quality, self.args.cachedir, 1)
+        copy_covers.embed_albums([(converted_album, converted_cover_path)], 1)
+
+    def close(self) -> None:
+        """
+        Stop watching and close the conversion manifest
+        """
+
+        self.inotify.close()
+        self.manifest.close()
+
+def _top_entry(path: str, root: str) -> str:
+    """
+    Find the entry directly within a root that a path is in
+
+    Args:
+        path: Full path to a file or directory
+        root: Full path to the root directory
+
+    Returns:
+        The full path to the entry directly within the root, or None if the path is not within the root
+    """
+
+    parts = os.path.relpath(path, root).split(os.sep)
+
+    if parts[0] in (os.curdir, os.pardir):
+        return None
+
+    return os.path.join(root, parts[0])
+
+def _album_dir(path: str, library_dir: str) -> str:
+    """
+    Find the album a path is in, in the "$artist/$album/..." layout of a library
+
+    Args:
+        path: Full path to a file or directory
+        library_dir: Path to the library which contains the artist folders
+
+    Returns:
+        The full path to the album folder, or None if the path is not within an album of the library
+    """
+
+    parts = os.path.relpath(path, library_dir).split(os.sep)
+
+    if parts[0] in (os.curdir, os.pardir) or len(parts) < 2:
+        return None
+
+    return os.path.join(library_dir, parts[0], parts[1])
+
+def _read_watch_limit() -> str:
+    """
+    Read the inotify watch limit of each user
+
+    Returns:
+        The value of fs.inotify.max_user_watches, or unknown if it cannot be read
+    """
+
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as limit_file:
+            return limit_file.read().strip()
+    except OSError:
+        return "unknown"
+
+def main(args: argparse.Namespace) -> int:
+    # Expansion
+    for path in ["db", "config", "manifest", "import_dir", "artifactdir"]:
+        setattr(args, path, os.path.expanduser(getattr(args, path)))
+
+    try:
+        watcher = Watcher(args)
+    except OSError as e:
+        # A large library can use up every watch before watching has begun, which needs the limit raising
+        if e.errno != errno.ENOSPC:
+            raise
+
+        print(e.strerror, file=sys.stderr)
+        return 1
+
+    try:
+        watcher.watch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return 0
+
+if __name__ == "__main__":
+    # Interactive command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", nargs="?", default="~/.config/beets/library.db", help="The beets database")
+    parser.add_argument("--config", nargs="?", default="~/.config/beets/config.yaml", help="The beets config")
+    parser.add_argument("--manifest", nargs="?", default="~/.config/beets/convert_manifest.db", help="The conversion manifest database")
+    parser.add_argument("--import", dest="import_dir", nargs="?", default="~/media/Music/Import", help="Directory to import new music from")
+    parser.add_argument("--artifactdir", nargs="?", default="~/media/Music/Misc/Artifacts", help="Directory to move jpg artifacts to")
+    parser.add_argument("--rules", type=fix_artifacts.string_to_rules, nargs="?", default=fix_artifacts.DEFAULT_RULES, help="Artifact rules, see fix_artifacts.py")
+    parser.add_argument("--fix", type=beetutils.string_to_boolean, nargs="?", const=True, default="no", help="Apply the artifact rules, rather than only reporting artifacts")
+    parser.add_argument("--beet", nargs="?", default="beet", help="Path to the beet binary used to import")
+    parser.add_argument("--ext", nargs="?", default="flac", help="Extension of the songs in the library")
+    parser.add_argument("--debounce", type=float, nargs="?", default=5.0, help="Seconds without any events before acting on them")
+    parser.add_argument("--maxdelay", type=float, nargs="?", default=60.0, help="Most seconds to wait while events keep arriving")
+    parser.add_argument("--maxsize", type=int, nargs="?", default=None, help="Largest width and height in pixels of copied covers, see copy_covers.py")
+    parser.add_argument("--quality", type=int, nargs="?", default=copy_covers.DEFAULT_QUALITY, help="JPEG quality of resized covers")
+    parser.add_argument("--cachedir", nargs="?", default=copy_covers.DEFAULT_CACHE_DIR, help="Directory to keep resized covers in")
+    parser.add_argument("--jobs", type=int, nargs="?", default=None, help="Number of songs to convert at once, defaults to the number of CPUs")
+    parser.add_argument("--retries", type=int, nargs="?", default=2, help="Number of times to retry a failed conversion")
+    beetutils.add_output_arguments(parser)
+    beetutils.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    args.jobs = args.jobs or os.cpu_count()
+
+    with beetutils.instrumented(args, "watch"):
+        result = main(args)
+
+    exit(result)